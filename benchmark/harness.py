@@ -0,0 +1,587 @@
+#!/usr/bin/env python
+
+"""Benchmark harness for ZooKeeper clients, dbeelogs and dbees.
+
+Each backend is an adapter that runs numbered operations asynchronously and
+reports their completion through a callback. The harness keeps up to
+--concurrency operations in flight, records the latency of every operation
+after the first --warmup of each phase, and prints a JSON report with latency
+percentiles, a latency histogram and the throughput over time of each phase.
+
+    harness.py kazoo --server localhost:2181 --batch_size 100
+    harness.py zkpython --server localhost:2181
+    harness.py dbeelog --log local --directory /tmp/dbeelog
+    harness.py dbeelog --log zk --server localhost:2181
+    harness.py dbeelog --log zk --server fake --fake_latency 0.5
+    harness.py dbeelog --log mypackage.module:make_log
+    harness.py dbee --dbee dbeekeeper.dbee.memory:MemoryDbee
+
+--log and --dbee take the name of a callable, module:attribute. The --log
+callable is called with the parsed options and returns a dbeelog.Base; the
+--dbee callable is called without arguments and returns a dbee.Base.
+Transactions for dbees are built by --transaction, a callable that takes a
+key and a value; the default builds MemoryDbee transactions.
+
+--server fake replaces the ZooKeeper server of the kazoo adapter and of the
+zk dbeelog with an in-process dbeekeeper.dbeelog.fakezk.FakeServer, whose
+latency, fsync cost and jitter are set by --fake_latency, --fake_fsync and
+--fake_jitter, and made reproducible by --fake_seed.
+
+See README for the dependencies of the kazoo and zkpython adapters.
+"""
+
+import importlib
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+# Upper bound of the first histogram bucket, in milliseconds. Each bucket is
+# twice as wide as the previous one.
+HISTOGRAM_BASE = 0.01
+
+PERCENTILES = (("p50", 50.0), ("p99", 99.0), ("p999", 99.9))
+
+
+def load(name):
+    """Return the object module:attribute refers to."""
+    module, _, attribute = name.partition(":")
+    return getattr(importlib.import_module(module), attribute)
+
+
+def percentile(values, p):
+    """Return the p-th percentile of sorted values by nearest rank."""
+    if not values:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def histogram(values):
+    """Count sorted latencies in buckets that double in width.
+
+    Returns:
+        list of [upper bound in milliseconds, count] for the non-empty
+        buckets.
+    """
+    buckets = []
+    bound = HISTOGRAM_BASE
+    for value in values:
+        while value > bound:
+            bound *= 2
+        if buckets and buckets[-1][0] == bound:
+            buckets[-1][1] += 1
+        else:
+            buckets.append([bound, 1])
+    return buckets
+
+
+class Recorder(object):
+    """Latencies and completion times of the operations of one phase."""
+
+    def __init__(self, count, warmup):
+        self._count = count
+        self._warmup = warmup
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._completed = 0
+        self._start = None
+        self._latencies = []
+        self._completions = []
+        self._errors = 0
+        self._first_error = None
+
+    def start(self, i):
+        """Return the start time of operation i."""
+        now = time.time()
+        if i == self._warmup:
+            self._start = now
+        return now
+
+    def finish(self, i, start, error):
+        now = time.time()
+        with self._lock:
+            if i >= self._warmup:
+                if error is not None:
+                    self._errors += 1
+                    self._first_error = self._first_error or str(error)
+                else:
+                    self._latencies.append((now - start) * 1000)
+                    self._completions.append(now)
+            self._completed += 1
+            if self._completed == self._count:
+                self._done.set()
+
+    def wait(self):
+        self._done.wait()
+
+    def report(self, interval):
+        latencies = sorted(self._latencies)
+        result = {"operations": len(latencies) + self._errors,
+                  "errors": self._errors}
+        if self._first_error is not None:
+            result["first_error"] = self._first_error
+        if not latencies:
+            return result
+        elapsed = max(self._completions) - self._start
+        timeline = [0] * (int(elapsed / interval) + 1)
+        for completion in self._completions:
+            timeline[int((completion - self._start) / interval)] += 1
+        latency = {"min": latencies[0], "max": latencies[-1],
+                   "mean": sum(latencies) / len(latencies)}
+        for name, p in PERCENTILES:
+            latency[name] = percentile(latencies, p)
+        result.update({
+            "elapsed_s": elapsed,
+            "throughput": len(latencies) / elapsed if elapsed else None,
+            "latency_ms": latency,
+            "histogram_ms": histogram(latencies),
+            "timeline": {"interval_s": interval,
+                         "operations": timeline},
+        })
+        return result
+
+
+def run_phase(adapter, phase, count, options):
+    """Run count operations of a phase and return its report."""
+    warmup = min(options.warmup, count)
+    recorder = Recorder(count + warmup, warmup)
+    slots = threading.Semaphore(options.concurrency)
+
+    def done(i, start, error):
+        recorder.finish(i, start, error)
+        slots.release()
+
+    for i in range(count + warmup):
+        slots.acquire()
+        start = recorder.start(i)
+        try:
+            adapter.run(phase, i, (lambda error, i=i, start=start:
+                                   done(i, start, error)))
+        except Exception as e:
+            done(i, start, e)
+    recorder.wait()
+    report = recorder.report(options.interval)
+    report["phase"] = phase
+    report["warmup"] = warmup
+    return report
+
+
+class Adapter(object):
+    """Backend that runs numbered operations in phases."""
+
+    def setup(self):
+        pass
+
+    def teardown(self):
+        pass
+
+    def phases(self):
+        """Return the list of (phase, number of measured operations)."""
+        raise NotImplementedError()
+
+    def run(self, phase, i, callback):
+        """Start operation i of phase.
+
+        A phase runs its warmup operations and then the measured ones,
+        numbered consecutively from 0. callback(error) must be called once
+        the operation completes, from any thread.
+        """
+        raise NotImplementedError()
+
+
+def zk_client(options):
+    """Return a kazoo client for --server, which may be "fake"."""
+    if options.server == "fake":
+        from dbeekeeper.dbeelog import fakezk
+        server = fakezk.FakeServer(latency=options.fake_latency / 1000.0,
+                                   fsync=options.fake_fsync / 1000.0,
+                                   jitter=options.fake_jitter / 1000.0,
+                                   seed=options.fake_seed)
+        return fakezk.FakeClient(server)
+    from kazoo.client import KazooClient
+    return KazooClient(options.server)
+
+
+class KazooAdapter(Adapter):
+    """Create, set, get and delete znodes with kazoo."""
+
+    def __init__(self, options):
+        self._options = options
+        self._data = options.data_size * b"D"
+        self._client = zk_client(options)
+        self._root = options.root_znode
+
+    def setup(self):
+        self._client.start()
+        if self._client.exists(self._root):
+            for child in self._client.get_children(self._root):
+                self._client.delete("%s/%s" % (self._root, child))
+        else:
+            self._client.create(self._root, b"kazoo root znode")
+
+    def teardown(self):
+        self._client.stop()
+
+    def phases(self):
+        count = self._options.count
+        if self._options.batch_size:
+            count = (count - 1) // self._options.batch_size + 1
+            return [(op, count) for op in ("create", "set", "delete")]
+        return [(op, count) for op in ("create", "set", "get", "delete")]
+
+    def _path(self, i):
+        return "%s/session_%d" % (self._root, i)
+
+    def run(self, phase, i, callback):
+        batch_size = self._options.batch_size
+        if batch_size:
+            t = self._client.transaction()
+            for j in range(i * batch_size, (i + 1) * batch_size):
+                if phase == "create":
+                    t.create(self._path(j), self._data)
+                elif phase == "set":
+                    t.set_data(self._path(j), self._data)
+                else:
+                    t.delete(self._path(j))
+            result = t.commit_async()
+        elif phase == "create":
+            result = self._client.create_async(self._path(i), self._data)
+        elif phase == "set":
+            result = self._client.set_async(self._path(i), self._data)
+        elif phase == "get":
+            result = self._client.get_async(self._path(i))
+        else:
+            result = self._client.delete_async(self._path(i))
+
+        def done(result):
+            try:
+                result.get()
+            except Exception as e:
+                callback(e)
+            else:
+                callback(None)
+        result.rawlink(done)
+
+
+class ZkpythonAdapter(Adapter):
+    """Create, set, get and delete znodes with zkpython."""
+
+    ACL = [{"perms": 0x1f, "scheme": "world", "id": "anyone"}]
+
+    def __init__(self, options):
+        import zookeeper
+        self._zookeeper = zookeeper
+        self._options = options
+        self._data = options.data_size * "D"
+        self._root = options.root_znode
+        self._handle = None
+
+    def setup(self):
+        zk = self._zookeeper
+        zk.set_debug_level(zk.LOG_LEVEL_WARN)
+        self._handle = zk.init(self._options.server)
+        if zk.exists(self._handle, self._root, None):
+            for child in zk.get_children(self._handle, self._root, None):
+                zk.delete(self._handle, "%s/%s" % (self._root, child))
+        else:
+            zk.create(self._handle, self._root, "zkpy root znode", self.ACL,
+                      0)
+
+    def teardown(self):
+        self._zookeeper.close(self._handle)
+
+    def phases(self):
+        return [(op, self._options.count)
+                for op in ("create", "set", "get", "delete")]
+
+    def run(self, phase, i, callback):
+        zk = self._zookeeper
+        path = "%s/session_%d" % (self._root, i)
+
+        def done(handle, rc, *args):
+            callback(None if rc == zk.OK else zk.ZooKeeperException(
+                "%s failed with error code %d" % (phase, rc)))
+        if phase == "create":
+            zk.acreate(self._handle, path, self._data, self.ACL, 0, done)
+        elif phase == "set":
+            zk.aset(self._handle, path, self._data, -1, done)
+        elif phase == "get":
+            zk.aget(self._handle, path, None, done)
+        else:
+            zk.adelete(self._handle, path, -1, done)
+
+
+def local_log(options):
+    """Create a LocalLog in --directory, or a temporary directory.
+
+    Returns:
+        (log, function that closes it)
+    """
+    from dbeekeeper.dbeelog import local
+    directory = options.directory or tempfile.mkdtemp()
+    journal = local.Journal(directory, block_size=options.block_size)
+    log = local.LocalLog("benchmark", "client1", journal)
+
+    def cleanup():
+        log.close()
+        journal.close()
+        if not options.directory:
+            shutil.rmtree(directory)
+    return log, cleanup
+
+
+def zk_log(options):
+    """Create a ZkLog on --server under --root_znode.
+
+    Returns:
+        (log, function that closes it)
+    """
+    from dbeekeeper.dbeelog import zk
+    client = zk_client(options)
+    client.start()
+    log = zk.ZkLog("benchmark", "client1", client, root=options.root_znode,
+                   batch_size=options.batch_size or zk.DEFAULT_BATCH_SIZE)
+
+    def cleanup():
+        log.close()
+        client.stop()
+    return log, cleanup
+
+
+LOGS = {"local": local_log, "zk": zk_log}
+
+
+class DbeelogAdapter(Adapter):
+    """Append to and checkpoint any dbeelog.Base."""
+
+    def __init__(self, options):
+        self._options = options
+        self._data = options.data_size * "D"
+        self._log = None
+        self._cleanup = None
+        self._last = None
+
+    def setup(self):
+        if self._options.log in LOGS:
+            self._log, self._cleanup = LOGS[self._options.log](self._options)
+        else:
+            self._log = load(self._options.log)(self._options)
+            self._cleanup = getattr(self._log, "close", None)
+
+    def teardown(self):
+        if self._cleanup is not None:
+            self._cleanup()
+
+    def phases(self):
+        count = self._options.count
+        phases = [("append", count)]
+        if self._options.batch_size:
+            phases.append(("append_many",
+                           (count - 1) // self._options.batch_size + 1))
+        return phases + [("checkpoint", count), ("get_checkpoints", count)]
+
+    def run(self, phase, i, callback):
+        def done(error, result):
+            if phase in ("append", "append_many") and error is None:
+                self._last = result if phase == "append" else result[-1]
+            callback(error)
+        if phase == "append":
+            self._log.append(self._data, done)
+        elif phase == "append_many":
+            self._log.append_many([self._data] * self._options.batch_size,
+                                  done)
+        elif phase == "checkpoint":
+            self._log.checkpoint(self._last, done)
+        else:
+            self._log.get_checkpoints(done)
+
+
+class DbeeAdapter(Adapter):
+    """Execute transactions on, snapshot and restore any dbee.Base."""
+
+    def __init__(self, options):
+        self._options = options
+        self._factory = load(options.dbee)
+        self._transaction = load(options.transaction)
+        self._data = options.data_size * "D"
+        self._directory = None
+        self._dbee = None
+
+    def setup(self):
+        self._directory = tempfile.mkdtemp()
+        self._dbee = self._factory()
+
+    def teardown(self):
+        shutil.rmtree(self._directory)
+
+    def phases(self):
+        count = self._options.count
+        phases = [("execute", count)]
+        if self._options.batch_size:
+            phases.append(("execute_batch",
+                           (count - 1) // self._options.batch_size + 1))
+        return phases + [("snapshot", self._options.snapshots),
+                         ("restore", self._options.snapshots)]
+
+    def run(self, phase, i, callback):
+        if phase == "snapshot":
+            # dbee allows one snapshot at a time.
+            done = threading.Event()
+            result = []
+
+            def finished(error, filename):
+                result.append(error)
+                done.set()
+            self._dbee.snapshot(os.path.join(self._directory,
+                                             "snapshot%d" % i), finished)
+            done.wait()
+            callback(result[0])
+            return
+        try:
+            if phase == "restore":
+                # Restore the snapshots of the previous phase into fresh
+                # dbees.
+                dbee = self._factory()
+                try:
+                    dbee.restore(os.path.join(
+                        self._directory,
+                        "snapshot%d" % (i % self._options.snapshots)))
+                finally:
+                    close = getattr(dbee, "close", None)
+                    if close is not None:
+                        close()
+            elif phase == "execute":
+                self._dbee.execute(self._transaction("key%d" % i,
+                                                     self._data))
+            else:
+                batch_size = self._options.batch_size
+                errors = self._dbee.execute_batch([
+                    self._transaction("key%d" % j, self._data)
+                    for j in range(i * batch_size, (i + 1) * batch_size)])
+                if any(errors):
+                    raise [e for e in errors if e is not None][0]
+        except Exception as e:
+            callback(e)
+        else:
+            callback(None)
+
+
+ADAPTERS = {
+    "kazoo": KazooAdapter,
+    "zkpython": ZkpythonAdapter,
+    "dbeelog": DbeelogAdapter,
+    "dbee": DbeeAdapter,
+}
+
+
+def parse_options(args):
+    parser = OptionParser(usage="usage: %%prog [options] {%s}" %
+                          ",".join(sorted(ADAPTERS)))
+    parser.add_option("", "--count", dest="count", type="int", default=10000,
+                      help="number of measured operations in each phase "
+                           "(default %default)")
+    parser.add_option("", "--warmup", dest="warmup", type="int",
+                      default=1000,
+                      help="number of operations to run before measuring "
+                           "each phase (default %default)")
+    parser.add_option("", "--concurrency", dest="concurrency", type="int",
+                      default=64,
+                      help="maximum number of operations in flight "
+                           "(default %default)")
+    parser.add_option("", "--sync", action="store_const", dest="concurrency",
+                      const=1, help="run one operation at a time")
+    parser.add_option("", "--batch_size", dest="batch_size", type="int",
+                      default=0,
+                      help="number of znodes or transactions in each batch "
+                           "operation (default %default means no batch "
+                           "phases)")
+    parser.add_option("", "--data_size", dest="data_size", type="int",
+                      default=20,
+                      help="size of each znode or transaction "
+                           "(default %default)")
+    parser.add_option("", "--interval", dest="interval", type="float",
+                      default=1.0,
+                      help="seconds per throughput timeline bucket "
+                           "(default %default)")
+    parser.add_option("", "--output", dest="output", default=None,
+                      help="file to write the JSON report to "
+                           "(default stdout)")
+    parser.add_option("", "--server", dest="server",
+                      default="localhost:2181",
+                      help="zookeeper server, or fake for an in-process "
+                           "one (default %default)")
+    parser.add_option("", "--fake_latency", dest="fake_latency",
+                      type="float", default=0.0,
+                      help="milliseconds the fake server adds to each "
+                           "response (default %default)")
+    parser.add_option("", "--fake_fsync", dest="fake_fsync", type="float",
+                      default=0.0,
+                      help="milliseconds each group commit of the fake "
+                           "server takes (default %default)")
+    parser.add_option("", "--fake_jitter", dest="fake_jitter", type="float",
+                      default=0.0,
+                      help="maximum random milliseconds the fake server "
+                           "adds to each response (default %default)")
+    parser.add_option("", "--fake_seed", dest="fake_seed", type="int",
+                      default=None,
+                      help="seed of the fake server's jitter")
+    parser.add_option("", "--root_znode", dest="root_znode",
+                      default="/zk-benchmark",
+                      help="root znode for the evaluation")
+    parser.add_option("", "--log", dest="log", default="local",
+                      help="dbeelog to benchmark: %s, or module:callable "
+                           "(default %%default)" % ", ".join(sorted(LOGS)))
+    parser.add_option("", "--directory", dest="directory", default=None,
+                      help="directory of the local dbeelog (default: a "
+                           "temporary directory)")
+    parser.add_option("", "--block_size", dest="block_size", type="int",
+                      default=None,
+                      help="block size of the local dbeelog "
+                           "(default uncompressed)")
+    parser.add_option("", "--dbee", dest="dbee",
+                      default="dbeekeeper.dbee.memory:MemoryDbee",
+                      help="dbee class or factory, module:callable "
+                           "(default %default)")
+    parser.add_option("", "--transaction", dest="transaction",
+                      default="dbeekeeper.dbee.memory:put",
+                      help="function that builds a transaction from a key "
+                           "and a value (default %default)")
+    parser.add_option("", "--snapshots", dest="snapshots", type="int",
+                      default=5,
+                      help="number of measured snapshots and restores "
+                           "(default %default)")
+    options, args = parser.parse_args(args)
+    if len(args) != 1 or args[0] not in ADAPTERS:
+        parser.error("specify one of %s" % ", ".join(sorted(ADAPTERS)))
+    return options, args[0]
+
+
+def main():
+    options, name = parse_options(sys.argv[1:])
+    adapter = ADAPTERS[name](options)
+    adapter.setup()
+    try:
+        phases = [run_phase(adapter, phase, count, options)
+                  for phase, count in adapter.phases()]
+    finally:
+        adapter.teardown()
+    report = {"adapter": name, "options": vars(options), "phases": phases}
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(data + "\n")
+    else:
+        print(data)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
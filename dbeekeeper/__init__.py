@@ -15,3 +15,4 @@
 
 from .error import ClientError
 from .error import DbeeError
+from .error import DbeeLogError
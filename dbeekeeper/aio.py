@@ -0,0 +1,280 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""asyncio facade for the callback-based dbeelog and dbee APIs.
+
+AsyncLog and AsyncDbee wrap a dbeelog.Base and a dbee.Base. Their methods
+return asyncio futures instead of taking callbacks, so coroutines can await
+them:
+
+    log = aio.AsyncLog(local.LocalLog(...))
+    transaction_id = await log.append(transaction)
+    async for transaction_id, client_id, transaction in log.subscribe(""):
+        ...
+
+Callbacks may be invoked from any thread. A callback invoked from a thread
+other than the loop's resolves its future with a single
+call_soon_threadsafe(); one invoked from the loop thread resolves it
+directly. Subscriptions hand entries over through a buffer and wake up the
+loop at most once per burst of entries rather than once per entry.
+
+The methods must be called from the thread that runs the event loop, and
+the log must deliver entries from a thread of its own. Unless the wrappers
+are given a loop, they use the running loop, so the methods must then be
+called while it runs. This module requires
+Python 3.5 or later.
+"""
+
+import asyncio
+import collections
+import threading
+
+
+DEFAULT_MAXSIZE = 1024
+
+# get_event_loop() is deprecated outside a running loop, but 3.5 and 3.6
+# have nothing else.
+_get_running_loop = getattr(asyncio, "get_running_loop",
+                            asyncio.get_event_loop)
+
+
+def _resolve(future, error, result):
+    # A caller that stopped waiting may have cancelled the future.
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+def _bridge(loop):
+    """Create a future and a callback(error, result) that resolves it."""
+    future = loop.create_future()
+    thread = threading.get_ident()
+
+    def callback(error, result):
+        if threading.get_ident() == thread:
+            _resolve(future, error, result)
+        else:
+            loop.call_soon_threadsafe(_resolve, future, error, result)
+    return future, callback
+
+
+class AsyncLog(object):
+    """Awaitable view of a dbeelog.Base."""
+
+    def __init__(self, log, loop=None):
+        """Constructor
+
+        Args:
+            log: dbeelog.Base to wrap.
+            loop: event loop to resolve futures on. Defaults to the loop
+                  running at each call.
+        """
+        self._log = log
+        self._loop = loop
+        self._subscription = None
+
+    @property
+    def log(self):
+        return self._log
+
+    def close(self):
+        """Stop the subscription, if any, and close the wrapped log."""
+        if self._subscription is not None:
+            self._subscription.close()
+            self._subscription = None
+        close = getattr(self._log, "close", None)
+        if close is not None:
+            close()
+
+    def append(self, transaction):
+        """Append a transaction. See dbeelog.Base.append().
+
+        Returns:
+            Future of the transaction ID.
+        """
+        future, callback = _bridge(self._get_loop())
+        self._log.append(transaction, callback)
+        return future
+
+    def append_many(self, transactions):
+        """Append transactions. See dbeelog.Base.append_many().
+
+        Returns:
+            Future of the list of transaction IDs.
+        """
+        future, callback = _bridge(self._get_loop())
+        self._log.append_many(transactions, callback)
+        return future
+
+    def checkpoint(self, transaction_id):
+        """Checkpoint the log. See dbeelog.Base.checkpoint().
+
+        Returns:
+            Future of the checkpointed transaction ID.
+        """
+        future, callback = _bridge(self._get_loop())
+        self._log.checkpoint(transaction_id, callback)
+        return future
+
+    def get_checkpoints(self):
+        """Get the checkpoints. See dbeelog.Base.get_checkpoints().
+
+        Returns:
+            Future of the map from client_id to transaction ID.
+        """
+        future, callback = _bridge(self._get_loop())
+        self._log.get_checkpoints(callback)
+        return future
+
+    def subscribe(self, from_transaction_id, maxsize=DEFAULT_MAXSIZE):
+        """Subscribe to the log. See dbeelog.Base.subscribe().
+
+        As with dbeelog.Base, only the last subscription is valid; the
+        previous one, if any, is closed.
+
+        Args:
+            from_transaction_id: see dbeelog.Base.subscribe().
+            maxsize: number of entries to buffer before the log's delivery
+                     thread blocks waiting for the consumer.
+
+        Returns:
+            Subscription, an asynchronous iterator of (transaction_id,
+            client_id, transaction).
+
+        Raises:
+            See dbeelog.Base.subscribe().
+        """
+        if self._subscription is not None:
+            self._subscription.close()
+        subscription = Subscription(self._get_loop(), maxsize)
+        self._subscription = subscription
+        self._log.subscribe(from_transaction_id, subscription._receive)
+        return subscription
+
+    def _get_loop(self):
+        return self._loop or _get_running_loop()
+
+
+class Subscription(object):
+    """Asynchronous iterator over the entries of a dbeelog subscription.
+
+    Iteration raises the error that ended the subscription, and stops after
+    close().
+    """
+
+    def __init__(self, loop, maxsize):
+        self._loop = loop
+        self._maxsize = maxsize
+        self._cond = threading.Condition()
+        self._entries = collections.deque()
+        self._error = None
+        self._closed = False
+        self._wakeup_pending = False
+        # Future returned by __anext__() while the buffer was empty. Only
+        # touched from the loop thread.
+        self._waiter = None
+
+    def close(self):
+        """Stop iterating and unblock the log's delivery thread."""
+        with self._cond:
+            self._closed = True
+            self._entries.clear()
+            self._cond.notify_all()
+        if self._waiter is not None:
+            self._fill(self._waiter)
+            self._waiter = None
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        future = self._loop.create_future()
+        if not self._fill(future):
+            self._waiter = future
+        return future
+
+    def _fill(self, future):
+        """Resolve future with the next entry, if there is one yet."""
+        if future.done():
+            # Cancelled by the consumer. Keep the entry for the next call.
+            return True
+        with self._cond:
+            if self._closed:
+                error = StopAsyncIteration()
+            elif self._entries:
+                entry = self._entries.popleft()
+                self._cond.notify()
+                _resolve(future, None, entry)
+                return True
+            elif self._error is not None:
+                error = self._error
+            else:
+                return False
+        _resolve(future, error, None)
+        return True
+
+    def _receive(self, error, transaction_id, client_id, transaction):
+        with self._cond:
+            while (len(self._entries) >= self._maxsize and
+                   not self._closed):
+                self._cond.wait()
+            if self._closed:
+                return
+            if error is not None:
+                self._error = error
+            else:
+                self._entries.append((transaction_id, client_id,
+                                      transaction))
+            if self._wakeup_pending:
+                return
+            self._wakeup_pending = True
+        self._loop.call_soon_threadsafe(self._wakeup)
+
+    def _wakeup(self):
+        with self._cond:
+            self._wakeup_pending = False
+        if self._waiter is not None and self._fill(self._waiter):
+            self._waiter = None
+
+
+class AsyncDbee(object):
+    """Awaitable view of the asynchronous part of a dbee.Base."""
+
+    def __init__(self, dbee, loop=None):
+        """Constructor
+
+        Args:
+            dbee: dbee.Base to wrap.
+            loop: see AsyncLog.
+        """
+        self._dbee = dbee
+        self._loop = loop
+
+    @property
+    def dbee(self):
+        return self._dbee
+
+    def snapshot(self, filename):
+        """Take a snapshot. See dbee.Base.snapshot().
+
+        Returns:
+            Future of the snapshot filename.
+        """
+        future, callback = _bridge(self._loop or _get_running_loop())
+        self._dbee.snapshot(filename, callback)
+        return future
@@ -14,19 +14,28 @@
 
 
 import abc
+import time
+
+from .. import metrics
+from ..error import ClientError
 
 
 class Base(object):
     """Abstract base class for dbeekeeper local storage, or 'dbee'.
 
-    A dbee instance must be accessed from a single thread.
+    A dbee instance must be accessed from a single thread, except that a
+    dbee that implements key_set() must accept concurrent execute_batch()
+    calls for batches of transactions whose key sets don't conflict (see
+    dbeekeeper.parallel).
 
     Dbee transactions must be idempotent. Much like ZooKeeper snapshots, dbee
     snapshots are 'fuzzy', meaning that transactions that were executed during
     snapshotting may or may not be included in the snapshot. During recovery,
     dbeekeeper executes all the transactions since the beginning of the
     snapshot it's recoverying from in the same order they were applied
-    originally.
+    originally, in batches passed to execute_batch(). Transactions up to the
+    watermark recorded with the snapshot (see dbeekeeper.recovery) are known
+    to be included and are not executed again.
     """
 
     __metaclass__ = abc.ABCMeta
@@ -39,7 +48,9 @@ class Base(object):
         The caller must maintain a transaction log until it takes a snapshot.
 
         Args:
-            transaction: transaction to execute in string.
+            transaction: transaction to execute in string, or a frame
+                         built with dbeekeeper.framing in bytes or
+                         memoryview, as received from the dbeelog.
 
         Returns:
             None
@@ -55,6 +66,61 @@ class Base(object):
                 to the client.
         """
 
+    def execute_batch(self, transactions):
+        """Execute a list of transactions in order.
+
+        The default implementation calls execute() once for each
+        transaction. Classes that inherit from this class should override
+        this method if the underlying storage can apply several transactions
+        at a lower cost, for example in a single storage transaction.
+
+        Like execute(), this method is *not* responsible for persisting
+        transactions to disk.
+
+        Args:
+            transactions: list of transactions to execute. See execute().
+
+        Returns:
+            List with one entry for each transaction: None if it succeeded, or
+            the dbeekeeper.ClientError it failed with.
+
+        Raises:
+            dbeekeeper.DbeeError:
+                See execute(). Transactions before the failing one may or may
+                not have been executed.
+        """
+        timed = metrics.registry.enabled
+        errors = []
+        for transaction in transactions:
+            if timed:
+                start = time.time()
+            try:
+                self.execute(transaction)
+            except ClientError as e:
+                errors.append(e)
+            else:
+                errors.append(None)
+            if timed:
+                metrics.observe("dbee.execute.duration", time.time() - start)
+        return errors
+
+    def key_set(self, transaction):
+        """Declare the keys a transaction reads and writes.
+
+        Transactions that neither write a key the other reads or writes may
+        be executed concurrently and in any order. The default
+        implementation returns None, which orders the transaction after
+        every transaction before it and before every transaction after it.
+
+        Args:
+            transaction: see execute().
+
+        Returns:
+            (read keys, written keys), two iterables of hashable keys, or
+            None if the keys are unknown.
+        """
+        return None
+
     @abc.abstractmethod
     def snapshot(self, filename, callback):
         """Take a snapshot of this dbee asynchronously.
@@ -0,0 +1,468 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""In-memory key/value dbee with non-blocking snapshots.
+
+Transactions are JSON arrays built with put() and delete():
+
+    ["put", key, value]
+    ["delete", key]
+
+Both are idempotent, as dbee.Base requires. A transaction may also be sent
+as the payload of a dbeekeeper.framing frame, which execute() reads without
+checking its CRC again; the dbeelog has already verified it. Each
+transaction writes a single key, which key_set() declares, so transactions
+on different keys can be executed concurrently.
+
+snapshot() implements option (b) of dbee.Base.snapshot(): it forks the
+process, and the child writes the state it inherited to the snapshot file
+while the parent keeps executing transactions. The operating system shares
+the memory pages between the two processes copy-on-write, so taking a
+snapshot costs the parent a fork() no matter how large the state is. On
+platforms without fork(), the parent copies the dict and a thread writes the
+copy instead. Full snapshots use the chunked format of dbee.snapshot, which
+restore() decodes one chunk at a time, optionally with worker processes.
+
+In incremental mode, a snapshot only writes the keys that changed since the
+previous snapshot to a delta file, and the snapshot file itself is a small
+manifest that chains the deltas back to a full base:
+
+    {"base": "<filename>.base", "deltas": ["<filename>.delta<n>", ...]}
+
+restore() applies the deltas to the base in order. Once a chain grows to
+max_deltas deltas, a background thread folds the chain into a new base with
+a name of its own, "<filename>.base-<suffix>", and rewrites the latest
+manifest to refer to it unless a snapshot has written a manifest since.
+Earlier manifests keep referring to the files they were written with; use
+snapshot_files() to find the files a snapshot needs before deleting any of
+them.
+"""
+
+import functools
+import io
+import json
+import logging
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from . import base
+from . import snapshot
+from .. import framing
+from .. import metrics
+from ..error import ClientError
+from ..error import DbeeError
+from ..error import DbeeLogError
+
+
+_log = logging.getLogger(__name__)
+
+_TEXT_TYPE = type(u"")
+
+_DELTA_MAGIC = b"DBEEDEL1"
+
+# Delta record header: key length, value length or -1 for a deleted key.
+_DELTA_RECORD = struct.Struct(">Ii")
+
+DEFAULT_MAX_DELTAS = 8
+
+
+def put(key, value):
+    """Build a transaction that sets key to value."""
+    return json.dumps(["put", key, value])
+
+
+def delete(key):
+    """Build a transaction that deletes key if it exists."""
+    return json.dumps(["delete", key])
+
+
+def _parse(transaction):
+    try:
+        if framing.is_frame(transaction):
+            payload = framing.decode(transaction, verify=False)[1]
+            transaction = payload.tobytes().decode("utf-8")
+        op = json.loads(transaction)
+    except (TypeError, ValueError, DbeeLogError):
+        raise ClientError("malformed transaction: %r" % (transaction,))
+    if (isinstance(op, list) and
+            (len(op) == 3 and op[0] == "put" or
+             len(op) == 2 and op[0] == "delete") and
+            all(isinstance(arg, _TEXT_TYPE) for arg in op[1:])):
+        return op
+    raise ClientError("malformed transaction: %r" % (transaction,))
+
+
+def _dump_delta(items, filename):
+    """Write (key, value) pairs to filename. None values are deletions."""
+    with io.open(filename, "wb") as f:
+        f.write(_DELTA_MAGIC)
+        for key, value in items:
+            key = key.encode("utf-8")
+            if value is None:
+                f.write(_DELTA_RECORD.pack(len(key), -1))
+                f.write(key)
+                continue
+            value = value.encode("utf-8")
+            f.write(_DELTA_RECORD.pack(len(key), len(value)))
+            f.write(key)
+            f.write(value)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _load_delta(filename, data):
+    """Apply a delta written by _dump_delta() to data."""
+    with io.open(filename, "rb") as f:
+        if f.read(len(_DELTA_MAGIC)) != _DELTA_MAGIC:
+            raise DbeeError("%s is not a snapshot delta" % filename)
+        while True:
+            header = f.read(_DELTA_RECORD.size)
+            if not header:
+                return
+            if len(header) < _DELTA_RECORD.size:
+                raise DbeeError("%s is truncated" % filename)
+            key_len, value_len = _DELTA_RECORD.unpack(header)
+            body = f.read(key_len + max(value_len, 0))
+            if len(body) < key_len + max(value_len, 0):
+                raise DbeeError("%s is truncated" % filename)
+            key = body[:key_len].decode("utf-8")
+            if value_len < 0:
+                data.pop(key, None)
+            else:
+                data[key] = body[key_len:].decode("utf-8")
+
+
+def _write_manifest(filename, base, deltas):
+    """Write a manifest for filename to a temporary file next to it.
+
+    Returns:
+        The name of the temporary file, to be renamed to filename.
+    """
+    directory = os.path.dirname(filename) or "."
+    manifest = {"base": os.path.relpath(base, directory),
+                "deltas": [os.path.relpath(d, directory) for d in deltas]}
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp",
+                               prefix=os.path.basename(filename) + ".")
+    try:
+        with io.open(fd, "wb") as f:
+            f.write(json.dumps(manifest).encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+    except EnvironmentError:
+        os.remove(tmp)
+        raise
+    return tmp
+
+
+def _read_manifest(filename):
+    """Read a snapshot manifest.
+
+    Returns:
+        (base, deltas), or None if filename is a full snapshot.
+    """
+    if snapshot.is_snapshot(filename):
+        return None
+    with io.open(filename, "rb") as f:
+        data = f.read()
+    try:
+        manifest = json.loads(data.decode("utf-8"))
+        directory = os.path.dirname(filename)
+        return (os.path.join(directory, manifest["base"]),
+                [os.path.join(directory, d) for d in manifest["deltas"]])
+    except (ValueError, KeyError, TypeError):
+        raise DbeeError("%s is not a snapshot" % filename)
+
+
+def snapshot_files(filename):
+    """Return the list of files the snapshot in filename consists of.
+
+    Raises:
+        dbeekeeper.DbeeError: filename is not a snapshot.
+        EnvironmentError: failed to read filename.
+    """
+    chain = _read_manifest(filename)
+    if chain is None:
+        return [filename]
+    return [filename, chain[0]] + chain[1]
+
+
+class MemoryDbee(base.Base):
+    """Key/value dbee that keeps its state in a dict."""
+
+    def __init__(self, use_fork=hasattr(os, "fork"), incremental=False,
+                 max_deltas=DEFAULT_MAX_DELTAS, restore_processes=1):
+        """Constructor
+
+        Args:
+            use_fork: take snapshots in a forked child process. Otherwise
+                      snapshot() copies the state and writes it from a
+                      thread.
+            incremental: write incremental snapshots.
+            max_deltas: in incremental mode, number of deltas after which
+                        the chain is folded into a new base.
+            restore_processes: number of processes to check and decompress
+                               large snapshot chunks with in restore().
+        """
+        self._data = {}
+        self._use_fork = use_fork
+        self._incremental = incremental
+        self._max_deltas = max_deltas
+        self._restore_processes = restore_processes
+        self._lock = threading.Lock()
+        self._snapshotting = False
+        # Keys changed since the last snapshot, and the (base, deltas) chain
+        # of the last snapshot, in incremental mode. Manifests are renamed
+        # into place with the lock held, so that the chain always matches
+        # the latest manifest.
+        self._dirty = set()
+        self._chain = None
+        self._merging = False
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Return the value of key, or default if it doesn't exist."""
+        return self._data.get(key, default)
+
+    def key_set(self, transaction):
+        try:
+            return (), (_parse(transaction)[1],)
+        except ClientError:
+            return None
+
+    def execute(self, transaction):
+        op = _parse(transaction)
+        if op[0] == "put":
+            self._data[op[1]] = op[2]
+        else:
+            self._data.pop(op[1], None)
+        if self._incremental:
+            with self._lock:
+                self._dirty.add(op[1])
+
+    def snapshot(self, filename, callback):
+        start = time.time()
+        with self._lock:
+            if self._snapshotting:
+                error = ClientError("another snapshot is in progress")
+            else:
+                error = None
+                self._snapshotting = True
+            chain = self._chain
+            dirty, self._dirty = self._dirty, set()
+        if error is not None:
+            callback(error, None)
+            return
+
+        if not self._incremental:
+            def write(items):
+                snapshot.write(filename, items)
+            view = self._data.items
+            written = [filename]
+        elif chain is None:
+            chain = (filename + ".base", [])
+            written = [chain[0], filename]
+
+            def write(items):
+                snapshot.write(chain[0], items)
+            view = self._data.items
+        else:
+            delta = "%s.delta%d" % (filename, len(chain[1]))
+            chain = (chain[0], chain[1] + [delta])
+            written = [delta, filename]
+
+            def write(items):
+                _dump_delta(items, chain[1][-1])
+
+            def view():
+                return [(k, self._data.get(k)) for k in dirty]
+
+        try:
+            if self._use_fork:
+                waiter = self._fork(write, view)
+            else:
+                waiter = functools.partial(self._write, write, list(view()))
+        except Exception as e:
+            self._failed(callback, dirty, e)
+            return
+
+        def run():
+            error = waiter()
+            if error is not None:
+                self._failed(callback, dirty, error)
+                return
+            if self._incremental:
+                try:
+                    tmp = _write_manifest(filename, *chain)
+                    with self._lock:
+                        os.rename(tmp, filename)
+                        self._chain = chain
+                        merge = (len(chain[1]) >= self._max_deltas and
+                                 not self._merging)
+                        self._merging = self._merging or merge
+                except EnvironmentError as e:
+                    self._failed(callback, dirty, e)
+                    return
+                if merge:
+                    self._merge(filename, chain)
+            if metrics.registry.enabled:
+                metrics.observe("dbee.snapshot.duration", time.time() - start)
+                metrics.observe("dbee.snapshot.bytes",
+                                sum(os.path.getsize(f) for f in written))
+            self._finish(callback, None, filename)
+        thread = threading.Thread(target=run, name="dbee-snapshot")
+        thread.daemon = True
+        thread.start()
+
+    def restore(self, filename):
+        with self._lock:
+            if self._snapshotting:
+                raise ClientError("snapshot is in progress")
+        try:
+            chain = _read_manifest(filename)
+            if chain is None:
+                data = self._load(filename)
+            else:
+                data = self._load(chain[0])
+                for delta in chain[1]:
+                    _load_delta(delta, data)
+        except EnvironmentError as e:
+            raise DbeeError("failed to restore %s: %s" % (filename, e))
+        except ValueError as e:
+            raise DbeeError("%s is corrupted: %s" % (filename, e))
+        self._data = data
+        with self._lock:
+            self._dirty = set()
+            self._chain = chain
+
+    def _load(self, filename):
+        data = {}
+        for records in snapshot.read(filename, self._restore_processes):
+            data.update(records)
+        return data
+
+    def _failed(self, callback, dirty, error):
+        # The changes didn't make it into a delta, so they have to be in the
+        # next one.
+        with self._lock:
+            self._dirty.update(dirty)
+        self._finish(callback, DbeeError("snapshot failed: %s" % error),
+                     None)
+
+    def _finish(self, callback, error, filename):
+        with self._lock:
+            self._snapshotting = False
+        callback(error, filename)
+
+    def _write(self, write, items):
+        try:
+            write(items)
+        except EnvironmentError as e:
+            return str(e)
+        return None
+
+    def _merge(self, filename, chain):
+        """Fold chain into a new base in a background thread.
+
+        The manifest in filename, which refers to chain, is rewritten to
+        refer to the new base, unless a snapshot has written a manifest
+        since. Either way, the next snapshot chains from the new base.
+        """
+        def run():
+            base = tmp = None
+            try:
+                data = self._load(chain[0])
+                for delta in chain[1]:
+                    _load_delta(delta, data)
+                fd, base = tempfile.mkstemp(
+                    dir=os.path.dirname(filename) or ".",
+                    prefix=os.path.basename(filename) + ".base-")
+                os.close(fd)
+                snapshot.write(base, data.items())
+                tmp = _write_manifest(filename, base, [])
+                with self._lock:
+                    self._merging = False
+                    if self._chain == chain:
+                        os.rename(tmp, filename)
+                        tmp = None
+                    # Snapshots taken during the merge extended the chain.
+                    # Their deltas apply on top of the new base just as
+                    # well.
+                    if (self._chain is not None and
+                            self._chain[0] == chain[0] and
+                            self._chain[1][:len(chain[1])] == chain[1]):
+                        self._chain = (base,
+                                       self._chain[1][len(chain[1]):])
+                        base = None
+            except (EnvironmentError, ValueError, DbeeError):
+                _log.exception("failed to merge snapshot %s", filename)
+                with self._lock:
+                    self._merging = False
+            # Remove whatever no manifest refers to.
+            for path in (tmp, base):
+                if path is not None:
+                    try:
+                        os.remove(path)
+                    except EnvironmentError:
+                        pass
+        thread = threading.Thread(target=run, name="dbee-snapshot-merge")
+        thread.daemon = True
+        thread.start()
+
+    def _fork(self, write, view):
+        """Fork a child that calls write(view()).
+
+        Returns:
+            Function that waits for the child to exit and returns None if it
+            succeeded, or an error message otherwise.
+        """
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # Child: only write the snapshot, and never return into the
+            # caller's code.
+            status = 1
+            try:
+                os.close(r)
+                try:
+                    write(view())
+                    status = 0
+                except BaseException as e:
+                    os.write(w, str(e).encode("utf-8", "replace"))
+            finally:
+                os._exit(status)
+
+        os.close(w)
+
+        def wait():
+            try:
+                message = b""
+                while True:
+                    chunk = os.read(r, 4096)
+                    if not chunk:
+                        break
+                    message += chunk
+            finally:
+                os.close(r)
+            _, status = os.waitpid(pid, 0)
+            if status == 0:
+                return None
+            return (message.decode("utf-8", "replace") or
+                    "snapshot process exited with status %d" % status)
+        return wait
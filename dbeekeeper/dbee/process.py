@@ -0,0 +1,404 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Host a dbee in a worker process.
+
+A dbee must be driven from a single thread, and under the GIL a dbee that
+spends its time in Python code starves every other thread of the process,
+including the dbeelog subscriptions and callbacks. ProcessDbee is a
+dbee.Base that runs the real dbee in a dedicated worker process instead,
+where its execute() calls and snapshot() serialization use a core of their
+own.
+
+Transactions travel to the worker through a ring buffer in shared memory,
+and results come back through a second one. Each record in a ring is a
+length-prefixed byte string, so neither transactions nor their ClientError
+and DbeeError results are pickled. Only snapshot() results, which the worker
+reports from whichever thread its dbee calls back on, come back through a
+pipe.
+
+Requests, from the caller to the worker:
+
+    B count, then count transaction records   execute a batch
+    L filename                                 restore
+    S id, filename                             snapshot
+    Q                                          stop the worker
+
+A transaction record is "t" followed by UTF-8 text, or "b" followed by
+bytes. A batch result is "R" followed by one entry per transaction, "\\0"
+for success or "C" and a message for a ClientError, or "D" and a message if
+the batch failed with a DbeeError.
+"""
+
+import ctypes
+import functools
+import logging
+import multiprocessing
+import struct
+import threading
+
+from . import base
+from ..error import ClientError
+from ..error import DbeeError
+
+
+_log = logging.getLogger(__name__)
+
+_TEXT_TYPE = type(u"")
+
+DEFAULT_RING_SIZE = 4 * 1024 * 1024
+
+# Record length prefix in a ring.
+_LENGTH = struct.Struct(">I")
+
+# Number of transactions in a batch request, or the ID of a snapshot.
+_COUNT = struct.Struct(">I")
+
+# Error messages are truncated so that the results of a batch are bounded.
+_MAX_MESSAGE = 256
+
+# Seconds between checks that the worker is still alive.
+_POLL_INTERVAL = 1.0
+
+
+class Ring(object):
+    """Single-producer, single-consumer ring of byte strings in shared
+    memory."""
+
+    def __init__(self, size):
+        self._size = size
+        self._buffer = multiprocessing.RawArray(ctypes.c_char, size)
+        # Total number of bytes read from and written to the ring.
+        self._positions = multiprocessing.RawArray(ctypes.c_uint64, 2)
+        self._cond = multiprocessing.Condition()
+
+    @property
+    def max_record_size(self):
+        return self._size - _LENGTH.size
+
+    def put(self, data, timeout=None):
+        """Append data to the ring, waiting for space if it's full.
+
+        The wait ends when the consumer removes a record, even if that
+        doesn't free enough space, so callers retry in a loop.
+
+        Returns:
+            True if data was appended, False on timeout.
+        """
+        record = _LENGTH.pack(len(data)) + data
+        if len(record) > self._size:
+            raise ClientError("record of %d bytes does not fit in the ring" %
+                              len(data))
+        with self._cond:
+            head, tail = self._positions
+            if self._size - (tail - head) < len(record):
+                self._cond.wait(timeout)
+                head, tail = self._positions
+                if self._size - (tail - head) < len(record):
+                    return False
+            self._copy_in(tail, record)
+            self._positions[1] = tail + len(record)
+            self._cond.notify_all()
+            return True
+
+    def get(self, timeout=None):
+        """Remove and return the oldest record, or None on timeout.
+
+        Like put(), this may return early when the other side notifies.
+        """
+        with self._cond:
+            head, tail = self._positions
+            if head == tail:
+                self._cond.wait(timeout)
+                head, tail = self._positions
+                if head == tail:
+                    return None
+            length = _LENGTH.unpack(self._copy_out(head, _LENGTH.size))[0]
+            data = self._copy_out(head + _LENGTH.size, length)
+            self._positions[0] = head + _LENGTH.size + length
+            self._cond.notify_all()
+            return data
+
+    def _copy_in(self, position, data):
+        start = position % self._size
+        first = min(len(data), self._size - start)
+        self._buffer[start:start + first] = data[:first]
+        if first < len(data):
+            self._buffer[0:len(data) - first] = data[first:]
+
+    def _copy_out(self, position, length):
+        start = position % self._size
+        first = min(length, self._size - start)
+        data = self._buffer[start:start + first]
+        if first < length:
+            data += self._buffer[0:length - first]
+        return data
+
+
+def _encode_transaction(transaction):
+    if isinstance(transaction, _TEXT_TYPE):
+        return b"t" + transaction.encode("utf-8")
+    if isinstance(transaction, memoryview):
+        return b"b" + transaction.tobytes()
+    return b"b" + bytes(transaction)
+
+
+def _decode_transaction(data):
+    if data[:1] == b"t":
+        return data[1:].decode("utf-8")
+    return data[1:]
+
+
+def _encode_error(error):
+    code = b"C" if isinstance(error, ClientError) else b"D"
+    message = str(error).encode("utf-8", "replace")[:_MAX_MESSAGE]
+    return code + _LENGTH.pack(len(message)) + message
+
+
+def _decode_error(code, message):
+    message = message.decode("utf-8", "replace")
+    if code == b"C":
+        return ClientError(message)
+    return DbeeError(message)
+
+
+def _put(ring, data):
+    while not ring.put(data):
+        pass
+
+
+def _serve(factory, requests, responses, conn):
+    """Main loop of the worker process."""
+    try:
+        dbee = factory()
+    except Exception as e:
+        _put(responses, _encode_error(DbeeError(
+            "failed to create the dbee: %s" % e)))
+        return
+    _put(responses, b"O")
+    conn_lock = threading.Lock()
+
+    def snapshot_done(snapshot_id, error, filename):
+        if error is not None:
+            error = _encode_error(error)
+        with conn_lock:
+            conn.send((snapshot_id, error, filename))
+
+    while True:
+        request = requests.get()
+        if request is None:
+            continue
+        op = request[:1]
+        if op == b"B":
+            count = _COUNT.unpack(request[1:])[0]
+            transactions = []
+            while len(transactions) < count:
+                record = requests.get()
+                if record is not None:
+                    transactions.append(_decode_transaction(record))
+            try:
+                results = dbee.execute_batch(transactions)
+            except Exception as e:
+                if not isinstance(e, DbeeError):
+                    _log.exception("dbee failed")
+                _put(responses, b"D" + _encode_error(e)[1:])
+                continue
+            _put(responses, b"R" + b"".join(
+                b"\0" if r is None else _encode_error(r) for r in results))
+        elif op == b"L":
+            try:
+                dbee.restore(request[1:].decode("utf-8"))
+            except Exception as e:
+                _put(responses, _encode_error(e))
+            else:
+                _put(responses, b"O")
+        elif op == b"S":
+            snapshot_id = _COUNT.unpack(request[1:1 + _COUNT.size])[0]
+            filename = request[1 + _COUNT.size:].decode("utf-8")
+            dbee.snapshot(filename, functools.partial(snapshot_done,
+                                                      snapshot_id))
+        elif op == b"Q":
+            close = getattr(dbee, "close", None)
+            if close is not None:
+                close()
+            return
+
+
+class ProcessDbee(base.Base):
+    """dbee.Base that forwards to a dbee hosted in a worker process."""
+
+    def __init__(self, factory, ring_size=DEFAULT_RING_SIZE):
+        """Constructor
+
+        Args:
+            factory: function that creates the dbee.Base to host. It is
+                     called in the worker process, so it must be picklable
+                     on platforms that don't fork.
+            ring_size: size in bytes of each of the two ring buffers.
+
+        Raises:
+            dbeekeeper.DbeeError: the worker failed to create the dbee.
+        """
+        self._requests = Ring(ring_size)
+        self._responses = Ring(ring_size)
+        # Each entry of a batch result takes at most this many bytes.
+        self._max_batch = max(1, (ring_size - 1) //
+                              (1 + _LENGTH.size + _MAX_MESSAGE) - 1)
+        self._conn, child_conn = multiprocessing.Pipe(False)
+        self._process = multiprocessing.Process(
+            target=_serve, name="dbee-host",
+            args=(factory, self._requests, self._responses, child_conn))
+        self._process.daemon = True
+        self._process.start()
+        child_conn.close()
+        self._lock = threading.Lock()
+        self._snapshots = {}
+        self._next_snapshot_id = 0
+        self._reader = threading.Thread(target=self._read_snapshots,
+                                        name="dbee-host-snapshots")
+        self._reader.daemon = True
+        self._reader.start()
+        response = self._response()
+        if response[:1] != b"O":
+            self.close()
+            raise _decode_error(response[:1], response[1 + _LENGTH.size:])
+
+    @property
+    def pid(self):
+        return self._process.pid
+
+    def close(self):
+        """Stop the worker process and wait for it to exit."""
+        if self._process.is_alive():
+            try:
+                self._put(b"Q")
+            except DbeeError:
+                pass
+        self._process.join()
+        self._reader.join()
+
+    def execute(self, transaction):
+        error = self.execute_batch([transaction])[0]
+        if error is not None:
+            raise error
+
+    def execute_batch(self, transactions):
+        """Execute transactions in the worker process.
+
+        Large batches are sent in parts small enough for their results to
+        fit in the ring.
+        """
+        errors = []
+        transactions = list(transactions)
+        for i in range(0, len(transactions), self._max_batch):
+            errors += self._execute_batch(transactions[i:i + self._max_batch])
+        return errors
+
+    def snapshot(self, filename, callback):
+        with self._lock:
+            if not self._process.is_alive():
+                error = DbeeError("dbee process exited")
+            else:
+                error = None
+                snapshot_id = self._next_snapshot_id
+                self._next_snapshot_id += 1
+                self._snapshots[snapshot_id] = callback
+        if error is not None:
+            callback(error, None)
+            return
+        try:
+            self._put(b"S" + _COUNT.pack(snapshot_id) +
+                      filename.encode("utf-8"))
+        except DbeeError:
+            # The reader thread fails the callback once the pipe closes.
+            pass
+
+    def restore(self, filename):
+        self._put(b"L" + filename.encode("utf-8"))
+        response = self._response()
+        if response[:1] != b"O":
+            raise _decode_error(response[:1], response[1 + _LENGTH.size:])
+
+    def _execute_batch(self, transactions):
+        records = []
+        errors = [None] * len(transactions)
+        for i, transaction in enumerate(transactions):
+            record = _encode_transaction(transaction)
+            if len(record) > self._requests.max_record_size:
+                errors[i] = ClientError("transaction of %d bytes is too large"
+                                        % len(record))
+            else:
+                records.append((i, record))
+        if not records:
+            return errors
+        self._put(b"B" + _COUNT.pack(len(records)))
+        for _, record in records:
+            self._put(record)
+        response = self._response()
+        if response[:1] == b"D":
+            raise _decode_error(b"D", response[1 + _LENGTH.size:])
+        pos = 1
+        for i, _ in records:
+            code = response[pos:pos + 1]
+            pos += 1
+            if code == b"\0":
+                continue
+            length = _LENGTH.unpack(response[pos:pos + _LENGTH.size])[0]
+            pos += _LENGTH.size
+            errors[i] = _decode_error(code, response[pos:pos + length])
+            pos += length
+        return errors
+
+    def _put(self, data):
+        while not self._requests.put(data, _POLL_INTERVAL):
+            self._check_alive()
+
+    def _response(self):
+        while True:
+            response = self._responses.get(_POLL_INTERVAL)
+            if response is not None:
+                return response
+            self._check_alive()
+
+    def _check_alive(self):
+        if not self._process.is_alive():
+            raise DbeeError("dbee process exited with status %s" %
+                            self._process.exitcode)
+
+    def _read_snapshots(self):
+        while True:
+            try:
+                snapshot_id, error, filename = self._conn.recv()
+            except (EOFError, IOError):
+                break
+            with self._lock:
+                callback = self._snapshots.pop(snapshot_id, None)
+            if callback is None:
+                continue
+            if error is not None:
+                error = _decode_error(error[:1], error[1 + _LENGTH.size:])
+            try:
+                callback(error, filename)
+            except Exception:
+                _log.exception("snapshot callback raised an exception")
+        with self._lock:
+            callbacks = list(self._snapshots.values())
+            self._snapshots.clear()
+        for callback in callbacks:
+            try:
+                callback(DbeeError("dbee process exited"), None)
+            except Exception:
+                _log.exception("snapshot callback raised an exception")
+        self._conn.close()
@@ -0,0 +1,256 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Chunked snapshot file format with streaming, parallel decode.
+
+A snapshot file holds key/value records grouped into independent chunks,
+followed by an index of the chunks:
+
+    magic
+    chunk 1, chunk 2, ...        records, optionally zlib-compressed
+    index                        offset, length, crc32, flags of each chunk
+    footer                       index offset, number of chunks, magic
+
+write() produces such a file from an iterable of (key, value) pairs. read()
+memory-maps it and generates the records one chunk at a time, so that a
+dbee can apply a chunk and drop it before the next one is decoded.
+
+With more than one process, a pool of worker processes checks the CRCs of
+large chunks and decompresses them, memory-mapping the file themselves, and
+only a bounded window of chunks is outstanding at a time. The records are
+always built in the calling process: sending them back pickled would cost
+about as much as building them, while raw chunk bytes are cheap to send.
+Small chunks are not worth the round trip and are decoded in place. Run
+"benchmark/harness.py dbee" to measure restore().
+
+dbee.Base implementations can use this module to implement snapshot() and
+restore().
+"""
+
+import collections
+import io
+import mmap
+import multiprocessing
+import os
+import struct
+import zlib
+
+from ..error import DbeeError
+
+
+MAGIC = b"DBEESNP1"
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Record header: key length, value length.
+_RECORD = struct.Struct(">II")
+
+# Index entry: offset, length, crc32 of the stored bytes, flags.
+_INDEX = struct.Struct(">QIIB")
+
+# Footer: index offset, number of chunks, magic.
+_FOOTER = struct.Struct(">QI%ds" % len(MAGIC))
+
+_COMPRESSED = 0x1
+
+# Chunks stored in fewer bytes are decoded in the calling process even when
+# read() has worker processes.
+_MIN_PARALLEL_LENGTH = 256 * 1024
+
+
+def _to_bytes(s):
+    if isinstance(s, bytes):
+        return s
+    return s.encode("utf-8")
+
+
+def _to_str(b):
+    if str is bytes:
+        return b
+    return b.decode("utf-8")
+
+
+def is_snapshot(filename):
+    """Return True if filename starts like a snapshot written by write()."""
+    with io.open(filename, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def write(filename, items, chunk_size=DEFAULT_CHUNK_SIZE, compress=False):
+    """Write (key, value) pairs to a snapshot file atomically.
+
+    Args:
+        filename: snapshot file to write.
+        items: iterable of (key, value) pairs of strings.
+        chunk_size: approximate number of bytes of records in each chunk.
+        compress: compress each chunk with zlib.
+
+    Raises:
+        EnvironmentError: failed to write the file.
+    """
+    tmp = filename + ".tmp"
+    index = []
+    with io.open(tmp, "wb") as f:
+        f.write(MAGIC)
+        offset = len(MAGIC)
+
+        def flush(records):
+            data = b"".join(records)
+            flags = 0
+            if compress:
+                data = zlib.compress(data)
+                flags |= _COMPRESSED
+            f.write(data)
+            index.append((offset, len(data), zlib.crc32(data) & 0xffffffff,
+                          flags))
+            return offset + len(data)
+
+        records = []
+        size = 0
+        for key, value in items:
+            key = _to_bytes(key)
+            value = _to_bytes(value)
+            records.append(_RECORD.pack(len(key), len(value)))
+            records.append(key)
+            records.append(value)
+            size += _RECORD.size + len(key) + len(value)
+            if size >= chunk_size:
+                offset = flush(records)
+                records = []
+                size = 0
+        if records:
+            offset = flush(records)
+
+        for entry in index:
+            f.write(_INDEX.pack(*entry))
+        f.write(_FOOTER.pack(offset, len(index), MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, filename)
+
+
+def read(filename, processes=1):
+    """Generate the records of a snapshot file, one chunk at a time.
+
+    Args:
+        filename: snapshot file written by write().
+        processes: number of worker processes to check and decompress large
+                   chunks with. With 1, chunks are decoded in the calling
+                   process.
+
+    Yields:
+        list of (key, value) pairs in each chunk, in file order.
+
+    Raises:
+        dbeekeeper.DbeeError: the file is not a snapshot or is corrupted.
+        EnvironmentError: failed to read the file.
+    """
+    with io.open(filename, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < len(MAGIC) + _FOOTER.size:
+            raise DbeeError("%s is not a snapshot" % filename)
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        chunks = _read_index(filename, m)
+        if processes <= 1 or not any(chunk[1] >= _MIN_PARALLEL_LENGTH
+                                     for chunk in chunks):
+            for chunk in chunks:
+                yield _parse(filename, chunk[0], _inflate(filename, m, *chunk))
+            return
+        pool = multiprocessing.Pool(processes)
+        try:
+            # Keep a bounded number of chunks in flight, so that raw chunks
+            # don't pile up when the caller is slower than the pool.
+            window = collections.deque()
+            for chunk in chunks:
+                if chunk[1] >= _MIN_PARALLEL_LENGTH:
+                    data = pool.apply_async(_inflate_file, (filename,) + chunk)
+                else:
+                    data = None
+                window.append((chunk, data))
+                if len(window) >= 2 * processes:
+                    yield _collect(filename, m, *window.popleft())
+            while window:
+                yield _collect(filename, m, *window.popleft())
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        m.close()
+
+
+def _read_index(filename, m):
+    index_offset, count, magic = _FOOTER.unpack_from(m, len(m) - _FOOTER.size)
+    if m[:len(MAGIC)] != MAGIC or magic != MAGIC:
+        raise DbeeError("%s is not a snapshot" % filename)
+    if index_offset + count * _INDEX.size != len(m) - _FOOTER.size:
+        raise DbeeError("%s has a corrupted index" % filename)
+    return [_INDEX.unpack_from(m, index_offset + i * _INDEX.size)
+            for i in range(count)]
+
+
+def _collect(filename, m, chunk, result):
+    """Parse a chunk, inflated by a worker if result is not None."""
+    if result is None:
+        data = _inflate(filename, m, *chunk)
+    else:
+        data = result.get()
+    return _parse(filename, chunk[0], data)
+
+
+def _inflate_file(filename, offset, length, crc, flags):
+    """Check and decompress a chunk of a snapshot file in a worker process."""
+    with io.open(filename, "rb") as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return _inflate(filename, m, offset, length, crc, flags)
+    finally:
+        m.close()
+
+
+def _inflate(filename, m, offset, length, crc, flags):
+    """Return the records of a chunk in bytes, after checking its CRC."""
+    data = m[offset:offset + length]
+    if len(data) != length or zlib.crc32(data) & 0xffffffff != crc:
+        raise DbeeError("%s has a corrupted chunk at %d" % (filename, offset))
+    if flags & _COMPRESSED:
+        try:
+            data = zlib.decompress(data)
+        except zlib.error as e:
+            raise DbeeError("%s has a corrupted chunk at %d: %s" %
+                            (filename, offset, e))
+    return data
+
+
+def _parse(filename, offset, data):
+    """Split the records of a chunk into (key, value) pairs."""
+    records = []
+    pos = 0
+    end = len(data)
+    try:
+        while pos < end:
+            key_len, value_len = _RECORD.unpack_from(data, pos)
+            pos += _RECORD.size
+            key = data[pos:pos + key_len]
+            pos += key_len
+            value = data[pos:pos + value_len]
+            pos += value_len
+            records.append((_to_str(key), _to_str(value)))
+    except (struct.error, UnicodeDecodeError) as e:
+        raise DbeeError("%s has a corrupted chunk at %d: %s" %
+                        (filename, offset, e))
+    if pos != end:
+        raise DbeeError("%s has a corrupted chunk at %d" % (filename, offset))
+    return records
@@ -0,0 +1,306 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Key/value dbee stored in a SQLite database.
+
+SqliteDbee executes the same put() and delete() transactions as
+dbee.memory.MemoryDbee against a single table in a SQLite database in WAL
+mode. Transactions are not committed one at a time: execute() leaves them in
+an open SQLite transaction that is committed once every commit_interval
+transactions, and execute_batch() commits a whole batch at once. As
+dbee.Base allows, a crash may lose the uncommitted transactions; recovery
+executes them again from the dbeelog.
+
+snapshot() implements option (b) of dbee.Base.snapshot(). It commits the
+open transaction, and a background thread copies the database to the
+snapshot file with SQLite's online backup API through a connection of its
+own. The copy runs in a single step inside one read transaction, which WAL
+mode lets writers proceed alongside, so execute() is never blocked and the
+backup is not restarted by concurrent writes. A snapshot is itself a SQLite
+database. restore() checks it, copies it next to the database and renames
+the copy over the database, so that a crash during restore() leaves either
+the old or the new database in place.
+"""
+
+import io
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+from . import base
+from . import memory
+from .. import metrics
+from ..error import ClientError
+from ..error import DbeeError
+
+
+DEFAULT_COMMIT_INTERVAL = 1000
+
+# Seconds to wait for a lock held by another connection.
+_BUSY_TIMEOUT = 30
+
+_SCHEMA = "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT)"
+
+
+def _connect(filename):
+    # isolation_level=None leaves transactions to the explicit BEGIN and
+    # COMMIT statements below.
+    return sqlite3.connect(filename, timeout=_BUSY_TIMEOUT,
+                           isolation_level=None, check_same_thread=False)
+
+
+def _fsync(filename):
+    with io.open(filename, "rb") as f:
+        os.fsync(f.fileno())
+
+
+def _remove(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+def _backup(source, target):
+    """Copy the database of the source connection to target."""
+    if os.path.exists(target):
+        os.remove(target)
+    dest = sqlite3.connect(target)
+    try:
+        if hasattr(source, "backup"):
+            source.backup(dest)
+        else:
+            # Connection.backup() is only available on Python 3.7+. Copy
+            # the rows inside one read transaction instead.
+            dest.execute(_SCHEMA)
+            source.execute("BEGIN")
+            try:
+                dest.executemany("INSERT INTO kv VALUES (?, ?)",
+                                 source.execute("SELECT key, value FROM kv"))
+            finally:
+                source.execute("COMMIT")
+            dest.commit()
+    finally:
+        dest.close()
+    _fsync(target)
+
+
+class SqliteDbee(base.Base):
+    """Key/value dbee that keeps its state in a SQLite database."""
+
+    def __init__(self, filename, commit_interval=DEFAULT_COMMIT_INTERVAL,
+                 synchronous="NORMAL"):
+        """Constructor
+
+        Args:
+            filename: SQLite database file. It is created if it doesn't
+                      exist.
+            commit_interval: number of transactions execute() leaves
+                             uncommitted before it commits them.
+            synchronous: SQLite synchronous setting. NORMAL only syncs the
+                         WAL at checkpoints, which is enough since the
+                         dbeelog has the transactions.
+
+        Raises:
+            dbeekeeper.DbeeError: failed to open the database.
+        """
+        self._filename = filename
+        self._commit_interval = commit_interval
+        self._synchronous = synchronous
+        self._lock = threading.Lock()
+        self._snapshotting = False
+        self._pending = 0
+        # Connection.in_transaction is only available on Python 3.2+.
+        self._in_transaction = False
+        self._conn = None
+        self._open()
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM kv").fetchone()[0]
+
+    @property
+    def filename(self):
+        return self._filename
+
+    def get(self, key, default=None):
+        """Return the value of key, or default if it doesn't exist."""
+        row = self._conn.execute("SELECT value FROM kv WHERE key = ?",
+                                 (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def close(self):
+        """Commit the open transaction and close the database."""
+        if self._conn is not None:
+            self.commit()
+            self._conn.close()
+            self._conn = None
+
+    def commit(self):
+        """Commit the transactions executed so far.
+
+        Raises:
+            dbeekeeper.DbeeError: failed to commit.
+        """
+        if not self._in_transaction:
+            return
+        try:
+            self._conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            self._rollback()
+            raise DbeeError("failed to commit: %s" % e)
+        self._in_transaction = False
+        self._pending = 0
+
+    def execute(self, transaction):
+        op = memory._parse(transaction)
+        self._begin()
+        self._apply(op)
+        self._pending += 1
+        if self._pending >= self._commit_interval:
+            self.commit()
+
+    def execute_batch(self, transactions):
+        """Execute transactions and commit them together."""
+        errors = []
+        self._begin()
+        for transaction in transactions:
+            try:
+                op = memory._parse(transaction)
+            except ClientError as e:
+                errors.append(e)
+                continue
+            self._apply(op)
+            errors.append(None)
+        self.commit()
+        return errors
+
+    def snapshot(self, filename, callback):
+        start = time.time()
+        with self._lock:
+            rejected = self._snapshotting
+            self._snapshotting = True
+        if rejected:
+            # The snapshot in progress still owns the flag.
+            callback(ClientError("another snapshot is in progress"), None)
+            return
+        try:
+            # The snapshot must contain everything executed so far.
+            self.commit()
+        except DbeeError as e:
+            self._finish(callback, e, None)
+            return
+
+        def run():
+            tmp = filename + ".tmp"
+            try:
+                source = _connect(self._filename)
+                try:
+                    _backup(source, tmp)
+                finally:
+                    source.close()
+                os.rename(tmp, filename)
+            except (EnvironmentError, sqlite3.Error) as e:
+                _remove(tmp)
+                self._finish(callback, DbeeError("snapshot failed: %s" % e),
+                             None)
+                return
+            if metrics.registry.enabled:
+                metrics.observe("dbee.snapshot.duration", time.time() - start)
+                metrics.observe("dbee.snapshot.bytes",
+                                os.path.getsize(filename))
+            self._finish(callback, None, filename)
+        thread = threading.Thread(target=run, name="dbee-snapshot")
+        thread.daemon = True
+        thread.start()
+
+    def restore(self, filename):
+        with self._lock:
+            if self._snapshotting:
+                raise ClientError("snapshot is in progress")
+        tmp = self._filename + ".restore"
+        try:
+            shutil.copyfile(filename, tmp)
+            _fsync(tmp)
+            check = sqlite3.connect(tmp)
+            try:
+                result = check.execute("PRAGMA quick_check").fetchone()[0]
+                check.execute("SELECT COUNT(*) FROM kv").fetchone()
+            finally:
+                check.close()
+            if result != "ok":
+                raise DbeeError("%s is corrupted: %s" % (filename, result))
+        except (EnvironmentError, sqlite3.Error) as e:
+            _remove(tmp)
+            raise DbeeError("failed to restore %s: %s" % (filename, e))
+        except DbeeError:
+            _remove(tmp)
+            raise
+
+        # Closing the last connection checkpoints and deletes the WAL. Any
+        # WAL left behind belongs to the old database and must not be
+        # applied to the new one.
+        self._rollback()
+        self._conn.close()
+        self._conn = None
+        for suffix in ("-wal", "-shm"):
+            _remove(self._filename + suffix)
+        os.rename(tmp, self._filename)
+        self._open()
+
+    def _open(self):
+        try:
+            self._conn = _connect(self._filename)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=%s" % self._synchronous)
+            self._conn.execute(_SCHEMA)
+        except sqlite3.Error as e:
+            raise DbeeError("failed to open %s: %s" % (self._filename, e))
+        self._in_transaction = False
+        self._pending = 0
+
+    def _begin(self):
+        if not self._in_transaction:
+            try:
+                self._conn.execute("BEGIN IMMEDIATE")
+            except sqlite3.Error as e:
+                raise DbeeError("failed to begin a transaction: %s" % e)
+            self._in_transaction = True
+
+    def _apply(self, op):
+        try:
+            if op[0] == "put":
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO kv VALUES (?, ?)", op[1:])
+            else:
+                self._conn.execute("DELETE FROM kv WHERE key = ?", op[1:])
+        except sqlite3.Error as e:
+            self._rollback()
+            raise DbeeError("failed to execute %r: %s" % (op, e))
+
+    def _rollback(self):
+        self._pending = 0
+        if self._in_transaction:
+            self._in_transaction = False
+            try:
+                self._conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+
+    def _finish(self, callback, error, filename):
+        with self._lock:
+            self._snapshotting = False
+        callback(error, filename)
@@ -14,6 +14,8 @@
 
 
 import abc
+import functools
+import threading
 
 
 class Base(object):
@@ -81,7 +83,10 @@ class Base(object):
         """Append a dbee transaction to this log.
 
         Args:
-            transaction: transaction to append in string.
+            transaction: transaction to append in string, or a frame built
+                         with dbeekeeper.framing in bytes, bytearray or
+                         memoryview. A frame must not be modified until
+                         the callback is invoked.
             callback: Callback to invoke when the operation finishes. This
                       function must take 2 arguments, error and transactionid.
                       If the operation succeeded, the first argument is set to
@@ -99,6 +104,61 @@ class Base(object):
             errors must be passed in the callback
         """
 
+    def append_many(self, transactions, callback):
+        """Append a list of dbee transactions to this log.
+
+        The default implementation calls append() once for each transaction
+        and invokes the callback once all of them have finished. Since other
+        clients may append concurrently, the resulting transaction IDs are
+        ordered but not necessarily contiguous. Classes that inherit from
+        this class should override this method if the underlying log can
+        append a contiguous range of transactions in one operation.
+
+        Args:
+            transactions: list of transactions to append. See append().
+            callback: Callback to invoke when the operation finishes. This
+                      function must take 2 arguments, error and
+                      transaction_ids. If the operation succeeded, the first
+                      argument is set to None and second argument is a list
+                      of the transaction IDs in the same order as
+                      transactions. If the operation failed, the first
+                      argument is an Exception that explains why the
+                      operation failed, and the second argument is set to
+                      None. Some of the transactions may have been appended
+                      even if the operation failed.
+
+        Returns:
+            None
+
+        Raises:
+            This method must not raise any dbeekeeper error. All the dbeekeeper
+            errors must be passed in the callback
+        """
+        transactions = list(transactions)
+        if not transactions:
+            callback(None, [])
+            return
+
+        lock = threading.Lock()
+        transaction_ids = [None] * len(transactions)
+        state = {"remaining": len(transactions), "error": None}
+
+        def done(i, error, transaction_id):
+            with lock:
+                if error is not None and state["error"] is None:
+                    state["error"] = error
+                transaction_ids[i] = transaction_id
+                state["remaining"] -= 1
+                if state["remaining"]:
+                    return
+            if state["error"] is not None:
+                callback(state["error"], None)
+            else:
+                callback(None, transaction_ids)
+
+        for i, transaction in enumerate(transactions):
+            self.append(transaction, functools.partial(done, i))
+
     @abc.abstractmethod
     def subscribe(self, from_transaction_id, receive_func):
         """Subscribe to this dbeelog for new entries.
@@ -122,7 +182,9 @@ class Base(object):
                    You won't receive any more transactions.
                 2. transaction_id
                 3. client_id - client that appended this transaction.
-                4. transaction
+                4. transaction - string, or memoryview for a frame. Dbeelog
+                   must verify frames it reads back and report torn or
+                   corrupted ones as a DbeeLogError.
 
         Returns:
             True if successful. False otherwise.
@@ -139,6 +201,11 @@ class Base(object):
         Call this method to notify dbeelog that you have persisted all the
         transactions up to and including the given transaction ID to disk.
 
+        Implementations may coalesce checkpoints: while a checkpoint is being
+        written, the checkpoints that follow it can be persisted by a single
+        write of the newest one, and each callback is invoked once that write
+        completes.
+
         Args:
             transaction_id:
                 Specify that the caller has persisted all the transactions up
@@ -165,6 +232,10 @@ class Base(object):
     def get_checkpoints(self, callback):
         """Get current checkpoints as a map from client_id to transaction_id.
 
+        Implementations may serve this from a cache, but the result must
+        reflect every checkpoint of this client whose callback was invoked
+        before the call. Checkpoints of other clients may lag behind.
+
         Args:
             callback: Callback to invoke when the operation finishes. This
                       function must take 2 arguments, error and a map. If the
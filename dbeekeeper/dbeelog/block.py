@@ -0,0 +1,102 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Compressed blocks of log records.
+
+A block-compressed segment is a sequence of blocks, each holding a number of
+consecutive records compressed together with zlib:
+
+    stored length, raw length, record count, crc32, compressed records
+
+Records that zlib doesn't make smaller, such as the single small record of
+a group commit at low load, are stored as they are, and the top bit of the
+record count is set to tell such blocks apart.
+
+Each block is compressed on its own, so a reader that knows where a block
+starts, for example from an OffsetIndex that only indexes block starts, can
+decompress that block without touching the ones before it. Blocks are
+checksummed, so a reader can tell a torn block at the tail of a segment
+from the end of the segment.
+"""
+
+import struct
+import zlib
+
+from ..error import DbeeLogError
+
+
+# Block header: stored length, raw length, record count, crc32 of the
+# stored bytes.
+_BLOCK = struct.Struct(">IIII")
+
+# Set in the record count of blocks stored uncompressed.
+_STORED = 0x80000000
+
+DEFAULT_BLOCK_SIZE = 64 * 1024
+
+DEFAULT_LEVEL = 6
+
+
+def pack(data, count, level=DEFAULT_LEVEL):
+    """Compress records into a block.
+
+    Args:
+        data: the encoded records in bytes.
+        count: number of records in data.
+        level: zlib compression level.
+
+    Returns:
+        The block in bytes.
+    """
+    stored = zlib.compress(data, level)
+    if len(stored) >= len(data):
+        stored = data
+        count |= _STORED
+    return (_BLOCK.pack(len(stored), len(data), count,
+                        zlib.crc32(stored) & 0xffffffff) + stored)
+
+
+def read(f):
+    """Read and decompress the block at the current position of f.
+
+    Returns:
+        (size of the block in f, record count, raw records in bytes), or None
+        if f is at the end of the segment or the block is incomplete.
+
+    Raises:
+        dbeekeeper.DbeeLogError: the block is corrupted.
+    """
+    header = f.read(_BLOCK.size)
+    if len(header) < _BLOCK.size:
+        return None
+    stored_len, raw_len, count, crc = _BLOCK.unpack(header)
+    stored = f.read(stored_len)
+    if len(stored) < stored_len:
+        return None
+    name = getattr(f, "name", "log")
+    if zlib.crc32(stored) & 0xffffffff != crc:
+        raise DbeeLogError("corrupted block in %s" % name)
+    if count & _STORED:
+        count &= ~_STORED
+        data = stored
+    else:
+        try:
+            data = zlib.decompress(stored)
+        except zlib.error as e:
+            raise DbeeLogError("corrupted block in %s: %s" % (name, e))
+    if len(data) != raw_len:
+        raise DbeeLogError("corrupted block in %s: expected %d bytes, got "
+                           "%d" % (name, raw_len, len(data)))
+    return _BLOCK.size + stored_len, count, data
@@ -0,0 +1,544 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""In-process ZooKeeper stand-in for kazoo clients, with injected latency.
+
+FakeServer keeps a znode tree in memory, and FakeClient implements the part
+of the kazoo.client.KazooClient interface that dbeelog.zk.ZkLog and the
+benchmark harness use: create, get, set, delete, exists and get_children,
+their _async variants, ensure_path, multi-op transactions, sequential and
+ephemeral znodes, and data and child watches. Results and watch events
+are delivered through a kazoo SequentialThreadingHandler, so callbacks run
+on the same kind of threads and in the same order as with a real server.
+
+A single thread processes requests in the order they arrive, like the
+ZooKeeper leader, and commits all the writes it finds queued with a single
+fsync, like the ZooKeeper transaction log. Each response is then delayed
+by the request latency plus a uniformly distributed jitter, without ever
+overtaking an earlier response to the same client. With a seed, the
+jitter is the same from one run to the next:
+
+    server = FakeServer(latency=0.001, fsync=0.002, jitter=0.0005, seed=1)
+    client = FakeClient(server)
+    client.start()
+    log = zk.ZkLog("log", "client1", client)
+
+There is no network protocol, no ACLs and no session expiry. Ephemeral
+znodes are deleted when their client is stopped.
+"""
+
+import functools
+import heapq
+import random
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from kazoo.exceptions import BadArgumentsError
+from kazoo.exceptions import BadVersionError
+from kazoo.exceptions import ConnectionClosedError
+from kazoo.exceptions import NoChildrenForEphemeralsError
+from kazoo.exceptions import NoNodeError
+from kazoo.exceptions import NodeExistsError
+from kazoo.exceptions import NotEmptyError
+from kazoo.exceptions import RolledBackError
+from kazoo.exceptions import RuntimeInconsistency
+from kazoo.exceptions import ZookeeperError
+from kazoo.handlers.threading import SequentialThreadingHandler
+from kazoo.protocol.states import Callback
+from kazoo.protocol.states import EventType
+from kazoo.protocol.states import KazooState
+from kazoo.protocol.states import KeeperState
+from kazoo.protocol.states import WatchedEvent
+from kazoo.protocol.states import ZnodeStat
+
+
+# Sentinel that stops the server threads.
+_STOP = object()
+
+
+def _parent(path):
+    return path.rsplit("/", 1)[0] or "/"
+
+
+def _check_path(path):
+    if (not path.startswith("/") or "//" in path or
+            path != "/" and path.endswith("/")):
+        raise BadArgumentsError("invalid path: %r" % (path,))
+
+
+def _check_value(value):
+    if not isinstance(value, bytes):
+        raise TypeError("value must be bytes")
+
+
+class _Node(object):
+
+    __slots__ = ("data", "children", "czxid", "mzxid", "ctime", "mtime",
+                 "version", "cversion", "owner", "pzxid")
+
+    def __init__(self, data, zxid, now, owner):
+        self.data = data
+        self.children = set()
+        self.czxid = self.mzxid = self.pzxid = zxid
+        self.ctime = self.mtime = now
+        self.version = 0
+        self.cversion = 0
+        self.owner = owner
+
+    def stat(self):
+        return ZnodeStat(self.czxid, self.mzxid, self.ctime, self.mtime,
+                         self.version, self.cversion, 0, self.owner,
+                         len(self.data), len(self.children), self.pzxid)
+
+
+class FakeServer(object):
+    """In-memory znode tree that serves FakeClients."""
+
+    def __init__(self, latency=0.0, fsync=0.0, jitter=0.0, seed=None):
+        """Constructor
+
+        Args:
+            latency: seconds added to every response.
+            fsync: seconds each group commit of writes takes.
+            jitter: maximum seconds added to latency at random.
+            seed: seed of the jitter, for reproducible runs.
+        """
+        self.latency = latency
+        self.fsync = fsync
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self._zxid = 0
+        self._nodes = {"/": _Node(b"", 0, 0, 0)}
+        # Path -> list of (client, func) of one-shot watches.
+        self._data_watches = {}
+        self._child_watches = {}
+        self._next_session = 1
+        self._requests = queue.Queue()
+        self._cond = threading.Condition()
+        self._deliveries = []
+        self._delivery_count = 0
+        self._closed = False
+        self._threads = []
+        for target, name in ((self._process, "fakezk-processor"),
+                             (self._deliver, "fakezk-delivery")):
+            thread = threading.Thread(target=target, name=name)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self):
+        """Stop the server threads. Pending requests are dropped."""
+        self._requests.put(_STOP)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def _session(self):
+        with self._cond:
+            session = self._next_session
+            self._next_session += 1
+        return session
+
+    def submit(self, client, op, write):
+        """Queue op(session) for the processor and return an AsyncResult.
+
+        op runs on the processor thread, the only thread that touches the
+        tree, and returns the result value or raises a ZookeeperError.
+        """
+        result = client.handler.async_result()
+        self._requests.put((client, op, write, result))
+        return result
+
+    def _process(self):
+        while True:
+            requests = [self._requests.get()]
+            while True:
+                try:
+                    requests.append(self._requests.get_nowait())
+                except queue.Empty:
+                    break
+            if _STOP in requests:
+                return
+            completed = []
+            writes = False
+            for client, op, write, result in requests:
+                events = []
+                try:
+                    value = op(client, events)
+                    error = None
+                except (ZookeeperError, TypeError) as e:
+                    value = None
+                    error = e
+                writes = writes or write
+                completed.append((client, result, value, error, events))
+            if writes and self.fsync:
+                time.sleep(self.fsync)
+            now = time.time()
+            with self._cond:
+                for client, result, value, error, events in completed:
+                    for watcher, func, event in events:
+                        self._schedule(watcher, now, functools.partial(
+                            watcher.handler.dispatch_callback,
+                            Callback("watch", func, (event,))))
+                    self._schedule(client, now, functools.partial(
+                        self._complete, result, value, error))
+                self._cond.notify_all()
+
+    def _schedule(self, client, now, func):
+        due = now + self.latency
+        if self.jitter:
+            due += self._random.uniform(0, self.jitter)
+        # Responses to a client never overtake each other.
+        due = max(due, client._last_due)
+        client._last_due = due
+        self._delivery_count += 1
+        heapq.heappush(self._deliveries, (due, self._delivery_count, func))
+
+    def _complete(self, result, value, error):
+        if error is not None:
+            result.set_exception(error)
+        else:
+            result.set(value)
+
+    def _deliver(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        return
+                    if self._deliveries:
+                        wait = self._deliveries[0][0] - time.time()
+                        if wait <= 0:
+                            break
+                        self._cond.wait(wait)
+                    else:
+                        self._cond.wait()
+                func = heapq.heappop(self._deliveries)[2]
+            func()
+
+    # The methods below run on the processor thread.
+
+    def _node(self, path):
+        _check_path(path)
+        node = self._nodes.get(path)
+        if node is None:
+            raise NoNodeError(path)
+        return node
+
+    def _watch(self, watches, path, client, func):
+        if func is not None:
+            entries = watches.setdefault(path, [])
+            if (client, func) not in entries:
+                entries.append((client, func))
+
+    def _trigger(self, events, watches, path, event_type):
+        for client, func in watches.pop(path, []):
+            events.append((client, func, WatchedEvent(
+                event_type, KeeperState.CONNECTED, path)))
+
+    def get(self, client, path, watch, events):
+        node = self._node(path)
+        self._watch(self._data_watches, path, client, watch)
+        return node.data, node.stat()
+
+    def exists(self, client, path, watch, events):
+        _check_path(path)
+        self._watch(self._data_watches, path, client, watch)
+        node = self._nodes.get(path)
+        return None if node is None else node.stat()
+
+    def get_children(self, client, path, watch, events):
+        node = self._node(path)
+        self._watch(self._child_watches, path, client, watch)
+        return sorted(node.children)
+
+    def create(self, client, path, value, ephemeral, sequence, makepath,
+               events, undo):
+        _check_path(path)
+        _check_value(value)
+        if path == "/":
+            raise NodeExistsError(path)
+        parent_path = _parent(path)
+        if makepath and parent_path not in self._nodes:
+            self.create(client, parent_path, b"", False, False, True,
+                        events, undo)
+        parent = self._node(parent_path)
+        if parent.owner:
+            raise NoChildrenForEphemeralsError(parent_path)
+        if sequence:
+            path += "%010d" % parent.cversion
+        if path in self._nodes:
+            raise NodeExistsError(path)
+        self._zxid += 1
+        owner = client._session_id if ephemeral else 0
+        self._nodes[path] = _Node(value, self._zxid,
+                                  int(time.time() * 1000), owner)
+        name = path.rsplit("/", 1)[1]
+        old = parent.cversion, parent.pzxid
+        parent.children.add(name)
+        parent.cversion += 1
+        parent.pzxid = self._zxid
+
+        def revert():
+            del self._nodes[path]
+            parent.children.discard(name)
+            parent.cversion, parent.pzxid = old
+        undo.append(revert)
+        self._trigger(events, self._data_watches, path, EventType.CREATED)
+        self._trigger(events, self._child_watches, parent_path,
+                      EventType.CHILD)
+        return path
+
+    def set(self, client, path, value, version, events, undo):
+        _check_value(value)
+        node = self._node(path)
+        if version != -1 and version != node.version:
+            raise BadVersionError(path)
+        self._zxid += 1
+        old = node.data, node.version, node.mzxid, node.mtime
+        node.data = value
+        node.version += 1
+        node.mzxid = self._zxid
+        node.mtime = int(time.time() * 1000)
+
+        def revert():
+            node.data, node.version, node.mzxid, node.mtime = old
+        undo.append(revert)
+        self._trigger(events, self._data_watches, path, EventType.CHANGED)
+        return node.stat()
+
+    def delete(self, client, path, version, events, undo):
+        node = self._node(path)
+        if path == "/":
+            raise BadArgumentsError("cannot delete /")
+        if version != -1 and version != node.version:
+            raise BadVersionError(path)
+        if node.children:
+            raise NotEmptyError(path)
+        parent_path = _parent(path)
+        parent = self._nodes[parent_path]
+        name = path.rsplit("/", 1)[1]
+        self._zxid += 1
+        old = parent.cversion, parent.pzxid
+        del self._nodes[path]
+        parent.children.discard(name)
+        parent.cversion += 1
+        parent.pzxid = self._zxid
+
+        def revert():
+            self._nodes[path] = node
+            parent.children.add(name)
+            parent.cversion, parent.pzxid = old
+        undo.append(revert)
+        self._trigger(events, self._data_watches, path, EventType.DELETED)
+        self._trigger(events, self._child_watches, path, EventType.DELETED)
+        self._trigger(events, self._child_watches, parent_path,
+                      EventType.CHILD)
+        return True
+
+    def check(self, client, path, version, events, undo):
+        node = self._node(path)
+        if version != node.version:
+            raise BadVersionError(path)
+        return True
+
+    def multi(self, client, ops, events):
+        """Apply ops atomically. Returns kazoo's list of results."""
+        undo = []
+        staged = []
+        results = []
+        for i, (op, args) in enumerate(ops):
+            try:
+                results.append(op(client, *args, events=staged, undo=undo))
+            except (ZookeeperError, TypeError) as e:
+                for revert in reversed(undo):
+                    revert()
+                return ([RolledBackError() for _ in range(i)] + [e] +
+                        [RuntimeInconsistency()
+                         for _ in range(len(ops) - i - 1)])
+        events.extend(staged)
+        return results
+
+    def expire(self, client, events):
+        """Delete the ephemeral znodes of client."""
+        owned = sorted((path for path, node in self._nodes.items()
+                        if node.owner == client._session_id), reverse=True)
+        for path in owned:
+            self.delete(client, path, -1, events, [])
+        return True
+
+
+class FakeTransaction(object):
+    """Multi-op transaction, like kazoo's TransactionRequest."""
+
+    def __init__(self, client):
+        self._client = client
+        self._ops = []
+        self.committed = False
+
+    def create(self, path, value=b"", acl=None, ephemeral=False,
+               sequence=False):
+        self._ops.append((self._client._server.create,
+                          (path, value, ephemeral, sequence, False)))
+
+    def delete(self, path, version=-1):
+        self._ops.append((self._client._server.delete, (path, version)))
+
+    def set_data(self, path, value, version=-1):
+        self._ops.append((self._client._server.set, (path, value, version)))
+
+    def check(self, path, version):
+        self._ops.append((self._client._server.check, (path, version)))
+
+    def commit_async(self):
+        if self.committed:
+            raise ValueError("transaction already committed")
+        self.committed = True
+        ops = self._ops
+        return self._client._submit(
+            lambda client, events: client._server.multi(client, ops, events),
+            True)
+
+    def commit(self):
+        return self.commit_async().get()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if exc_type is None:
+            self.commit()
+
+
+class FakeClient(object):
+    """Subset of kazoo.client.KazooClient backed by a FakeServer."""
+
+    def __init__(self, server):
+        self._server = server
+        self._session_id = server._session()
+        self._last_due = 0.0
+        self.handler = SequentialThreadingHandler()
+        self.connected = False
+        self._listeners = []
+
+    def start(self, timeout=None):
+        if not self.connected:
+            self.handler.start()
+            self.connected = True
+
+    def stop(self):
+        """Delete the ephemeral znodes of this client and disconnect."""
+        if self.connected:
+            self._submit(self._server.expire, True).get()
+            self.connected = False
+            self.handler.stop()
+            for listener in list(self._listeners):
+                listener(KazooState.LOST)
+
+    def add_listener(self, listener):
+        """Add a session state listener, like KazooClient.add_listener()."""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def close(self):
+        pass
+
+    def _submit(self, op, write):
+        if not self.connected:
+            result = self.handler.async_result()
+            result.set_exception(ConnectionClosedError(
+                "Connection has been closed"))
+            return result
+        return self._server.submit(self, op, write)
+
+    def _write(self, op, *args):
+        return self._submit(
+            lambda client, events: op(client, *args, events=events,
+                                      undo=[]), True)
+
+    def create_async(self, path, value=b"", acl=None, ephemeral=False,
+                     sequence=False, makepath=False):
+        return self._write(self._server.create, path, value, ephemeral,
+                           sequence, makepath)
+
+    def create(self, path, value=b"", acl=None, ephemeral=False,
+               sequence=False, makepath=False):
+        return self.create_async(path, value, acl, ephemeral, sequence,
+                                 makepath).get()
+
+    def ensure_path_async(self, path, acl=None):
+        def op(client, events):
+            if path not in self._server._nodes:
+                self._server.create(client, path, b"", False, False, True,
+                                    events, [])
+            return True
+        return self._submit(op, True)
+
+    def ensure_path(self, path, acl=None):
+        return self.ensure_path_async(path).get()
+
+    def set_async(self, path, value, version=-1):
+        return self._write(self._server.set, path, value, version)
+
+    def set(self, path, value, version=-1):
+        return self.set_async(path, value, version).get()
+
+    def delete_async(self, path, version=-1):
+        return self._write(self._server.delete, path, version)
+
+    def delete(self, path, version=-1, recursive=False):
+        if recursive:
+            try:
+                for child in self.get_children(path):
+                    self.delete("%s/%s" % (path.rstrip("/"), child),
+                                recursive=True)
+            except NoNodeError:
+                return True
+        return self.delete_async(path, version).get()
+
+    def _read(self, op, *args):
+        return self._submit(
+            lambda client, events: op(client, *args, events=events), False)
+
+    def get_async(self, path, watch=None):
+        return self._read(self._server.get, path, watch)
+
+    def get(self, path, watch=None):
+        return self.get_async(path, watch).get()
+
+    def exists_async(self, path, watch=None):
+        return self._read(self._server.exists, path, watch)
+
+    def exists(self, path, watch=None):
+        return self.exists_async(path, watch).get()
+
+    def get_children_async(self, path, watch=None):
+        return self._read(self._server.get_children, path, watch)
+
+    def get_children(self, path, watch=None):
+        return self.get_children_async(path, watch).get()
+
+    def transaction(self):
+        return FakeTransaction(self)
@@ -0,0 +1,282 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Share a single dbeelog subscription among many local subscribers.
+
+A Fanout subscribes to a dbeelog once and stores the entries it receives in
+a bounded ring buffer. Each local subscriber reads the ring buffer from its
+own cursor, and its receive_func is driven from its own thread.
+
+When the ring buffer is full, the Fanout stops reading the underlying log
+until the slowest subscriber catches up. If slow_subscriber_timeout is set,
+subscribers that are still a full buffer behind after that many seconds are
+disconnected with a DbeeLogError instead.
+
+Transaction IDs are compared as strings, so the underlying dbeelog must use
+transaction IDs that sort in log order, like LocalLog and ZkLog do.
+"""
+
+import logging
+import threading
+import time
+
+from . import base
+from ..error import DbeeLogError
+
+
+_log = logging.getLogger(__name__)
+
+DEFAULT_CAPACITY = 64 * 1024
+
+# Maximum number of entries a subscriber delivers between two updates of its
+# cursor.
+_CHUNK = 256
+
+
+def _invoke(callback, *args):
+    try:
+        callback(*args)
+    except Exception:
+        _log.exception("dbeelog callback raised an exception")
+
+
+class Fanout(object):
+    """Single subscription to a dbeelog shared by local subscribers."""
+
+    def __init__(self, log, from_transaction_id="",
+                 capacity=DEFAULT_CAPACITY, slow_subscriber_timeout=None):
+        """Constructor
+
+        Args:
+            log:
+                dbeelog.Base to read from. The Fanout takes over its
+                subscription.
+
+            from_transaction_id:
+                Start reading the log from this transaction ID. Local
+                subscribers can't subscribe from earlier transactions.
+
+            capacity:
+                Number of entries in the ring buffer.
+
+            slow_subscriber_timeout:
+                Number of seconds to wait for a subscriber that is a full
+                ring buffer behind before disconnecting it. None means wait
+                forever.
+
+        Raises:
+            see dbeelog.Base.subscribe().
+        """
+        self._log = log
+        self._from_transaction_id = from_transaction_id
+        self._capacity = capacity
+        self._timeout = slow_subscriber_timeout
+        self._cond = threading.Condition()
+        self._ring = [None] * capacity
+        self._end = 0
+        self._subscribers = []
+        self._error = None
+        log.subscribe(from_transaction_id, self._receive)
+
+    def close(self):
+        """Stop reading the log and disconnect all the subscribers."""
+        with self._cond:
+            if self._error is None:
+                self._error = DbeeLogError("fanout is closed")
+            self._cond.notify_all()
+        close = getattr(self._log, "close", None)
+        if close is not None:
+            close()
+
+    def subscribe(self, from_transaction_id, receive_func):
+        """Subscribe to the shared log.
+
+        Args:
+            see dbeelog.Base.subscribe().
+
+        Returns:
+            Subscription. Call its cancel() method to unsubscribe.
+
+        Raises:
+            dbeekeeper.DbeeLogError: from_transaction_id precedes the
+                oldest entry in the ring buffer or the transaction the
+                Fanout started reading from, or the Fanout is closed.
+        """
+        with self._cond:
+            if self._error is not None:
+                raise self._error
+            start = max(0, self._end - self._capacity)
+            if not from_transaction_id:
+                cursor = self._end
+            else:
+                if (from_transaction_id < self._from_transaction_id or
+                        start < self._end and from_transaction_id <
+                        self._ring[start % self._capacity][0]):
+                    raise DbeeLogError("transaction %s is not buffered" %
+                                       from_transaction_id)
+                cursor = self._bisect(start, from_transaction_id)
+            subscription = Subscription(self, cursor, from_transaction_id,
+                                        receive_func)
+            self._subscribers.append(subscription)
+        subscription.start()
+        return subscription
+
+    def _bisect(self, start, transaction_id):
+        """Return the index of the first buffered entry >= transaction_id."""
+        lo, hi = start, self._end
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._ring[mid % self._capacity][0] < transaction_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _receive(self, error, transaction_id, client_id, transaction):
+        with self._cond:
+            if error is not None:
+                self._error = error
+                self._cond.notify_all()
+                return
+            deadline = None
+            while self._full():
+                if self._timeout is None:
+                    self._cond.wait()
+                    continue
+                now = time.time()
+                if deadline is None:
+                    deadline = now + self._timeout
+                if now >= deadline:
+                    self._disconnect_laggards()
+                    continue
+                self._cond.wait(deadline - now)
+            self._ring[self._end % self._capacity] = (transaction_id,
+                                                      client_id, transaction)
+            self._end += 1
+            self._cond.notify_all()
+
+    def _full(self):
+        return any(self._end - s._cursor >= self._capacity
+                   for s in self._subscribers)
+
+    def _disconnect_laggards(self):
+        for s in list(self._subscribers):
+            if self._end - s._cursor >= self._capacity:
+                _log.warning("disconnecting slow subscriber at %d/%d",
+                             s._cursor, self._end)
+                s._error = DbeeLogError("subscriber fell behind")
+                self._subscribers.remove(s)
+        self._cond.notify_all()
+
+    def _remove(self, subscription):
+        with self._cond:
+            if subscription in self._subscribers:
+                self._subscribers.remove(subscription)
+            self._cond.notify_all()
+
+
+class Subscription(threading.Thread):
+    """Local subscriber of a Fanout."""
+
+    def __init__(self, fanout, cursor, from_transaction_id, receive_func):
+        super(Subscription, self).__init__(name="dbeelog-fanout")
+        self.daemon = True
+        self._fanout = fanout
+        self._cursor = cursor
+        self._from = from_transaction_id
+        self._receive_func = receive_func
+        self._cancelled = False
+        self._error = None
+
+    def cancel(self):
+        self._cancelled = True
+        self._fanout._remove(self)
+
+    def run(self):
+        fanout = self._fanout
+        cond = fanout._cond
+        while True:
+            with cond:
+                while (not self._cancelled and self._error is None and
+                       self._cursor == fanout._end and fanout._error is None):
+                    cond.wait()
+                if self._cancelled:
+                    return
+                error = self._error
+                if error is None and self._cursor == fanout._end:
+                    error = fanout._error
+                if error is not None:
+                    break
+                end = min(fanout._end, self._cursor + _CHUNK)
+                entries = [fanout._ring[i % fanout._capacity]
+                           for i in range(self._cursor, end)]
+            for transaction_id, client_id, transaction in entries:
+                # Entries before from_transaction_id arrive when subscribing
+                # ahead of the log.
+                if transaction_id >= self._from:
+                    _invoke(self._receive_func, None, transaction_id,
+                            client_id, transaction)
+                if self._cancelled:
+                    return
+            with cond:
+                self._cursor = end
+                cond.notify_all()
+        fanout._remove(self)
+        _invoke(self._receive_func, error, None, None, None)
+
+
+class SharedLog(base.Base):
+    """dbeelog.Base that subscribes through a Fanout.
+
+    All the other operations are delegated to the client's own dbeelog.
+    """
+
+    def __init__(self, log, fanout):
+        """Constructor
+
+        Args:
+            log: dbeelog.Base of this client.
+            fanout: Fanout to subscribe to.
+        """
+        super(SharedLog, self).__init__(log.dbeelog_id, log.client_id,
+                                        log.min_checkpoints)
+        self._log = log
+        self._fanout = fanout
+        self._subscription = None
+
+    def close(self):
+        """Cancel the subscription of this client, if any."""
+        if self._subscription is not None:
+            self._subscription.cancel()
+            self._subscription = None
+
+    def append(self, transaction, callback):
+        self._log.append(transaction, callback)
+
+    def append_many(self, transactions, callback):
+        self._log.append_many(transactions, callback)
+
+    def subscribe(self, from_transaction_id, receive_func):
+        if self._subscription is not None:
+            self._subscription.cancel()
+        self._subscription = self._fanout.subscribe(from_transaction_id,
+                                                    receive_func)
+        return True
+
+    def checkpoint(self, transaction_id, callback):
+        self._log.checkpoint(transaction_id, callback)
+
+    def get_checkpoints(self, callback):
+        self._log.get_checkpoints(callback)
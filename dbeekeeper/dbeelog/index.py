@@ -0,0 +1,109 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Sparse, persistent index from log sequence numbers to file positions.
+
+A log implementation keeps one OffsetIndex per segment file. The index holds
+an entry for a record roughly every $interval bytes, so that finding a
+record only takes a binary search over the index and a scan over at most
+$interval bytes of the segment.
+
+The index is only a hint. Entries are written to disk without fsync, and a
+missing or partial index file can always be rebuilt from its segment.
+"""
+
+import bisect
+import io
+import os
+import struct
+
+
+# Index entry: sequence number, byte position in the segment.
+_ENTRY = struct.Struct(">QQ")
+
+DEFAULT_INTERVAL = 64 * 1024
+
+
+class OffsetIndex(object):
+    """Sparse index of a single segment file."""
+
+    def __init__(self, path, interval=DEFAULT_INTERVAL):
+        """Constructor
+
+        Loads the existing entries from path, if any.
+
+        Args:
+            path: index file.
+            interval: minimum number of bytes between indexed records.
+        """
+        self._path = path
+        self._interval = interval
+        self._entries = []
+        self._file = None
+        if os.path.exists(path):
+            with io.open(path, "rb") as f:
+                data = f.read()
+            for i in range(0, len(data) - _ENTRY.size + 1, _ENTRY.size):
+                self._entries.append(_ENTRY.unpack_from(data, i))
+
+    @property
+    def path(self):
+        return self._path
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, seq, position):
+        """Record that the record seq starts at position.
+
+        Records must be added in order. The entry is only kept if position
+        is at least $interval bytes past the last indexed record.
+        """
+        if self._entries and position - self._entries[-1][1] < self._interval:
+            return
+        # Appending a tuple is atomic, so readers can call lookup() while
+        # the writer is adding entries.
+        self._entries.append((seq, position))
+        if self._file is None:
+            self._file = io.open(self._path, "ab")
+        self._file.write(_ENTRY.pack(seq, position))
+
+    def lookup(self, seq):
+        """Find the closest indexed record at or before seq.
+
+        Returns:
+            (seq, position) of the indexed record, or None if seq precedes
+            all the indexed records.
+        """
+        i = bisect.bisect_right(self._entries, (seq, float("inf"))) - 1
+        if i < 0:
+            return None
+        return self._entries[i]
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def clear(self):
+        """Drop all the entries and the index file."""
+        self.close()
+        self._entries = []
+        if os.path.exists(self._path):
+            os.remove(self._path)
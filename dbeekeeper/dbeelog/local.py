@@ -0,0 +1,938 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Durable dbeelog backed by segment files on local disk.
+
+A Journal owns a directory of append-only segment files. Each segment is
+named after the sequence number of its first record, so that a reader can
+find the segment that holds a given transaction without opening the others.
+
+Appends are group-committed: a single writer thread collects every append()
+that arrives within a short window, writes them out with one write() and
+makes them durable with one fsync(). Callbacks are invoked only after the
+fsync returns.
+
+LocalLog is the dbeelog.Base view of a Journal for a single client. Several
+LocalLog instances, one per client, may share a Journal.
+
+With block_size set, new segments are block-compressed (see
+dbeelog.block): each group commit is packed into blocks of up to block_size
+bytes of records, and the index of the segment points at block starts, so
+that a subscriber only decompresses the blocks from its starting
+transaction on. A Journal can read both kinds of segments whatever its
+block_size is.
+
+Whole segments are deleted in the background once all of their records
+precede the truncation point computed from the clients' checkpoints.
+"""
+
+import bisect
+import collections
+import io
+import json
+import logging
+import os
+import re
+import struct
+import threading
+import time
+
+from . import base
+from . import block
+from . import index
+from . import truncation
+from .. import framing
+from .. import metrics
+from ..error import ClientError
+from ..error import DbeeLogError
+
+
+_log = logging.getLogger(__name__)
+
+_TEXT_TYPE = type(u"")
+
+# Types accepted as transactions: strings, and frames built with
+# dbeekeeper.framing.
+_TRANSACTION_TYPES = (_TEXT_TYPE, bytes, bytearray, memoryview)
+
+# Record header: transaction length, client_id length.
+_HEADER = struct.Struct(">IH")
+
+_SEGMENT_FORMAT = "%020d.log"
+_BLOCK_SEGMENT_FORMAT = "%020d.blk"
+_INDEX_FORMAT = "%020d.idx"
+_SEGMENT_PATTERN = re.compile(r"^(\d{20})\.(log|blk)$")
+_CHECKPOINTS = "checkpoints.json"
+
+# Number of recent group commits whose time is kept to measure the lag of
+# subscribers.
+_COMMIT_TIMES = 4096
+
+
+def format_transaction_id(seq):
+    """Format a log sequence number as a transaction ID string."""
+    return "%020d" % seq
+
+
+def parse_transaction_id(transaction_id):
+    """Parse a transaction ID string into a log sequence number.
+
+    Raises:
+        dbeekeeper.ClientError: transaction_id is malformed.
+    """
+    try:
+        seq = int(transaction_id)
+    except (TypeError, ValueError):
+        raise ClientError("malformed transaction id: %r" % (transaction_id,))
+    if seq < 1:
+        raise ClientError("malformed transaction id: %r" % (transaction_id,))
+    return seq
+
+
+def _to_bytes(s):
+    if not isinstance(s, _TEXT_TYPE):
+        return s
+    return s.encode("utf-8")
+
+
+def _to_str(b):
+    if str is bytes:
+        return b
+    return b.decode("utf-8")
+
+
+def _fsync_directory(directory):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        # Some platforms do not allow opening directories.
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _invoke(callback, *args):
+    try:
+        callback(*args)
+    except Exception:
+        _log.exception("dbeelog callback raised an exception")
+
+
+def _read_record(f):
+    """Read one record from f.
+
+    Returns:
+        (size, client_id, transaction) or None if f is at the end of the
+        segment or the record is incomplete. transaction is a memoryview of
+        the record, so that frames are passed on without a copy.
+    """
+    header = f.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+        return None
+    txn_len, client_len = _HEADER.unpack(header)
+    body = f.read(client_len + txn_len)
+    if len(body) < client_len + txn_len:
+        return None
+    view = memoryview(body)
+    return (_HEADER.size + len(body), view[:client_len].tobytes(),
+            view[client_len:])
+
+
+def _unpack_records(data, count):
+    """Split the raw records of a block into (client_id, transaction)."""
+    view = memoryview(data)
+    records = []
+    pos = 0
+    while pos + _HEADER.size <= len(view):
+        txn_len, client_len = _HEADER.unpack_from(view, pos)
+        pos += _HEADER.size
+        client_id = view[pos:pos + client_len].tobytes()
+        pos += client_len
+        records.append((client_id, view[pos:pos + txn_len]))
+        pos += txn_len
+    if pos != len(view) or len(records) != count:
+        raise DbeeLogError("corrupted block: expected %d records" % count)
+    return records
+
+
+def _read_chunk(f, compressed):
+    """Read the next record, or block of records, from f.
+
+    Returns:
+        (size, [(client_id, transaction), ...]) or None if f is at the end
+        of the segment or the chunk is incomplete.
+
+    Raises:
+        dbeekeeper.DbeeLogError: the block is corrupted.
+    """
+    if not compressed:
+        record = _read_record(f)
+        if record is None:
+            return None
+        return record[0], [record[1:]]
+    chunk = block.read(f)
+    if chunk is None:
+        return None
+    size, count, data = chunk
+    return size, _unpack_records(data, count)
+
+
+class Journal(object):
+    """Segmented append-only log in a local directory."""
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024,
+                 commit_window=0.001, index_interval=index.DEFAULT_INTERVAL,
+                 block_size=None):
+        """Constructor
+
+        Args:
+            directory:
+                Directory to store segment files in. It is created if it
+                doesn't exist.
+
+            segment_size:
+                Roll over to a new segment file once the current one grows
+                beyond this many bytes.
+
+            commit_window:
+                Number of seconds the writer waits after the first pending
+                append to collect more appends into the same group commit.
+
+            index_interval:
+                Index a record roughly every this many bytes of a segment.
+                Seeking to a transaction scans at most this many bytes.
+
+            block_size:
+                Compress new segments in blocks of up to this many bytes of
+                records. None writes uncompressed segments. Blocks never
+                span group commits, so they only fill up when appends
+                arrive faster than the commit window.
+
+        Raises:
+            dbeekeeper.DbeeLogError: the last segment holds a corrupted
+                block. Only an incomplete record or block at its end is
+                taken for a torn write and dropped.
+        """
+        self._directory = directory
+        self._segment_size = segment_size
+        self._commit_window = commit_window
+        self._index_interval = index_interval
+        self._block_size = block_size
+        # Segments stored in blocks.
+        self._block_segments = set()
+
+        self._lock = threading.Lock()
+        self._pending_cond = threading.Condition(self._lock)
+        self._commit_cond = threading.Condition(self._lock)
+        self._pending = []
+        self._closed = False
+        self._error = None
+        self._indexes = {}
+        self._index_lock = threading.Lock()
+        # (first seq, time) of recent group commits, while metrics are
+        # enabled.
+        self._commit_times = collections.deque(maxlen=_COMMIT_TIMES)
+        # Checkpoints waiting for the next write of the checkpoints file.
+        # Each checkpoint() call takes a ticket, and a write covers all the
+        # tickets taken before it started.
+        self._checkpoint_cond = threading.Condition()
+        self._checkpoint_updates = {}
+        self._checkpoint_requested = 0
+        self._checkpoint_written = 0
+        self._checkpoint_writing = False
+        self._checkpoint_failures = {}
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._checkpoints = self._load_checkpoints()
+        self._tracker = truncation.CheckpointTracker(dict(
+            (c, int(t)) for c, t in self._checkpoints.items()))
+        self._min_checkpoints = 0
+        self._segments = self._list_segments()
+        self._recover()
+        self._truncator = truncation.Truncator(
+            self.truncate, name="dbeelog-truncator:%s" % directory)
+
+        self._writer = threading.Thread(target=self._run,
+                                        name="dbeelog-writer:%s" % directory)
+        self._writer.daemon = True
+        self._writer.start()
+
+    @property
+    def directory(self):
+        return self._directory
+
+    @property
+    def last_seq(self):
+        """Sequence number of the last durable record, or 0."""
+        with self._lock:
+            return self._committed
+
+    def close(self):
+        """Flush pending appends, stop the writer and wake up readers."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._pending_cond.notify()
+            self._commit_cond.notify_all()
+        self._writer.join()
+        self._truncator.close()
+        self._file.close()
+        with self._lock:
+            for idx in self._indexes.values():
+                idx.close()
+
+    def append(self, client_id, transactions, callback):
+        """Queue transactions for the next group commit.
+
+        callback is invoked with (error, first_seq) once all of transactions
+        are durable. The transactions get consecutive sequence numbers.
+        """
+        with self._lock:
+            error = self._error
+            if error is None and self._closed:
+                error = DbeeLogError("dbeelog is closed")
+            if error is None:
+                self._pending.append((client_id, transactions, callback))
+                self._pending_cond.notify()
+                return
+        _invoke(callback, error, None)
+
+    def checkpoint(self, client_id, seq):
+        """Persist a checkpoint for client_id.
+
+        Checkpoints are coalesced: while one thread writes the checkpoints
+        file, checkpoint() calls from other threads wait, and the next write
+        persists the newest checkpoint of each client for all of them.
+        """
+        with self._checkpoint_cond:
+            self._checkpoint_updates[client_id] = seq
+            self._checkpoint_requested += 1
+            ticket = self._checkpoint_requested
+            while (self._checkpoint_written < ticket and
+                   self._checkpoint_writing):
+                self._checkpoint_cond.wait()
+            if self._checkpoint_written >= ticket:
+                error = self._checkpoint_failures.pop(ticket, None)
+                if error is not None:
+                    raise error
+                return
+            self._checkpoint_writing = True
+            updates, self._checkpoint_updates = self._checkpoint_updates, {}
+            first = self._checkpoint_written + 1
+            last = self._checkpoint_requested
+        if last > first:
+            metrics.increment("dbeelog.checkpoint.merged", last - first)
+        error = None
+        try:
+            self._write_checkpoints(updates)
+        except (DbeeLogError, EnvironmentError) as e:
+            error = e
+        with self._checkpoint_cond:
+            self._checkpoint_writing = False
+            self._checkpoint_written = last
+            if error is not None:
+                for t in range(first, last + 1):
+                    if t != ticket:
+                        self._checkpoint_failures[t] = error
+            self._checkpoint_cond.notify_all()
+        if error is not None:
+            raise error
+
+    def _write_checkpoints(self, updates):
+        # Only one thread writes checkpoints at a time, so the file can be
+        # stored without holding the lock that appends and the writer need.
+        with self._lock:
+            if self._closed:
+                raise DbeeLogError("dbeelog is closed")
+            checkpoints = dict(self._checkpoints)
+        for client_id, seq in updates.items():
+            checkpoints[client_id] = format_transaction_id(seq)
+        self._store_checkpoints(checkpoints)
+        with self._lock:
+            self._checkpoints = checkpoints
+            for client_id, seq in updates.items():
+                self._tracker.update(client_id, seq)
+            point = self._tracker.truncation_point(self._min_checkpoints)
+            oldest, newest = self._tracker.range()
+        metrics.set_gauge("dbeelog.checkpoint.spread", newest - oldest)
+        self._truncator.advance(point)
+
+    def require_checkpoints(self, min_checkpoints):
+        """Retain transactions until min_checkpoints clients checkpoint them.
+
+        The journal truncates nothing until this method is called. If it is
+        called several times, for example once by each LocalLog, the largest
+        min_checkpoints applies.
+        """
+        with self._lock:
+            self._min_checkpoints = max(self._min_checkpoints,
+                                        min_checkpoints)
+            point = self._tracker.truncation_point(self._min_checkpoints)
+        self._truncator.advance(point)
+
+    def truncate(self, seq):
+        """Delete the segments that only contain records before seq.
+
+        The segment being written to is never deleted. Readers that are
+        already reading a deleted segment can finish reading it.
+        """
+        with self._lock:
+            removed = []
+            while len(self._segments) > 1 and self._segments[1] <= seq:
+                segment = self._segments.pop(0)
+                removed.append((segment, self.segment_path(segment),
+                                self._indexes.pop(segment, None)))
+                self._block_segments.discard(segment)
+        for segment, path, idx in removed:
+            _log.info("deleting segment %s", path)
+            os.remove(path)
+            if idx is not None:
+                idx.close()
+            if os.path.exists(self._index_path(segment)):
+                os.remove(self._index_path(segment))
+        if removed:
+            _fsync_directory(self._directory)
+
+    def get_checkpoints(self):
+        with self._lock:
+            return dict(self._checkpoints)
+
+    def commit_time(self, seq):
+        """Return the time record seq was committed, if it is still known.
+
+        Commit times are only kept while metrics are enabled, for the most
+        recent group commits.
+        """
+        times = self._commit_times
+        i = bisect.bisect_right(times, (seq, float("inf"))) - 1
+        if i < 0:
+            return None
+        return times[i][1]
+
+    def follow(self, seq, cancelled):
+        """Generate durable records starting at sequence number seq.
+
+        The generator blocks waiting for new records once it reaches the end
+        of the log, and returns when cancelled() becomes true or the journal
+        is closed.
+
+        Yields:
+            (seq, client_id, transaction)
+
+        Raises:
+            dbeekeeper.DbeeLogError: seq is no longer in the log, or a
+                segment could not be read.
+        """
+        cursor = _Cursor(self)
+        try:
+            while True:
+                with self._lock:
+                    while (self._committed < seq and not self._closed and
+                           not cancelled()):
+                        self._commit_cond.wait()
+                    if cancelled() or self._committed < seq:
+                        return
+                    last = self._committed
+                for record in cursor.read(seq, last):
+                    yield record
+                    if cancelled():
+                        return
+                seq = last + 1
+        finally:
+            cursor.close()
+
+    def first_seq(self):
+        """Sequence number of the oldest record still in the log."""
+        with self._lock:
+            return self._segments[0]
+
+    def wakeup(self):
+        """Wake up all the followers so that they check cancellation."""
+        with self._lock:
+            self._commit_cond.notify_all()
+
+    def segment_path(self, segment):
+        if segment in self._block_segments:
+            return os.path.join(self._directory,
+                                _BLOCK_SEGMENT_FORMAT % segment)
+        return os.path.join(self._directory, _SEGMENT_FORMAT % segment)
+
+    def is_compressed(self, segment):
+        """Return True if segment is stored in compressed blocks."""
+        return segment in self._block_segments
+
+    def index(self, segment):
+        """Return the OffsetIndex of a segment.
+
+        The index is loaded from disk, or rebuilt from the segment if its
+        index file is missing.
+        """
+        with self._index_lock:
+            with self._lock:
+                idx = self._indexes.get(segment)
+            if idx is not None:
+                return idx
+            idx = index.OffsetIndex(self._index_path(segment),
+                                    self._index_interval)
+            if not len(idx):
+                try:
+                    self._build_index(segment, idx)
+                except DbeeLogError:
+                    # Don't leave a partial index behind.
+                    idx.clear()
+                    raise
+                finally:
+                    idx.close()
+            with self._lock:
+                self._indexes[segment] = idx
+            return idx
+
+    def find_segment(self, seq):
+        """Return the base sequence number of the segment containing seq."""
+        with self._lock:
+            i = bisect.bisect_right(self._segments, seq) - 1
+            if i < 0:
+                raise DbeeLogError("transaction %s has been truncated" %
+                                   format_transaction_id(seq))
+            return self._segments[i]
+
+    def _index_path(self, segment):
+        return os.path.join(self._directory, _INDEX_FORMAT % segment)
+
+    def _build_index(self, segment, idx):
+        """Scan a segment, adding its records to idx.
+
+        An incomplete record or block at the end of the segment is a torn
+        write, and is left out.
+
+        Returns:
+            (number of records, size of the valid part of the segment)
+
+        Raises:
+            dbeekeeper.DbeeLogError: the segment can't be read, or holds a
+                complete but corrupted block.
+        """
+        count = 0
+        offset = 0
+        try:
+            f = io.open(self.segment_path(segment), "rb")
+        except EnvironmentError as e:
+            raise DbeeLogError("failed to open segment %d: %s" % (segment, e))
+        with f:
+            while True:
+                try:
+                    chunk = _read_chunk(f, self.is_compressed(segment))
+                except DbeeLogError as e:
+                    raise DbeeLogError("segment %d at offset %d: %s" %
+                                       (segment, offset, e))
+                if chunk is None:
+                    break
+                idx.add(segment + count, offset)
+                offset += chunk[0]
+                count += len(chunk[1])
+        return count, offset
+
+    def _list_segments(self):
+        segments = []
+        for name in os.listdir(self._directory):
+            m = _SEGMENT_PATTERN.match(name)
+            if m:
+                segments.append(int(m.group(1)))
+                if m.group(2) == "blk":
+                    self._block_segments.add(int(m.group(1)))
+        segments.sort()
+        return segments
+
+    def _recover(self):
+        """Find the end of the log and drop a torn record at its tail."""
+        if not self._segments:
+            self._segments = [1]
+            if self._block_size:
+                self._block_segments.add(1)
+            io.open(self.segment_path(1), "ab").close()
+            _fsync_directory(self._directory)
+        segment = self._segments[-1]
+        path = self.segment_path(segment)
+        # The index of the last segment may be missing entries or refer to
+        # a torn record, so always rebuild it.
+        idx = index.OffsetIndex(self._index_path(segment),
+                                self._index_interval)
+        idx.clear()
+        try:
+            count, offset = self._build_index(segment, idx)
+        except DbeeLogError:
+            idx.clear()
+            idx.close()
+            raise
+        idx.flush()
+        self._indexes[segment] = idx
+        if os.path.getsize(path) != offset:
+            _log.warning("truncating torn record at %s:%d", path, offset)
+            with io.open(path, "r+b") as f:
+                f.truncate(offset)
+                f.flush()
+                os.fsync(f.fileno())
+        self._committed = segment + count - 1
+        self._file = io.open(path, "ab")
+        self._file_size = offset
+
+    def _roll(self, next_seq):
+        self._file.close()
+        if self._block_size:
+            with self._lock:
+                self._block_segments.add(next_seq)
+        path = self.segment_path(next_seq)
+        self._file = io.open(path, "ab")
+        self._file_size = 0
+        _fsync_directory(self._directory)
+        idx = index.OffsetIndex(self._index_path(next_seq),
+                                self._index_interval)
+        idx.clear()
+        with self._lock:
+            self._indexes[self._segments[-1]].close()
+            self._segments.append(next_seq)
+            self._indexes[next_seq] = idx
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._pending and not self._closed:
+                    self._pending_cond.wait()
+                if not self._pending:
+                    return
+                closed = self._closed
+            if self._commit_window and not closed:
+                time.sleep(self._commit_window)
+            with self._lock:
+                batch, self._pending = self._pending, []
+            self._commit(batch)
+
+    def _commit(self, batch):
+        next_seq = self._committed + 1
+        if self._file_size >= self._segment_size:
+            try:
+                self._roll(next_seq)
+            except EnvironmentError as e:
+                self._fail(batch, e)
+                return
+
+        records = []
+        for client_id, transactions, _ in batch:
+            client_id = _to_bytes(client_id)
+            for transaction in transactions:
+                transaction = _to_bytes(transaction)
+                records.append((_HEADER.pack(len(transaction), len(client_id)),
+                                client_id, transaction))
+        data, entries = self._encode(records, next_seq)
+        try:
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except EnvironmentError as e:
+            self._fail(batch, e)
+            return
+        self._file_size += len(data)
+
+        # Index entries are added only after the records are durable, so
+        # that the index never points past the end of the segment.
+        idx = self._indexes[self._segments[-1]]
+        for seq, position in entries:
+            idx.add(seq, position)
+        try:
+            idx.flush()
+        except EnvironmentError as e:
+            _log.warning("failed to write index %s: %s", idx.path, e)
+
+        if metrics.registry.enabled:
+            self._commit_times.append((next_seq, time.time()))
+        with self._lock:
+            self._committed = next_seq + sum(len(t) for _, t, _ in batch) - 1
+            self._commit_cond.notify_all()
+
+        for _, transactions, callback in batch:
+            _invoke(callback, None, next_seq)
+            next_seq += len(transactions)
+
+    def _encode(self, records, seq):
+        """Encode records for the segment being written to.
+
+        Returns:
+            (data, entries) where entries lists the (seq, position) of
+            each record, or of each block in a block-compressed segment.
+        """
+        chunks = []
+        entries = []
+        position = self._file_size
+        if not self.is_compressed(self._segments[-1]):
+            for record in records:
+                entries.append((seq, position))
+                seq += 1
+                for part in record:
+                    chunks.append(part)
+                    position += len(part)
+            return b"".join(chunks), entries
+
+        # The journal may be appending to a block-compressed segment it
+        # didn't create.
+        block_size = self._block_size or block.DEFAULT_BLOCK_SIZE
+        start = 0
+        while start < len(records):
+            end = start
+            size = 0
+            while end < len(records) and (end == start or
+                                          size < block_size):
+                size += sum(len(part) for part in records[end])
+                end += 1
+            packed = block.pack(b"".join(part for record in records[start:end]
+                                         for part in record), end - start)
+            entries.append((seq, position))
+            chunks.append(packed)
+            position += len(packed)
+            seq += end - start
+            start = end
+        return b"".join(chunks), entries
+
+    def _fail(self, batch, e):
+        # After a failed write or fsync the state of the segment on disk is
+        # unknown, so refuse any further appends.
+        error = DbeeLogError("failed to write %s: %s" % (self._directory, e))
+        with self._lock:
+            self._error = error
+            pending, self._pending = self._pending, []
+        for _, _, callback in batch + pending:
+            _invoke(callback, error, None)
+
+    def _load_checkpoints(self):
+        path = os.path.join(self._directory, _CHECKPOINTS)
+        if not os.path.exists(path):
+            return {}
+        with io.open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _store_checkpoints(self, checkpoints):
+        path = os.path.join(self._directory, _CHECKPOINTS)
+        tmp = path + ".tmp"
+        with io.open(tmp, "wb") as f:
+            f.write(_to_bytes(json.dumps(checkpoints, sort_keys=True)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+        _fsync_directory(self._directory)
+
+
+class _Cursor(object):
+    """Sequential reader over the segments of a Journal."""
+
+    def __init__(self, journal):
+        self._journal = journal
+        self._file = None
+        self._segment = None
+        self._compressed = False
+        self._next = None
+        # Records of the last chunk read that haven't been returned yet.
+        self._buffer = []
+        self._buffer_pos = 0
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def read(self, seq, last):
+        """Generate records from seq up to and including last."""
+        if self._next != seq:
+            self._seek(seq)
+        while self._next <= last:
+            record = self._read()
+            if record is None:
+                # The current segment is exhausted, the next record is at the
+                # beginning of the next segment.
+                self._open(self._next)
+                continue
+            client_id, transaction = record
+            self._next += 1
+            yield self._next - 1, client_id, transaction
+
+    def _open(self, segment):
+        self.close()
+        try:
+            self._file = io.open(self._journal.segment_path(segment), "rb")
+        except EnvironmentError as e:
+            raise DbeeLogError("failed to open segment %d: %s" % (segment, e))
+        self._segment = segment
+        self._compressed = self._journal.is_compressed(segment)
+        self._next = segment
+        self._buffer = []
+        self._buffer_pos = 0
+
+    def _read(self):
+        if self._buffer_pos == len(self._buffer):
+            chunk = _read_chunk(self._file, self._compressed)
+            if chunk is None:
+                return None
+            self._buffer = chunk[1]
+            self._buffer_pos = 0
+        self._buffer_pos += 1
+        return self._buffer[self._buffer_pos - 1]
+
+    def _seek(self, seq):
+        segment = self._journal.find_segment(seq)
+        self._open(segment)
+        entry = self._journal.index(segment).lookup(seq)
+        if entry is not None:
+            self._next, position = entry
+            self._file.seek(position)
+        while self._next < seq:
+            if self._read() is None:
+                raise DbeeLogError("segment %d ends before transaction %s" %
+                                   (self._segment, format_transaction_id(seq)))
+            self._next += 1
+
+
+class LocalLog(base.Base):
+    """dbeelog.Base implementation on top of a local Journal."""
+
+    def __init__(self, dbeelog_id, client_id, journal, min_checkpoints=3):
+        """Constructor
+
+        Args:
+            dbeelog_id: see dbeelog.Base.
+            client_id: see dbeelog.Base.
+            journal: Journal to store transactions in.
+            min_checkpoints: see dbeelog.Base.
+        """
+        super(LocalLog, self).__init__(dbeelog_id, client_id, min_checkpoints)
+        self._journal = journal
+        self._subscription = None
+        journal.require_checkpoints(min_checkpoints)
+
+    def close(self):
+        """Cancel the subscription of this client, if any."""
+        if self._subscription is not None:
+            self._subscription.cancel()
+            self._subscription = None
+
+    def append(self, transaction, callback):
+        if not isinstance(transaction, _TRANSACTION_TYPES):
+            _invoke(callback, ClientError(
+                "transaction must be a string or a frame"), None)
+            return
+        try:
+            framing.check_transaction(transaction)
+        except ClientError as e:
+            _invoke(callback, e, None)
+            return
+        callback = metrics.timed("dbeelog.append.latency", callback)
+
+        def done(error, seq):
+            if error is not None:
+                callback(error, None)
+            else:
+                metrics.increment("dbeelog.append.transactions")
+                callback(None, format_transaction_id(seq))
+        self._journal.append(self._client_id, [transaction], done)
+
+    def append_many(self, transactions, callback):
+        """Append transactions as a contiguous range in one group commit."""
+        transactions = list(transactions)
+        for transaction in transactions:
+            if not isinstance(transaction, _TRANSACTION_TYPES):
+                _invoke(callback, ClientError(
+                    "transaction must be a string or a frame"), None)
+                return
+            try:
+                framing.check_transaction(transaction)
+            except ClientError as e:
+                _invoke(callback, e, None)
+                return
+        if not transactions:
+            _invoke(callback, None, [])
+            return
+        callback = metrics.timed("dbeelog.append.latency", callback)
+
+        def done(error, seq):
+            if error is not None:
+                callback(error, None)
+            else:
+                metrics.increment("dbeelog.append.transactions",
+                                  len(transactions))
+                callback(None, [format_transaction_id(seq + i)
+                                for i in range(len(transactions))])
+        self._journal.append(self._client_id, transactions, done)
+
+    def subscribe(self, from_transaction_id, receive_func):
+        if from_transaction_id:
+            seq = parse_transaction_id(from_transaction_id)
+            if seq < self._journal.first_seq():
+                raise DbeeLogError("transaction %s has been truncated" %
+                                   from_transaction_id)
+        else:
+            seq = self._journal.last_seq + 1
+        if self._subscription is not None:
+            self._subscription.cancel()
+        self._subscription = _Subscription(self._journal, seq, receive_func)
+        self._subscription.start()
+        return True
+
+    def checkpoint(self, transaction_id, callback):
+        try:
+            seq = parse_transaction_id(transaction_id)
+            self._journal.checkpoint(self._client_id, seq)
+        except (ClientError, DbeeLogError) as e:
+            _invoke(callback, e, None)
+        except EnvironmentError as e:
+            _invoke(callback, DbeeLogError(
+                "failed to store checkpoint: %s" % e), None)
+        else:
+            _invoke(callback, None, transaction_id)
+
+    def get_checkpoints(self, callback):
+        _invoke(callback, None, self._journal.get_checkpoints())
+
+
+class _Subscription(threading.Thread):
+    """Thread that delivers journal records to a receive_func."""
+
+    def __init__(self, journal, seq, receive_func):
+        super(_Subscription, self).__init__(name="dbeelog-subscription")
+        self.daemon = True
+        self._journal = journal
+        self._seq = seq
+        self._receive_func = receive_func
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+        self._journal.wakeup()
+
+    def run(self):
+        try:
+            for seq, client_id, transaction in self._journal.follow(
+                    self._seq, lambda: self._cancelled):
+                if metrics.registry.enabled:
+                    committed = self._journal.commit_time(seq)
+                    if committed is not None:
+                        metrics.observe("dbeelog.subscribe.lag",
+                                        time.time() - committed)
+                _invoke(self._receive_func, None, format_transaction_id(seq),
+                        _to_str(client_id),
+                        framing.unpack_transaction(transaction))
+        except DbeeLogError as e:
+            if not self._cancelled:
+                _invoke(self._receive_func, e, None, None, None)
@@ -0,0 +1,358 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Partition one logical dbeelog across several underlying dbeelogs.
+
+ShardedLog routes each transaction to one of its shards, each a dbeelog.Base
+with its own dbeelog_id, by a partition key. Transactions with the same key
+always go to the same shard and keep their order; transactions in
+different shards are not ordered with respect to each other.
+
+A sharded transaction ID is the shard number and the transaction ID within
+that shard:
+
+    0002:00000000000000000042
+
+Since there is no global order, a position in a ShardedLog is a cursor: a
+comma-separated list with at most one transaction ID per shard. subscribe()
+takes a cursor, and checkpoint() and get_checkpoints() use cursors to
+checkpoint all the shards at once. The shards truncate independently, each
+according to its own min_checkpoints.
+
+Shards are picked by the CRC32 of the key, so every process routes a key to
+the same shard as long as they agree on the number of shards.
+"""
+
+import functools
+import logging
+import threading
+import zlib
+
+from . import base
+from ..error import ClientError
+
+
+_log = logging.getLogger(__name__)
+
+_TEXT_TYPE = type(u"")
+
+
+def _invoke(callback, *args):
+    try:
+        callback(*args)
+    except Exception:
+        _log.exception("dbeelog callback raised an exception")
+
+
+def _discard(error, transaction_id, client_id, transaction):
+    pass
+
+
+def format_transaction_id(shard, transaction_id):
+    """Format the transaction ID of a shard as a sharded transaction ID."""
+    return "%04d:%s" % (shard, transaction_id)
+
+
+def parse_transaction_id(transaction_id):
+    """Split a sharded transaction ID into (shard, transaction ID).
+
+    Raises:
+        dbeekeeper.ClientError: transaction_id is malformed.
+    """
+    shard, sep, shard_transaction_id = str(transaction_id).partition(":")
+    if not sep or not shard.isdigit() or not shard_transaction_id:
+        raise ClientError("malformed transaction id: %r" % (transaction_id,))
+    return int(shard), shard_transaction_id
+
+
+def format_cursor(transaction_ids):
+    """Join sharded transaction IDs into a cursor."""
+    return ",".join(sorted(transaction_ids))
+
+
+def parse_cursor(cursor):
+    """Split a cursor into a map from shard to transaction ID.
+
+    Raises:
+        dbeekeeper.ClientError: cursor is malformed.
+    """
+    positions = {}
+    for transaction_id in cursor.split(",") if cursor else []:
+        shard, shard_transaction_id = parse_transaction_id(transaction_id)
+        if shard in positions:
+            raise ClientError("shard %d appears twice in %r" %
+                              (shard, cursor))
+        positions[shard] = shard_transaction_id
+    return positions
+
+
+def _gather(count, callback):
+    """Return a function done(i, error, result) that calls
+    callback(error, results) after all the count results arrived.
+
+    error is the first error, if any.
+    """
+    lock = threading.Lock()
+    results = [None] * count
+    state = {"remaining": count, "error": None}
+
+    def done(i, error, result):
+        with lock:
+            if error is not None and state["error"] is None:
+                state["error"] = error
+            results[i] = result
+            state["remaining"] -= 1
+            if state["remaining"]:
+                return
+        callback(state["error"], results)
+    return done
+
+
+class ShardedLog(base.Base):
+    """dbeelog.Base that partitions transactions across shards."""
+
+    def __init__(self, dbeelog_id, client_id, shards, key_func=None,
+                 min_checkpoints=3):
+        """Constructor
+
+        Args:
+            dbeelog_id: see dbeelog.Base.
+            client_id: see dbeelog.Base.
+            shards: list of dbeelog.Base, one per shard. The ShardedLog
+                    takes over their subscriptions.
+            key_func: function that returns the partition key of a
+                      transaction, used when append() is not given a key.
+            min_checkpoints: see dbeelog.Base. Each shard applies its own.
+        """
+        super(ShardedLog, self).__init__(dbeelog_id, client_id,
+                                         min_checkpoints)
+        if not shards:
+            raise ClientError("a sharded log needs at least one shard")
+        self._shards = list(shards)
+        self._key_func = key_func
+        # Entries of all the shards are delivered one at a time, and only
+        # for the current subscription, a list that holds its receive_func
+        # until the subscription fails.
+        self._receive_lock = threading.Lock()
+        self._subscription = None
+
+    @property
+    def shards(self):
+        return list(self._shards)
+
+    def shard_for(self, key):
+        """Return the number of the shard that key is routed to."""
+        if isinstance(key, _TEXT_TYPE):
+            key = key.encode("utf-8")
+        return (zlib.crc32(key) & 0xffffffff) % len(self._shards)
+
+    def close(self):
+        """Close the shards that can be closed."""
+        for shard in self._shards:
+            close = getattr(shard, "close", None)
+            if close is not None:
+                close()
+
+    def append(self, transaction, callback, key=None):
+        """Append a transaction to the shard of its partition key.
+
+        Args:
+            key: partition key. Defaults to key_func(transaction).
+            See dbeelog.Base.append() for the others.
+        """
+        try:
+            shard = self.shard_for(self._key(transaction, key))
+        except ClientError as e:
+            _invoke(callback, e, None)
+            return
+
+        def done(error, transaction_id):
+            if error is not None:
+                callback(error, None)
+            else:
+                callback(None, format_transaction_id(shard, transaction_id))
+        self._shards[shard].append(transaction, done)
+
+    def append_many(self, transactions, callback, keys=None):
+        """Append transactions, each to the shard of its partition key.
+
+        The transactions of each shard are appended with a single
+        append_many() call on that shard, in their original order.
+
+        Args:
+            keys: list of partition keys, one per transaction. Defaults to
+                  key_func of each transaction.
+            See dbeelog.Base.append_many() for the others.
+        """
+        transactions = list(transactions)
+        if keys is None:
+            keys = [None] * len(transactions)
+        try:
+            if len(keys) != len(transactions):
+                raise ClientError("expected %d keys, got %d" %
+                                  (len(transactions), len(keys)))
+            shards = [self.shard_for(self._key(t, k))
+                      for t, k in zip(transactions, keys)]
+        except ClientError as e:
+            _invoke(callback, e, None)
+            return
+        if not transactions:
+            _invoke(callback, None, [])
+            return
+
+        groups = {}
+        for i, shard in enumerate(shards):
+            groups.setdefault(shard, []).append(i)
+        order = sorted(groups)
+
+        def finished(error, results):
+            if error is not None:
+                callback(error, None)
+                return
+            transaction_ids = [None] * len(transactions)
+            for shard, shard_ids in zip(order, results):
+                for i, transaction_id in zip(groups[shard], shard_ids):
+                    transaction_ids[i] = format_transaction_id(
+                        shard, transaction_id)
+            callback(None, transaction_ids)
+        done = _gather(len(order), finished)
+        for n, shard in enumerate(order):
+            self._shards[shard].append_many(
+                [transactions[i] for i in groups[shard]],
+                functools.partial(done, n))
+
+    def subscribe(self, from_transaction_id, receive_func):
+        """Subscribe to all the shards.
+
+        Args:
+            from_transaction_id: cursor to start from. Shards that don't
+                                 appear in it are read from their end.
+            receive_func: see dbeelog.Base.subscribe(). It is called from
+                          the subscription thread of each shard, but never
+                          concurrently, and only the entries of a single
+                          shard arrive in order. Its transaction IDs are
+                          sharded transaction IDs. An error from any shard
+                          ends the subscription: the other shards are
+                          re-subscribed from their end to a function that
+                          discards their entries.
+
+        Raises:
+            dbeekeeper.ClientError: from_transaction_id is malformed.
+            See dbeelog.Base.subscribe().
+        """
+        positions = parse_cursor(from_transaction_id)
+        for shard in positions:
+            if shard >= len(self._shards):
+                raise ClientError("no shard %d in %r" %
+                                  (shard, from_transaction_id))
+        subscription = [receive_func]
+        with self._receive_lock:
+            self._subscription = subscription
+        subscribed = []
+        try:
+            for shard, log in enumerate(self._shards):
+                log.subscribe(positions.get(shard, ""),
+                              functools.partial(self._receive, shard,
+                                                subscription))
+                subscribed.append(shard)
+        except Exception:
+            with self._receive_lock:
+                del subscription[:]
+                self._cancel(subscribed)
+            raise
+        return True
+
+    def checkpoint(self, transaction_id, callback):
+        """Checkpoint the shards that appear in a cursor.
+
+        Args:
+            transaction_id: cursor, or a single sharded transaction ID.
+            See dbeelog.Base.checkpoint() for the others.
+        """
+        try:
+            positions = parse_cursor(transaction_id)
+            for shard in positions:
+                if shard >= len(self._shards):
+                    raise ClientError("no shard %d in %r" %
+                                      (shard, transaction_id))
+        except ClientError as e:
+            _invoke(callback, e, None)
+            return
+        if not positions:
+            _invoke(callback, ClientError("empty cursor"), None)
+            return
+
+        def finished(error, results):
+            callback(error, None if error is not None else transaction_id)
+        done = _gather(len(positions), finished)
+        for n, (shard, position) in enumerate(sorted(positions.items())):
+            self._shards[shard].checkpoint(position,
+                                           functools.partial(done, n))
+
+    def get_checkpoints(self, callback):
+        """Get the checkpoints of all the shards.
+
+        The callback receives a map from client_id to the cursor of the
+        checkpoints that client made in each shard.
+        """
+        def finished(error, results):
+            if error is not None:
+                callback(error, None)
+                return
+            cursors = {}
+            for shard, checkpoints in enumerate(results):
+                for client_id, position in checkpoints.items():
+                    cursors.setdefault(client_id, []).append(
+                        format_transaction_id(shard, position))
+            callback(None, dict((client_id, format_cursor(ids))
+                                for client_id, ids in cursors.items()))
+        done = _gather(len(self._shards), finished)
+        for shard, log in enumerate(self._shards):
+            log.get_checkpoints(functools.partial(done, shard))
+
+    def _key(self, transaction, key):
+        if key is None:
+            if self._key_func is None:
+                raise ClientError("no partition key for transaction")
+            key = self._key_func(transaction)
+        if not isinstance(key, (bytes, _TEXT_TYPE)):
+            raise ClientError("partition key must be a string")
+        return key
+
+    def _receive(self, shard, subscription, error, transaction_id,
+                 client_id, transaction):
+        if transaction_id is not None:
+            transaction_id = format_transaction_id(shard, transaction_id)
+        with self._receive_lock:
+            if subscription is not self._subscription or not subscription:
+                return
+            receive_func = subscription[0]
+            if error is None:
+                receive_func(None, transaction_id, client_id, transaction)
+                return
+            del subscription[:]
+            _invoke(receive_func, error, None, None, None)
+            # The lock keeps a new subscribe() from being cancelled too.
+            self._cancel(other for other in range(len(self._shards))
+                         if other != shard)
+
+    def _cancel(self, shards):
+        """Re-subscribe shards to a function that discards their entries."""
+        for shard in shards:
+            try:
+                self._shards[shard].subscribe("", _discard)
+            except Exception:
+                _log.exception("failed to cancel the subscription of shard "
+                               "%d", shard)
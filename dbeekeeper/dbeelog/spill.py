@@ -0,0 +1,305 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Buffer the entries of a slow subscriber on disk.
+
+A dbeelog delivers entries to receive_func from its subscription thread, so
+a receive_func that falls behind either holds up the subscription or, if it
+queues the entries itself, grows without bound. A SpillingReceiver is a
+receive_func that hands entries to the real one on a thread of its own. It
+keeps up to max_entries undelivered entries in memory; entries that arrive
+while the memory queue is full are appended to a temporary file instead,
+and are read back in order once the memory queue has been drained. Once
+the file is drained too, it is truncated and entries go to memory again.
+
+Memory use is bounded by max_entries however far behind the subscriber is,
+and the subscription never has to be dropped and resumed from an old
+transaction ID. SpillingLog is a dbeelog.Base that subscribes through a
+SpillingReceiver.
+
+The temporary file is unlinked as soon as it's created, so it disappears
+when the receiver is closed or the process exits.
+"""
+
+import collections
+import io
+import logging
+import os
+import struct
+import tempfile
+import threading
+
+from . import base
+from .. import metrics
+
+
+_log = logging.getLogger(__name__)
+
+_TEXT_TYPE = type(u"")
+
+DEFAULT_MAX_ENTRIES = 64 * 1024
+
+# Record header in the spill file: type of the transaction, length of the
+# transaction ID, the client ID and the transaction.
+_RECORD = struct.Struct(">cHHI")
+
+# Maximum number of entries read back from the spill file at once.
+_CHUNK = 256
+
+
+def _invoke(callback, *args):
+    try:
+        callback(*args)
+    except Exception:
+        _log.exception("dbeelog callback raised an exception")
+
+
+def _encode(transaction_id, client_id, transaction):
+    if isinstance(transaction, _TEXT_TYPE):
+        kind = b"t"
+        transaction = transaction.encode("utf-8")
+    elif isinstance(transaction, memoryview):
+        kind = b"f"
+        transaction = transaction.tobytes()
+    else:
+        kind = b"b"
+        transaction = bytes(transaction)
+    transaction_id = transaction_id.encode("utf-8")
+    client_id = client_id.encode("utf-8")
+    return b"".join([_RECORD.pack(kind, len(transaction_id), len(client_id),
+                                  len(transaction)),
+                     transaction_id, client_id, transaction])
+
+
+class SpillingReceiver(object):
+    """receive_func that spills undelivered entries to a temporary file."""
+
+    def __init__(self, receive_func, max_entries=DEFAULT_MAX_ENTRIES,
+                 directory=None):
+        """Constructor
+
+        Args:
+            receive_func: see dbeelog.Base.subscribe(). It is called from a
+                          thread of the SpillingReceiver.
+            max_entries: maximum number of undelivered entries kept in
+                         memory.
+            directory: directory of the spill file. Defaults to the
+                       system's temporary directory.
+        """
+        self._receive_func = receive_func
+        self._max_entries = max_entries
+        self._directory = directory
+        self._cond = threading.Condition()
+        self._queue = collections.deque()
+        self._file = None
+        # Descriptor of the spill file with an offset of its own, so that
+        # _run() can read it back while __call__() appends to it.
+        self._reader_fd = None
+        self._read_pos = 0
+        self._write_pos = 0
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run,
+                                        name="dbeelog-spill")
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def spilled_bytes(self):
+        """Number of bytes of undelivered entries in the spill file."""
+        with self._cond:
+            return self._write_pos - self._read_pos
+
+    def close(self):
+        """Stop delivering entries, and delete the spill file."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.close(self._reader_fd)
+            self._reader_fd = None
+
+    def __call__(self, error, transaction_id, client_id, transaction):
+        """dbeelog receive_func. See dbeelog.Base.subscribe()."""
+        with self._cond:
+            if self._closed or self._error is not None:
+                return
+            if error is not None:
+                self._error = error
+            elif (self._write_pos == self._read_pos and
+                  len(self._queue) < self._max_entries):
+                self._queue.append((transaction_id, client_id, transaction))
+            else:
+                try:
+                    self._spill(_encode(transaction_id, client_id,
+                                        transaction))
+                except EnvironmentError as e:
+                    # Dropping the entry would leave a gap, so end the
+                    # subscription once the entries before it are delivered.
+                    _log.error("failed to write the spill file: %s", e)
+                    self._error = e
+            self._cond.notify_all()
+
+    def _spill(self, record):
+        if self._file is None:
+            fd, path = tempfile.mkstemp(prefix="dbeelog-spill-",
+                                        dir=self._directory)
+            try:
+                self._reader_fd = os.open(path, os.O_RDONLY)
+            except EnvironmentError:
+                os.close(fd)
+                raise
+            finally:
+                os.unlink(path)
+            self._file = os.fdopen(fd, "w+b")
+        self._file.seek(self._write_pos)
+        self._file.write(record)
+        self._write_pos += len(record)
+        metrics.increment("dbeelog.subscribe.spilled")
+
+    def _unspill(self, pos, end):
+        """Read up to _CHUNK entries back from the spill file.
+
+        Only reads the records between pos and end, which __call__() no
+        longer writes to, so this runs without holding the lock.
+
+        Returns:
+            (entries, position of the first record not read).
+        """
+        # A fresh buffer each time: the file is truncated and rewritten once
+        # it is drained, so data buffered by an earlier call may be stale.
+        reader = io.BufferedReader(io.FileIO(self._reader_fd, "rb",
+                                             closefd=False))
+        reader.seek(pos)
+        entries = []
+        while len(entries) < _CHUNK and pos < end:
+            kind, id_len, client_len, length = _RECORD.unpack(
+                reader.read(_RECORD.size))
+            data = reader.read(id_len + client_len + length)
+            transaction = data[id_len + client_len:]
+            if kind == b"t":
+                transaction = transaction.decode("utf-8")
+            elif kind == b"f":
+                transaction = memoryview(transaction)
+            entries.append((data[:id_len].decode("utf-8"),
+                            data[id_len:id_len + client_len].decode("utf-8"),
+                            transaction))
+            pos += _RECORD.size + len(data)
+        return entries, pos
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while (not self._closed and not self._queue and
+                       self._read_pos == self._write_pos and
+                       self._error is None):
+                    self._cond.wait()
+                if self._closed:
+                    return
+                entries = list(self._queue)
+                self._queue.clear()
+                pos, end = self._read_pos, self._write_pos
+                error = self._error
+            if not entries and pos < end:
+                # Entries in the file arrived after the ones that were in
+                # memory, which have all been delivered.
+                entries = self._read_spilled(pos, end)
+            elif not entries:
+                _invoke(self._receive_func, error, None, None, None)
+                return
+            for entry in entries:
+                if self._closed:
+                    return
+                _invoke(self._receive_func, None, *entry)
+
+    def _read_spilled(self, pos, end):
+        """Read entries back from the spill file, and drop them from it."""
+        try:
+            with self._cond:
+                self._file.flush()
+            entries, pos = self._unspill(pos, end)
+            with self._cond:
+                self._read_pos = pos
+                if self._read_pos == self._write_pos:
+                    # Drained: start over at the beginning of the file.
+                    self._read_pos = self._write_pos = 0
+                    self._file.truncate(0)
+            return entries
+        except (EnvironmentError, struct.error) as e:
+            _log.error("failed to read the spill file: %s", e)
+            with self._cond:
+                self._error = e
+                self._read_pos = self._write_pos = 0
+            return []
+
+
+class SpillingLog(base.Base):
+    """dbeelog.Base whose subscriptions spill to disk when they fall behind.
+
+    All the other operations are delegated to the underlying dbeelog.
+    """
+
+    def __init__(self, log, max_entries=DEFAULT_MAX_ENTRIES, directory=None):
+        """Constructor
+
+        Args:
+            log: dbeelog.Base to subscribe to.
+            max_entries: see SpillingReceiver.
+            directory: see SpillingReceiver.
+        """
+        super(SpillingLog, self).__init__(log.dbeelog_id, log.client_id,
+                                          log.min_checkpoints)
+        self._log = log
+        self._max_entries = max_entries
+        self._directory = directory
+        self._receiver = None
+
+    def close(self):
+        """Cancel the subscription of this client, if any."""
+        close = getattr(self._log, "close", None)
+        if close is not None:
+            close()
+        if self._receiver is not None:
+            self._receiver.close()
+            self._receiver = None
+
+    def append(self, transaction, callback):
+        self._log.append(transaction, callback)
+
+    def append_many(self, transactions, callback):
+        self._log.append_many(transactions, callback)
+
+    def subscribe(self, from_transaction_id, receive_func):
+        receiver = SpillingReceiver(receive_func, self._max_entries,
+                                    self._directory)
+        try:
+            result = self._log.subscribe(from_transaction_id, receiver)
+        except Exception:
+            receiver.close()
+            raise
+        if self._receiver is not None:
+            self._receiver.close()
+        self._receiver = receiver
+        return result
+
+    def checkpoint(self, transaction_id, callback):
+        self._log.checkpoint(transaction_id, callback)
+
+    def get_checkpoints(self, callback):
+        self._log.get_checkpoints(callback)
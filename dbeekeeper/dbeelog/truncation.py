@@ -0,0 +1,145 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Checkpoint-driven log truncation.
+
+Dbeelog must not truncate a transaction unless it has been checkpointed by
+min_checkpoints clients (see dbeelog.Base). Since a checkpoint covers all
+the transactions up to and including the checkpointed one, the newest
+transaction that may be truncated is the min_checkpoints-th most recent
+checkpoint. CheckpointTracker keeps the checkpoints sorted so that this
+point is available in constant time after each checkpoint, and Truncator
+removes the log below it in a background thread.
+"""
+
+import bisect
+import logging
+import threading
+
+
+_log = logging.getLogger(__name__)
+
+
+class CheckpointTracker(object):
+    """Checkpoints of all the clients of a dbeelog, kept in sorted order.
+
+    Checkpoints can be of any type that sorts in log order, such as
+    sequence numbers or fixed-width transaction ID strings.
+    """
+
+    def __init__(self, checkpoints=None):
+        """Constructor
+
+        Args:
+            checkpoints: initial map from client_id to checkpoint.
+        """
+        self._checkpoints = {}
+        self._sorted = []
+        for client_id, checkpoint in (checkpoints or {}).items():
+            self.update(client_id, checkpoint)
+
+    def __len__(self):
+        return len(self._checkpoints)
+
+    def update(self, client_id, checkpoint):
+        """Record a new checkpoint for client_id."""
+        old = self._checkpoints.get(client_id)
+        if old == checkpoint:
+            return
+        if old is not None:
+            del self._sorted[bisect.bisect_left(self._sorted, old)]
+        bisect.insort(self._sorted, checkpoint)
+        self._checkpoints[client_id] = checkpoint
+
+    def range(self):
+        """Return (oldest, newest) checkpoint, or None if there is none."""
+        if not self._sorted:
+            return None
+        return self._sorted[0], self._sorted[-1]
+
+    def truncation_point(self, min_checkpoints):
+        """Return the newest checkpoint shared by min_checkpoints clients.
+
+        Every transaction up to and including the returned checkpoint has
+        been checkpointed by at least min_checkpoints clients.
+
+        Returns:
+            The checkpoint, or None if fewer than min_checkpoints clients
+            have checkpointed or min_checkpoints is less than 1.
+        """
+        if min_checkpoints < 1 or len(self._sorted) < min_checkpoints:
+            return None
+        return self._sorted[-min_checkpoints]
+
+
+class Truncator(object):
+    """Background thread that truncates a log up to a moving point."""
+
+    def __init__(self, truncate_func, name="dbeelog-truncator"):
+        """Constructor
+
+        Args:
+            truncate_func:
+                Function to truncate the log. It takes a single argument, a
+                truncation point passed to advance(), and removes whatever
+                part of the log below that point it can. It is called from
+                the truncator thread, never concurrently.
+            name:
+                Name of the truncator thread.
+        """
+        self._truncate_func = truncate_func
+        self._cond = threading.Condition()
+        self._point = None
+        self._done = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def advance(self, point):
+        """Move the truncation point forward to point.
+
+        Points that don't move the truncation point forward are ignored.
+        Several advances that happen while a truncation is running are
+        coalesced into one.
+        """
+        if point is None:
+            return
+        with self._cond:
+            if self._point is None or point > self._point:
+                self._point = point
+                self._cond.notify()
+
+    def close(self):
+        """Stop the truncator thread after the pending truncation."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and self._point == self._done:
+                    self._cond.wait()
+                if self._point == self._done:
+                    return
+                point = self._point
+            try:
+                self._truncate_func(point)
+            except Exception:
+                _log.exception("failed to truncate log at %r", point)
+            with self._cond:
+                self._done = point
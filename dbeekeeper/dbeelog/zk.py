@@ -0,0 +1,646 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""dbeelog backed by ZooKeeper, using kazoo.
+
+Each transaction is stored as a sequential znode under
+
+    <root>/<dbeelog_id>/log/txn-<sequence>
+
+and the sequence number assigned by ZooKeeper is the transaction ID. Each
+client keeps its checkpoint in <root>/<dbeelog_id>/checkpoints/<client_id>.
+
+Appends are pipelined: up to max_in_flight multi-op transactions are
+outstanding at any time, and appends that arrive while the pipeline is full
+are coalesced into multi-op commits of up to batch_size creates. Use
+benchmark/harness.py to measure the defaults against an ensemble.
+
+Checkpoints are coalesced: a client has at most one write to its
+checkpoint znode outstanding, and the checkpoint() calls made meanwhile are
+all answered by the next write, which stores the newest transaction ID.
+
+get_checkpoints() is served from a cache of the checkpoints znodes. The
+cache is filled with watched reads, and dropped when a watch fires, so only
+the first call after a change goes to ZooKeeper. After each of its
+checkpoint writes, a client gets the checkpoints and deletes the log znodes
+below the truncation point in the background.
+"""
+
+import collections
+import functools
+import logging
+import struct
+import threading
+import time
+
+from kazoo.exceptions import KazooException
+from kazoo.exceptions import NoNodeError
+from kazoo.protocol.states import KazooState
+
+from . import base
+from . import truncation
+from .. import framing
+from .. import metrics
+from ..error import ClientError
+from ..error import DbeeLogError
+
+
+_log = logging.getLogger(__name__)
+
+_TEXT_TYPE = type(u"")
+
+# Types accepted as transactions: strings, and frames built with
+# dbeekeeper.framing.
+_TRANSACTION_TYPES = (_TEXT_TYPE, bytes, bytearray, memoryview)
+
+# Number of creates in a multi-op commit. Batched async commits are an order
+# of magnitude faster than individual creates in benchmark/harness.py.
+# Run it with --batch_size to tune this for a particular ensemble.
+DEFAULT_BATCH_SIZE = 100
+
+# Number of outstanding multi-op commits.
+DEFAULT_MAX_IN_FLIGHT = 16
+
+# ZooKeeper rejects requests larger than jute.maxbuffer, which defaults to
+# 1MB. Keep each multi-op commit well below that.
+MAX_BATCH_BYTES = 512 * 1024
+
+# Data header: client_id length.
+_HEADER = struct.Struct(">H")
+
+_PREFIX = "txn-"
+
+
+def format_transaction_id(seq):
+    """Format a znode sequence number as a transaction ID string."""
+    return "%010d" % seq
+
+
+def parse_transaction_id(transaction_id):
+    """Parse a transaction ID string into a znode sequence number.
+
+    Raises:
+        dbeekeeper.ClientError: transaction_id is malformed.
+    """
+    try:
+        seq = int(transaction_id)
+    except (TypeError, ValueError):
+        raise ClientError("malformed transaction id: %r" % (transaction_id,))
+    if seq < 0:
+        raise ClientError("malformed transaction id: %r" % (transaction_id,))
+    return seq
+
+
+def _to_bytes(s):
+    if not isinstance(s, _TEXT_TYPE):
+        return s
+    return s.encode("utf-8")
+
+
+def _to_str(b):
+    if str is bytes:
+        return b
+    return b.decode("utf-8")
+
+
+def _invoke(callback, *args):
+    try:
+        callback(*args)
+    except Exception:
+        _log.exception("dbeelog callback raised an exception")
+
+
+def _error(e):
+    if isinstance(e, (ClientError, DbeeLogError)):
+        return e
+    return DbeeLogError("zookeeper request failed: %r" % (e,))
+
+
+class ZkLog(base.Base):
+    """dbeelog.Base implementation on top of a kazoo client."""
+
+    def __init__(self, dbeelog_id, client_id, client, root="/dbeekeeper",
+                 min_checkpoints=3, batch_size=DEFAULT_BATCH_SIZE,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        """Constructor
+
+        Args:
+            dbeelog_id: see dbeelog.Base.
+            client_id: see dbeelog.Base. It must be a valid znode name.
+            client: started kazoo.client.KazooClient.
+            root: znode under which all the dbeelogs are stored.
+            min_checkpoints: see dbeelog.Base.
+            batch_size: maximum number of creates in a multi-op commit.
+            max_in_flight: maximum number of outstanding multi-op commits.
+
+        Raises:
+            kazoo.exceptions.KazooException: failed to create the znodes
+                for this dbeelog.
+        """
+        super(ZkLog, self).__init__(dbeelog_id, client_id, min_checkpoints)
+        self._client = client
+        self._batch_size = batch_size
+        self._max_in_flight = max_in_flight
+        self._path = "%s/%s" % (root.rstrip("/"), dbeelog_id)
+        self._log_path = self._path + "/log"
+        self._checkpoints_path = self._path + "/checkpoints"
+        self._checkpoint_path = "%s/%s" % (self._checkpoints_path, client_id)
+        self._client_header = (_HEADER.pack(len(_to_bytes(client_id))) +
+                               _to_bytes(client_id))
+
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        self._in_flight = 0
+        self._subscription = None
+        # Checkpoints waiting for the outstanding checkpoint write.
+        self._checkpoint_waiters = []
+        self._checkpoint_writing = False
+        # Cached checkpoints: the list of client IDs, or None if it isn't
+        # known, and a map from client ID to checkpoint. The generation is
+        # bumped by every watch that fires, so that a read that raced with
+        # a change isn't cached.
+        self._cached_clients = None
+        self._cached_values = {}
+        self._cache_generation = 0
+        self._tracker = truncation.CheckpointTracker()
+        self._truncator = truncation.Truncator(
+            self._truncate, name="dbeelog-truncator:%s" % self._path)
+
+        client.ensure_path(self._log_path)
+        client.ensure_path(self._checkpoint_path)
+        client.add_listener(self._on_state)
+
+    def close(self):
+        """Cancel the subscription of this client and stop truncating."""
+        if self._subscription is not None:
+            self._subscription.cancel()
+            self._subscription = None
+        self._truncator.close()
+        self._client.remove_listener(self._on_state)
+
+    def append(self, transaction, callback):
+        callback = metrics.timed("dbeelog.append.latency", callback)
+
+        def done(error, seqs):
+            if error is not None:
+                callback(error, None)
+            else:
+                metrics.increment("dbeelog.append.transactions")
+                callback(None, format_transaction_id(seqs[0]))
+        self._enqueue([transaction], done)
+
+    def append_many(self, transactions, callback):
+        """Append transactions as a contiguous range in one multi-op commit.
+        """
+        callback = metrics.timed("dbeelog.append.latency", callback)
+
+        def done(error, seqs):
+            if error is not None:
+                callback(error, None)
+            else:
+                metrics.increment("dbeelog.append.transactions", len(seqs))
+                callback(None, [format_transaction_id(s) for s in seqs])
+        transactions = list(transactions)
+        if not transactions:
+            _invoke(callback, None, [])
+            return
+        self._enqueue(transactions, done)
+
+    def _enqueue(self, transactions, callback):
+        for transaction in transactions:
+            if not isinstance(transaction, _TRANSACTION_TYPES):
+                _invoke(callback, ClientError(
+                    "transaction must be a string or a frame"), None)
+                return
+            try:
+                framing.check_transaction(transaction)
+            except ClientError as e:
+                _invoke(callback, e, None)
+                return
+        data = [self._client_header + _to_bytes(t) for t in transactions]
+        with self._lock:
+            self._pending.append((data, callback))
+        self._flush()
+
+    def _flush(self):
+        # commit_async() only queues the request, so it is called with the
+        # lock held to make the commit order match the append order.
+        with self._lock:
+            while self._pending and self._in_flight < self._max_in_flight:
+                batch = [self._pending.popleft()]
+                count = len(batch[0][0])
+                size = sum(len(d) for d in batch[0][0])
+                while self._pending:
+                    data = self._pending[0][0]
+                    if (count + len(data) > self._batch_size or
+                            size + sum(len(d) for d in data) >
+                            MAX_BATCH_BYTES):
+                        break
+                    batch.append(self._pending.popleft())
+                    count += len(data)
+                    size += sum(len(d) for d in data)
+
+                transaction = self._client.transaction()
+                for data, _ in batch:
+                    for d in data:
+                        transaction.create(self._log_path + "/" + _PREFIX, d,
+                                           sequence=True)
+                self._in_flight += 1
+                try:
+                    result = transaction.commit_async()
+                except Exception as e:
+                    self._in_flight -= 1
+                    for _, callback in batch:
+                        _invoke(callback, _error(e), None)
+                    continue
+                result.rawlink(functools.partial(self._on_commit, batch))
+
+    def _on_commit(self, batch, result):
+        try:
+            paths = result.get()
+            error = None
+            for path in paths:
+                if isinstance(path, Exception):
+                    error = _error(path)
+                    break
+        except Exception as e:
+            error = _error(e)
+
+        with self._lock:
+            self._in_flight -= 1
+        self._flush()
+
+        i = 0
+        for data, callback in batch:
+            if error is not None:
+                _invoke(callback, error, None)
+            else:
+                _invoke(callback, None, [_sequence(p)
+                                         for p in paths[i:i + len(data)]])
+            i += len(data)
+
+    def subscribe(self, from_transaction_id, receive_func):
+        seq = None
+        if from_transaction_id:
+            seq = parse_transaction_id(from_transaction_id)
+        try:
+            # Every entry created after this has a sequence number of at
+            # least stat.cversion.
+            stat = self._client.exists(self._log_path)
+            seqs = self._list()
+        except KazooException as e:
+            raise _error(e)
+        if stat is None:
+            raise DbeeLogError("%s does not exist" % self._log_path)
+        if seq is None:
+            seq = stat.cversion
+        elif seqs and seqs[0] > seq:
+            raise DbeeLogError("transaction %s has been truncated" %
+                               from_transaction_id)
+        if self._subscription is not None:
+            self._subscription.cancel()
+        self._subscription = _Subscription(
+            self, seq, [s for s in seqs if seq <= s < stat.cversion], stat,
+            receive_func)
+        self._subscription.start()
+        return True
+
+    def _list(self, watch=None):
+        children = self._client.get_children(self._log_path, watch=watch)
+        return sorted(_sequence(c) for c in children if c.startswith(_PREFIX))
+
+    def _entry_path(self, seq):
+        return "%s/%s%s" % (self._log_path, _PREFIX,
+                            format_transaction_id(seq))
+
+    def checkpoint(self, transaction_id, callback):
+        try:
+            parse_transaction_id(transaction_id)
+        except ClientError as e:
+            _invoke(callback, e, None)
+            return
+        with self._lock:
+            self._checkpoint_waiters.append((transaction_id, callback))
+            if self._checkpoint_writing:
+                return
+            self._checkpoint_writing = True
+        self._write_checkpoint()
+
+    def _write_checkpoint(self):
+        with self._lock:
+            waiters, self._checkpoint_waiters = self._checkpoint_waiters, []
+            if not waiters:
+                self._checkpoint_writing = False
+                return
+        if len(waiters) > 1:
+            metrics.increment("dbeelog.checkpoint.merged", len(waiters) - 1)
+        transaction_id = waiters[-1][0]
+        try:
+            result = self._client.set_async(self._checkpoint_path,
+                                            _to_bytes(transaction_id))
+        except Exception as e:
+            self._answer_checkpoints(waiters, _error(e))
+            return
+        result.rawlink(functools.partial(self._on_checkpoint, waiters))
+
+    def _on_checkpoint(self, waiters, result):
+        try:
+            result.get()
+            error = None
+        except Exception as e:
+            error = _error(e)
+        self._answer_checkpoints(waiters, error)
+
+    def _answer_checkpoints(self, waiters, error):
+        if error is None:
+            # The watch on our own checkpoint fires on another thread, so
+            # update the cache before anyone is told the write completed.
+            with self._lock:
+                self._cache_generation += 1
+                self._cached_values[self._client_id] = waiters[-1][0]
+        for transaction_id, callback in waiters:
+            if error is not None:
+                _invoke(callback, error, None)
+            else:
+                _invoke(callback, None, transaction_id)
+        if error is None:
+            self.get_checkpoints(self._on_checkpoints)
+        self._write_checkpoint()
+
+    def _on_checkpoints(self, error, checkpoints):
+        if error is not None:
+            _log.warning("failed to get checkpoints: %s", error)
+            return
+        with self._lock:
+            for client_id, transaction_id in checkpoints.items():
+                self._tracker.update(client_id, transaction_id)
+            point = self._tracker.truncation_point(self._min_checkpoints)
+            checkpoint_range = self._tracker.range()
+        if checkpoint_range is not None:
+            oldest, newest = checkpoint_range
+            metrics.set_gauge("dbeelog.checkpoint.spread",
+                              int(newest) - int(oldest))
+        self._truncator.advance(point)
+
+    def _truncate(self, transaction_id):
+        point = parse_transaction_id(transaction_id)
+        seqs = [s for s in self._list() if s < point]
+        for i in range(0, len(seqs), self._batch_size):
+            results = [self._client.delete_async(self._entry_path(s))
+                       for s in seqs[i:i + self._batch_size]]
+            for result in results:
+                try:
+                    result.get()
+                except NoNodeError:
+                    # Another client truncated it first.
+                    pass
+        if seqs:
+            # Deletes don't fire the watches subscriptions wait on.
+            self._client.set(self._log_path, b"")
+
+    def get_checkpoints(self, callback):
+        with self._lock:
+            clients = self._cached_clients
+            values = dict(self._cached_values)
+            generation = self._cache_generation
+
+        def got_children(result):
+            try:
+                clients = result.get()
+            except Exception as e:
+                callback(_error(e), None)
+                return
+            fetch(clients)
+
+        def fetch(clients):
+            # Only the checkpoints whose watch fired since they were cached
+            # are read again.
+            missing = [c for c in clients if c not in values]
+            if not missing:
+                store(clients, missing)
+                callback(None, checkpoints(clients))
+                return
+            _gather(self._client, ["%s/%s" % (self._checkpoints_path, c)
+                                   for c in missing],
+                    functools.partial(got_data, clients, missing),
+                    watch=self._on_checkpoint_changed)
+
+        def got_data(clients, missing, error, data):
+            if error is not None:
+                callback(error, None)
+                return
+            values.update(zip(missing, [_to_str(v) if v else None
+                                        for v in data]))
+            store(clients, missing)
+            callback(None, checkpoints(clients))
+
+        def store(clients, missing):
+            with self._lock:
+                if self._cache_generation != generation:
+                    return
+                self._cached_clients = list(clients)
+                for c in missing:
+                    self._cached_values[c] = values[c]
+
+        def checkpoints(clients):
+            return dict((c, values[c]) for c in clients
+                        if values[c] is not None)
+
+        if clients is None:
+            self._client.get_children_async(
+                self._checkpoints_path,
+                watch=self._on_clients_changed).rawlink(got_children)
+        elif all(c in values for c in clients):
+            metrics.increment("dbeelog.checkpoint.cached")
+            _invoke(callback, None, checkpoints(clients))
+        else:
+            fetch(clients)
+
+    def _on_state(self, state):
+        # Watches are lost with the session, without firing.
+        if state != KazooState.CONNECTED:
+            with self._lock:
+                self._cache_generation += 1
+                self._cached_clients = None
+                self._cached_values = {}
+        return False
+
+    def _on_clients_changed(self, event):
+        # The checkpoints of the remaining clients are still watched.
+        with self._lock:
+            self._cache_generation += 1
+            self._cached_clients = None
+
+    def _on_checkpoint_changed(self, event):
+        client_id = event.path.rsplit("/", 1)[-1]
+        with self._lock:
+            self._cache_generation += 1
+            self._cached_values.pop(client_id, None)
+
+
+def _sequence(path):
+    return int(path[-10:])
+
+
+def _gather(client, paths, callback, watch=None):
+    """Get data of all the znodes in paths in parallel.
+
+    callback is invoked with (error, values). The value of a znode that
+    doesn't exist is None. If watch is given, it is set on each znode.
+    """
+    lock = threading.Lock()
+    values = [None] * len(paths)
+    state = {"remaining": len(paths), "error": None}
+
+    def done(i, result):
+        error = None
+        try:
+            values[i] = result.get()[0]
+        except NoNodeError:
+            pass
+        except Exception as e:
+            error = _error(e)
+        with lock:
+            if error is not None:
+                state["error"] = error
+            state["remaining"] -= 1
+            if state["remaining"]:
+                return
+        if state["error"] is not None:
+            _invoke(callback, state["error"], None)
+        else:
+            _invoke(callback, None, values)
+
+    for i, path in enumerate(paths):
+        client.get_async(path, watch=watch).rawlink(
+            functools.partial(done, i))
+
+
+class _Subscription(threading.Thread):
+    """Thread that delivers log znodes to a receive_func.
+
+    Every create and every delete of a log znode bumps the cversion of the
+    log znode, and a new entry gets the cversion as its sequence number. So
+    the entries created since the subscription last looked have sequence
+    numbers between the old and the new cversion, and how many there are
+    follows from the two stats. While nothing is deleted, each of those
+    numbers is an entry that can be read directly; otherwise the log is
+    listed once to skip the numbers used up by deletes. An entry that was
+    created but is gone before it could be read has been truncated, and
+    ends the subscription with a DbeeLogError.
+
+    New entries are waited for with a watch on the next sequence number,
+    and truncations with a data watch on the log znode, which ZkLog sets
+    after deleting entries. Entries are read with up to window get
+    requests in flight.
+    """
+
+    def __init__(self, log, seq, seqs, stat, receive_func,
+                 window=DEFAULT_BATCH_SIZE):
+        """Constructor
+
+        Args:
+            log: ZkLog to read from.
+            seq: first sequence number to deliver.
+            seqs: sequence numbers of the entries to deliver first, from a
+                  listing taken after stat.
+            stat: stat of the log znode.
+            receive_func: see dbeelog.Base.subscribe().
+            window: maximum number of get requests in flight.
+        """
+        super(_Subscription, self).__init__(name="dbeelog-subscription")
+        self.daemon = True
+        self._log = log
+        self._start = seq
+        self._seqs = seqs
+        self._cversion = stat.cversion
+        self._children = stat.numChildren
+        self._receive_func = receive_func
+        self._window = window
+        self._changed = threading.Event()
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+        self._changed.set()
+
+    def run(self):
+        client = self._log._client
+        try:
+            self._read(self._seqs)
+            while not self._cancelled:
+                self._changed.clear()
+                stat = client.exists(self._log._log_path, watch=self._watch)
+                if stat is None:
+                    raise DbeeLogError("%s was deleted" % self._log._log_path)
+                if stat.cversion == self._cversion:
+                    path = self._log._entry_path(self._cversion)
+                    if client.exists(path, watch=self._watch) is None:
+                        self._changed.wait()
+                    continue
+                changes = stat.cversion - self._cversion
+                creates = (changes + stat.numChildren - self._children) // 2
+                if creates == changes:
+                    seqs = list(range(self._cversion, stat.cversion))
+                else:
+                    seqs = [s for s in self._log._list()
+                            if self._cversion <= s < stat.cversion]
+                    if len(seqs) < creates:
+                        raise DbeeLogError(
+                            "%d transactions were truncated before they "
+                            "were read" % (creates - len(seqs)))
+                self._read(seqs)
+                self._cversion = stat.cversion
+                self._children = stat.numChildren
+        except KazooException as e:
+            if not self._cancelled:
+                _invoke(self._receive_func, _error(e), None, None, None)
+        except DbeeLogError as e:
+            if not self._cancelled:
+                _invoke(self._receive_func, e, None, None, None)
+
+    def _read(self, seqs):
+        """Deliver the entries in seqs, which must all exist."""
+        client = self._log._client
+        for i in range(0, len(seqs), self._window):
+            chunk = seqs[i:i + self._window]
+            results = [client.get_async(self._log._entry_path(s))
+                       for s in chunk]
+            for seq, result in zip(chunk, results):
+                try:
+                    data, stat = result.get()
+                except NoNodeError:
+                    raise DbeeLogError("transaction %s has been truncated" %
+                                       format_transaction_id(seq))
+                if self._cancelled:
+                    return
+                if seq < self._start:
+                    continue
+                if metrics.registry.enabled:
+                    # ctime is set by the server, so the lag includes the
+                    # clock skew between the two.
+                    metrics.observe("dbeelog.subscribe.lag",
+                                    time.time() - stat.ctime / 1000.0)
+                self._deliver(seq, data)
+
+    def _watch(self, event):
+        self._changed.set()
+
+    def _deliver(self, seq, data):
+        client_len = _HEADER.unpack_from(data)[0]
+        client_id = data[_HEADER.size:_HEADER.size + client_len]
+        transaction = memoryview(data)[_HEADER.size + client_len:]
+        _invoke(self._receive_func, None, format_transaction_id(seq),
+                _to_str(client_id), framing.unpack_transaction(transaction))
@@ -42,3 +42,19 @@ class DbeeError(Exception):
     consistency of dbee. When a dbee throws a DbeeError, dbeekeeper
     goes into recovery.
     """
+
+
+class DbeeLogError(Exception):
+    """dbeelog error.
+
+    Dbeelog raises a DbeeLogError when it encounters a log-side errors.
+    Examples of log-side errors are:
+
+    - Failed to write or fsync a log segment.
+    - Corrupted log record.
+    - Operation on a closed log.
+
+    Log-side errors are passed to the callbacks of the operation that
+    encountered them. A subscription that receives a DbeeLogError is no
+    longer valid.
+    """
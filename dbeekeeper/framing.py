@@ -0,0 +1,143 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Binary envelope for transactions.
+
+A frame wraps a transaction payload, and optionally a header, with the
+lengths of both and a CRC32 of their bytes:
+
+    magic, header length, payload length, crc32, header, payload
+
+dbeelog.Base.append() accepts frames as bytes, bytearray or memoryview, and
+stores them as they are. Subscribers receive them back as memoryviews of the
+log's read buffer, so a frame reaches dbee.Base.execute() without being
+copied or re-encoded. The log verifies the CRC of each frame it reads and
+reports torn or corrupted frames as a DbeeLogError.
+
+The magic is not valid UTF-8, so a frame can never be mistaken for a string
+transaction. Logs keep delivering string transactions as strings, so they
+reject bytes that are neither a frame nor UTF-8 when they are appended.
+"""
+
+import struct
+import zlib
+
+from .error import ClientError
+from .error import DbeeLogError
+
+
+MAGIC = b"\xdb\xee"
+
+# Frame header: magic, header length, payload length, crc32.
+_FRAME = struct.Struct(">2sHII")
+
+_BUFFER_TYPES = (bytes, bytearray, memoryview)
+
+
+def encode(payload, header=b""):
+    """Build a frame.
+
+    Args:
+        payload: transaction payload in bytes.
+        header: optional header in bytes.
+
+    Returns:
+        The frame in bytes.
+    """
+    crc = zlib.crc32(payload, zlib.crc32(header)) & 0xffffffff
+    return b"".join([_FRAME.pack(MAGIC, len(header), len(payload), crc),
+                     header, payload])
+
+
+def is_frame(transaction):
+    """Return True if transaction is a frame rather than a string."""
+    return (isinstance(transaction, _BUFFER_TYPES) and
+            memoryview(transaction)[:len(MAGIC)].tobytes() == MAGIC)
+
+
+def check_transaction(transaction):
+    """Check that a transaction can be delivered back to subscribers.
+
+    Args:
+        transaction: transaction in string, or a frame.
+
+    Raises:
+        dbeekeeper.ClientError: transaction is bytes that are neither a frame
+            nor UTF-8.
+    """
+    if (str is bytes or not isinstance(transaction, _BUFFER_TYPES) or
+            is_frame(transaction)):
+        return
+    try:
+        memoryview(transaction).tobytes().decode("utf-8")
+    except UnicodeDecodeError:
+        raise ClientError("transaction must be a frame or UTF-8")
+
+
+def decode(frame, verify=True):
+    """Split a frame into its header and payload without copying them.
+
+    Args:
+        frame: frame in bytes, bytearray or memoryview.
+        verify: check the CRC of the frame.
+
+    Returns:
+        (header, payload) as memoryviews of frame.
+
+    Raises:
+        dbeekeeper.DbeeLogError: frame is torn or corrupted.
+    """
+    view = memoryview(frame)
+    if len(view) < _FRAME.size:
+        raise DbeeLogError("truncated frame")
+    magic, header_len, payload_len, crc = _FRAME.unpack_from(view)
+    if magic != MAGIC:
+        raise DbeeLogError("not a frame")
+    if len(view) != _FRAME.size + header_len + payload_len:
+        raise DbeeLogError("torn frame: expected %d bytes, got %d" %
+                           (_FRAME.size + header_len + payload_len,
+                            len(view)))
+    header = view[_FRAME.size:_FRAME.size + header_len]
+    payload = view[_FRAME.size + header_len:]
+    if verify and (zlib.crc32(payload, zlib.crc32(header)) & 0xffffffff !=
+                   crc):
+        raise DbeeLogError("corrupted frame: crc mismatch")
+    return header, payload
+
+
+def unpack_transaction(data):
+    """Turn a transaction read back from a log into what subscribers get.
+
+    Args:
+        data: stored transaction as bytes or memoryview.
+
+    Returns:
+        A memoryview of data if it is a frame, or the transaction in string
+        otherwise.
+
+    Raises:
+        dbeekeeper.DbeeLogError: data is a torn or corrupted frame, or is not
+            UTF-8.
+    """
+    if is_frame(data):
+        decode(data)
+        return memoryview(data)
+    data = memoryview(data).tobytes()
+    if str is bytes:
+        return data
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        raise DbeeLogError("transaction is neither a frame nor UTF-8")
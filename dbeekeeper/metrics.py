@@ -0,0 +1,294 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Counters, gauges and histograms for the hot paths of dbeekeeper.
+
+dbeelogs, dbees and the recovery driver report to the module-level
+registry. It is disabled by default, and every reporting function returns
+after a single attribute check until enable() is called, so instrumented
+code pays next to nothing when nobody is looking.
+
+    dbeelog.append.latency      seconds from append() to its callback
+    dbeelog.append.transactions transactions appended
+    dbeelog.subscribe.lag       seconds from append to delivery
+    dbeelog.subscribe.spilled   entries a slow subscriber spilled to disk
+    dbeelog.checkpoint.spread   transactions between the oldest and the
+                                newest checkpoint
+    dbeelog.checkpoint.merged   checkpoints persisted by another call's write
+    dbeelog.checkpoint.cached   get_checkpoints() calls served from a cache
+    dbee.execute.duration       seconds per execute() in execute_batch()
+    dbee.execute_batch.duration seconds per batch applied during replay
+    dbee.transactions           transactions applied during replay
+    dbee.snapshot.duration      seconds from snapshot() to its callback
+    dbee.snapshot.bytes         bytes written per snapshot
+    dbee.restore.duration       seconds per restore() during recovery
+    dbee.recovery.estimate      estimated seconds to replay the backlog
+                                since the last scheduled snapshot
+
+Histograms count values in buckets whose upper bounds double from
+HISTOGRAM_BASE. collect() returns the current values of all the metrics,
+and export() passes them to the registered sinks: FileSink appends them to
+a file as JSON lines, and MemorySink keeps the latest collection in process.
+An Exporter exports periodically from a background thread.
+"""
+
+import abc
+import io
+import json
+import logging
+import math
+import threading
+import time
+
+
+_log = logging.getLogger(__name__)
+
+# Upper bound of the first histogram bucket, in the unit of the values.
+HISTOGRAM_BASE = 1e-6
+
+DEFAULT_EXPORT_INTERVAL = 10.0
+
+
+class Counter(object):
+    """Monotonically increasing count."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = 0
+
+    def increment(self, n=1):
+        with self._lock:
+            self._value += n
+
+    def collect(self):
+        return self._value
+
+
+class Gauge(object):
+    """Last reported value."""
+
+    def __init__(self):
+        self._value = None
+
+    def set(self, value):
+        self._value = value
+
+    def collect(self):
+        return self._value
+
+
+class Histogram(object):
+    """Distribution of values in buckets that double in width."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._count = 0
+        self._sum = 0
+
+    def observe(self, value):
+        if value > HISTOGRAM_BASE:
+            bucket = math.frexp(value / HISTOGRAM_BASE)[1]
+        else:
+            bucket = 0
+        with self._lock:
+            self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+            self._count += 1
+            self._sum += value
+
+    def collect(self):
+        """Return count, sum and [upper bound, count] of non-empty buckets."""
+        with self._lock:
+            return {"count": self._count, "sum": self._sum,
+                    "buckets": [[HISTOGRAM_BASE * 2 ** b, n]
+                                for b, n in sorted(self._buckets.items())]}
+
+
+class Registry(object):
+    """Named metrics and the sinks they are exported to."""
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._sinks = []
+
+    def counter(self, name):
+        return self._get(name, Counter)
+
+    def gauge(self, name):
+        return self._get(name, Gauge)
+
+    def histogram(self, name):
+        return self._get(name, Histogram)
+
+    def add_sink(self, sink):
+        with self._lock:
+            self._sinks.append(sink)
+
+    def remove_sink(self, sink):
+        with self._lock:
+            self._sinks.remove(sink)
+
+    def collect(self):
+        """Return the current values of all the metrics.
+
+        Returns:
+            dict with "counters", "gauges" and "histograms", each a map from
+            metric name to its value.
+        """
+        with self._lock:
+            metrics = list(self._metrics.items())
+        result = {"counters": {}, "gauges": {}, "histograms": {}}
+        kinds = {Counter: "counters", Gauge: "gauges",
+                 Histogram: "histograms"}
+        for name, metric in metrics:
+            result[kinds[type(metric)]][name] = metric.collect()
+        return result
+
+    def export(self):
+        """Pass the current values of all the metrics to every sink."""
+        metrics = self.collect()
+        with self._lock:
+            sinks = list(self._sinks)
+        for sink in sinks:
+            try:
+                sink.export(metrics)
+            except Exception:
+                _log.exception("failed to export metrics to %r", sink)
+
+    def clear(self):
+        """Drop all the metrics."""
+        with self._lock:
+            self._metrics = {}
+
+    def _get(self, name, kind):
+        metric = self._metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(name, kind())
+        if not isinstance(metric, kind):
+            raise TypeError("metric %s is a %s" % (name,
+                                                   type(metric).__name__))
+        return metric
+
+
+class Sink(object):
+    """Abstract destination of exported metrics."""
+
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def export(self, metrics):
+        """Receive the result of Registry.collect()."""
+
+
+class FileSink(Sink):
+    """Append each export to a file as a line of JSON."""
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+
+    def export(self, metrics):
+        line = json.dumps({"time": time.time(), "metrics": metrics},
+                          sort_keys=True)
+        with self._lock:
+            with io.open(self._path, "ab") as f:
+                f.write(line.encode("utf-8") + b"\n")
+
+
+class MemorySink(Sink):
+    """Keep the latest export in process."""
+
+    def __init__(self):
+        self.metrics = None
+
+    def export(self, metrics):
+        self.metrics = metrics
+
+
+class Exporter(object):
+    """Background thread that exports a registry periodically."""
+
+    def __init__(self, interval=DEFAULT_EXPORT_INTERVAL,
+                 metrics_registry=None):
+        """Constructor
+
+        Args:
+            interval: seconds between two exports.
+            metrics_registry: Registry to export. Defaults to the
+                              module-level registry.
+        """
+        self._registry = metrics_registry or registry
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name="dbeekeeper-metrics")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        """Stop the thread after a last export."""
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self._registry.export()
+        self._registry.export()
+
+
+registry = Registry()
+
+
+def enable():
+    """Start recording metrics in the module-level registry."""
+    registry.enabled = True
+
+
+def disable():
+    """Stop recording metrics in the module-level registry."""
+    registry.enabled = False
+
+
+def increment(name, n=1):
+    if registry.enabled:
+        registry.counter(name).increment(n)
+
+
+def set_gauge(name, value):
+    if registry.enabled:
+        registry.gauge(name).set(value)
+
+
+def observe(name, value):
+    if registry.enabled:
+        registry.histogram(name).observe(value)
+
+
+def timed(name, callback):
+    """Wrap callback to observe the seconds until it is invoked.
+
+    Returns callback itself if the registry is disabled.
+    """
+    if not registry.enabled:
+        return callback
+    start = time.time()
+
+    def wrapper(*args):
+        registry.histogram(name).observe(time.time() - start)
+        return callback(*args)
+    return wrapper
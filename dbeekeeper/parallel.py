@@ -0,0 +1,210 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Execute non-conflicting transactions concurrently.
+
+A ParallelExecutor executes a batch of transactions on a pool of worker
+threads, and produces the same result as executing them one at a time in
+order. It asks the dbee for the key set of each transaction with
+dbee.Base.key_set(), and orders a transaction after every earlier one that
+writes a key it reads or writes, or reads a key it writes. A transaction
+without a key set is ordered after all the earlier transactions and before
+all the later ones. Everything else runs in whatever order the workers pick
+it up.
+
+Transactions whose dependencies have all been executed don't conflict
+with each other, so a worker takes a share of them at once and hands it to
+dbee.Base.execute_batch(). A dbee that applies batches at a lower cost, or
+records metrics there, gets the same treatment as on the serial path.
+execute_batch() has to release the GIL, for example to wait for I/O or in a
+C extension, for the pool to use more than one core. Worker processes would
+not help: the state of a dbee lives in the process that executes its
+transactions.
+"""
+
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+_log = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+
+# Sentinel that stops a worker thread.
+_STOP = object()
+
+
+def plan(key_sets):
+    """Build the dependency graph of a batch.
+
+    Args:
+        key_sets: list with the dbee.Base.key_set() of each transaction.
+
+    Returns:
+        (pending, dependents): for each transaction, the number of
+        transactions it waits for, and the list of transactions that wait
+        for it.
+    """
+    pending = [0] * len(key_sets)
+    dependents = [[] for _ in key_sets]
+    last_writer = {}
+    readers = {}
+    # Last transaction without a key set, and the transactions since then.
+    barrier = None
+    since_barrier = []
+    for i, key_set in enumerate(key_sets):
+        deps = set()
+        if barrier is not None:
+            deps.add(barrier)
+        if key_set is None:
+            deps.update(since_barrier)
+            barrier = i
+            since_barrier = []
+            last_writer = {}
+            readers = {}
+        else:
+            reads, writes = key_set
+            for key in reads:
+                if key in last_writer:
+                    deps.add(last_writer[key])
+            for key in writes:
+                if key in last_writer:
+                    deps.add(last_writer[key])
+                deps.update(readers.get(key, ()))
+            for key in reads:
+                readers.setdefault(key, []).append(i)
+            for key in writes:
+                last_writer[key] = i
+                readers[key] = []
+            since_barrier.append(i)
+        pending[i] = len(deps)
+        for dep in deps:
+            dependents[dep].append(i)
+    return pending, dependents
+
+
+class ParallelExecutor(object):
+    """Execute batches of transactions on a pool of worker threads."""
+
+    def __init__(self, dbee, workers=DEFAULT_WORKERS):
+        """Constructor
+
+        Args:
+            dbee: dbee.Base to execute transactions on. execute_batch() is
+                  the only caller of its execute() and execute_batch()
+                  until close() returns.
+            workers: number of worker threads.
+        """
+        self._dbee = dbee
+        self._queue = queue.Queue()
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work,
+                                      name="dbee-worker-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self):
+        """Stop the worker threads."""
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def execute_batch(self, transactions):
+        """Execute transactions with the result of executing them in order.
+
+        Same as dbee.Base.execute_batch(), except that when a transaction
+        raises a DbeeError, transactions after it that don't depend on it
+        may or may not have been executed as well. No more transactions are
+        started after the first error.
+        """
+        transactions = list(transactions)
+        if not transactions:
+            return []
+        pending, dependents = plan([self._dbee.key_set(t)
+                                    for t in transactions])
+        errors = [None] * len(transactions)
+        cond = threading.Condition()
+        # Transactions whose dependencies have all been executed.
+        ready = []
+        state = {"running": 0, "error": None}
+
+        def schedule(i):
+            state["running"] += 1
+            ready.append(i)
+            self._queue.put(run)
+
+        def run():
+            with cond:
+                if state["error"] is not None:
+                    # Drop what is left instead of starting it.
+                    state["running"] -= len(ready)
+                    del ready[:]
+                    if not state["running"]:
+                        cond.notify_all()
+                    return
+                # Leave a share for the other workers.
+                count = -(-len(ready) // len(self._threads))
+                batch = ready[:count]
+                del ready[:count]
+            if not batch:
+                return
+            try:
+                batch_errors = self._dbee.execute_batch(
+                    [transactions[i] for i in batch])
+            except Exception as e:
+                batch_errors = None
+                with cond:
+                    if state["error"] is None:
+                        state["error"] = e
+            with cond:
+                state["running"] -= len(batch)
+                if state["error"] is None:
+                    for i, error in zip(batch, batch_errors):
+                        errors[i] = error
+                        for j in dependents[i]:
+                            pending[j] -= 1
+                            if not pending[j]:
+                                schedule(j)
+                if not state["running"]:
+                    cond.notify_all()
+
+        with cond:
+            for i, count in enumerate(pending):
+                if not count:
+                    schedule(i)
+            while state["running"]:
+                cond.wait()
+        if state["error"] is not None:
+            raise state["error"]
+        return errors
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            try:
+                item()
+            except Exception:
+                _log.exception("dbee worker failed")
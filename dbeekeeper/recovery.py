@@ -0,0 +1,323 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Apply dbeelog transactions to a dbee in batches.
+
+A Replayer is a dbeelog receive_func. It queues the transactions it
+receives, and a single applier thread, the only thread that touches the
+dbee, passes them to dbee.Base.execute_batch() in batches of up to
+batch_size. While the applier is busy the queue fills up, so the batches
+grow with the backlog: replay after a restore runs in large batches, and
+live delivery in small ones. With more than one worker, each batch is
+executed by a parallel.ParallelExecutor, which runs the transactions that
+don't conflict concurrently.
+
+Snapshots taken with Replayer.snapshot() record a watermark, the ID of the
+last transaction executed before dbee.Base.snapshot() was called, in a
+metadata file next to the snapshot. Every transaction up to the watermark is
+definitely in the snapshot, so recover() subscribes from the watermark and
+drops the transactions up to and including it without executing them.
+Only the transactions that may or may not have made it into the fuzzy
+snapshot are executed again.
+"""
+
+import io
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from . import metrics
+from . import parallel
+from .error import ClientError
+from .error import DbeeError
+
+
+_log = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 1000
+
+# Sentinel that stops the applier thread.
+_STOP = object()
+
+# Marks a snapshot request in the applier queue.
+_SNAPSHOT = object()
+
+
+def metadata_path(filename):
+    """Return the path of the metadata file of a snapshot."""
+    return filename + ".meta"
+
+
+def read_watermark(filename):
+    """Return the watermark recorded for a snapshot, or None.
+
+    Raises:
+        dbeekeeper.DbeeError: the metadata file is corrupted.
+    """
+    try:
+        with io.open(metadata_path(filename), "rb") as f:
+            return json.loads(f.read().decode("utf-8"))["transaction_id"]
+    except EnvironmentError:
+        return None
+    except (ValueError, KeyError, TypeError) as e:
+        raise DbeeError("corrupted metadata for %s: %s" % (filename, e))
+
+
+def _write_watermark(filename, transaction_id):
+    path = metadata_path(filename)
+    tmp = path + ".tmp"
+    with io.open(tmp, "wb") as f:
+        f.write(json.dumps({"transaction_id": transaction_id}).encode("utf-8"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+
+class Replayer(object):
+    """Feed transactions received from a dbeelog to a dbee in batches."""
+
+    def __init__(self, dbee, batch_size=DEFAULT_BATCH_SIZE, watermark=None,
+                 workers=1):
+        """Constructor
+
+        Args:
+            dbee: dbee.Base to execute transactions on. Once the Replayer is
+                  created, no other thread may access the dbee until
+                  close() returns.
+            batch_size: maximum number of transactions passed to a single
+                        execute_batch() call.
+            watermark: ID of the last transaction the dbee is known to
+                       contain. Transactions up to and including it are
+                       dropped.
+            workers: number of threads to execute each batch with. With
+                     more than one, non-conflicting transactions are
+                     executed concurrently by a parallel.ParallelExecutor.
+        """
+        self._dbee = dbee
+        self._executor = None
+        if workers > 1:
+            self._executor = parallel.ParallelExecutor(dbee, workers)
+        self._batch_size = batch_size
+        self._watermark = watermark
+        self._queue = queue.Queue(4 * batch_size)
+        self._cond = threading.Condition()
+        self._last = watermark
+        self._error = None
+        self._applied = 0
+        self._execute_time = 0.0
+        self._thread = threading.Thread(target=self._run,
+                                        name="dbee-replayer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def last_transaction_id(self):
+        """ID of the last transaction executed, or None."""
+        with self._cond:
+            return self._last
+
+    @property
+    def stats(self):
+        """(transactions executed, seconds spent in execute_batch())."""
+        with self._cond:
+            return self._applied, self._execute_time
+
+    @property
+    def error(self):
+        """Error that stopped the Replayer, or None."""
+        with self._cond:
+            return self._error
+
+    def __call__(self, error, transaction_id, client_id, transaction):
+        """dbeelog receive_func. See dbeelog.Base.subscribe()."""
+        if error is not None:
+            self._queue.put((error, None, None))
+        elif self._watermark is None or transaction_id > self._watermark:
+            self._queue.put((None, transaction_id, transaction))
+
+    def snapshot(self, filename, callback):
+        """Take a snapshot of the dbee and record its watermark.
+
+        The snapshot is started from the applier thread between two
+        batches. See dbee.Base.snapshot() for the arguments.
+        """
+        self._queue.put((_SNAPSHOT, filename, callback))
+
+    def wait(self, transaction_id, timeout=None):
+        """Block until transaction_id has been executed.
+
+        Transaction IDs are compared as strings, so the dbeelog must use
+        transaction IDs that sort in log order.
+
+        Returns:
+            True if transaction_id has been executed, False on timeout.
+
+        Raises:
+            The error that stopped the Replayer.
+        """
+        with self._cond:
+            while ((self._last is None or self._last < transaction_id) and
+                   self._error is None):
+                if not self._wait(timeout):
+                    return False
+            if self._error is not None:
+                raise self._error
+            return True
+
+    def close(self):
+        """Execute the queued transactions and stop the applier thread."""
+        self._queue.put(_STOP)
+        self._thread.join()
+        if self._executor is not None:
+            self._executor.close()
+
+    def _wait(self, timeout):
+        if timeout is None:
+            self._cond.wait()
+            return True
+        # Condition.wait() only reports timeouts on Python 3.2+, so check
+        # the elapsed time instead.
+        start = time.time()
+        self._cond.wait(timeout)
+        return time.time() - start < timeout
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            batch = []
+            while item is not _STOP and item[0] is None:
+                batch.append(item)
+                if len(batch) >= self._batch_size:
+                    item = None
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    item = None
+                    break
+            error = self._apply(batch)
+            if error is None and item is not None and item is not _STOP:
+                if item[0] is _SNAPSHOT:
+                    self._snapshot(item[1], item[2])
+                else:
+                    # The subscription is no longer valid.
+                    error = item[0]
+            if error is not None:
+                with self._cond:
+                    self._error = error
+                    self._cond.notify_all()
+                break
+            if item is _STOP:
+                return
+        # Keep draining the queue so that the subscription doesn't block
+        # until close() is called.
+        while item is not _STOP:
+            item = self._queue.get()
+
+    def _snapshot(self, filename, callback):
+        watermark = self._last
+
+        def done(error, filename):
+            if error is None:
+                try:
+                    _write_watermark(filename, watermark)
+                except EnvironmentError as e:
+                    error = DbeeError("failed to write metadata for %s: %s" %
+                                      (filename, e))
+                    filename = None
+            callback(error, filename)
+        self._dbee.snapshot(filename, done)
+
+    def _apply(self, batch):
+        """Execute a batch. Returns the DbeeError it failed with, if any."""
+        if not batch:
+            return None
+        start = time.time()
+        execute_batch = self._dbee.execute_batch
+        if self._executor is not None:
+            execute_batch = self._executor.execute_batch
+        try:
+            results = execute_batch([t for _, _, t in batch])
+        except DbeeError as e:
+            _log.error("dbee failed during replay: %s", e)
+            return e
+        elapsed = time.time() - start
+        metrics.observe("dbee.execute_batch.duration", elapsed)
+        metrics.increment("dbee.transactions", len(batch))
+        for (_, transaction_id, _), result in zip(batch, results):
+            if result is not None:
+                # ClientErrors don't affect the consistency of the dbee, and
+                # the client already got them when the transaction was
+                # first executed.
+                _log.debug("transaction %s failed: %s", transaction_id,
+                           result)
+        with self._cond:
+            self._last = batch[-1][1]
+            self._applied += len(batch)
+            self._execute_time += elapsed
+            self._cond.notify_all()
+        return None
+
+
+def recover(dbee, log, snapshot_filename, from_transaction_id=None,
+            batch_size=DEFAULT_BATCH_SIZE, workers=1):
+    """Restore a dbee from a snapshot and replay the log since then.
+
+    Args:
+        dbee: dbee.Base to recover.
+        log: dbeelog.Base to replay. Its subscription is taken over by the
+             returned Replayer.
+        snapshot_filename: snapshot to restore, or None to replay onto the
+                           dbee as it is.
+        from_transaction_id: transaction ID to subscribe from. Defaults to
+                             the watermark of the snapshot.
+        batch_size: see Replayer.
+        workers: see Replayer.
+
+    Returns:
+        Replayer that keeps applying transactions as they are appended to
+        the log. Call its wait() method to wait for a transaction to be
+        applied.
+
+    Raises:
+        dbeekeeper.ClientError: from_transaction_id is not given and the
+            snapshot has no watermark.
+        dbeekeeper.DbeeError: failed to restore the snapshot.
+        See dbeelog.Base.subscribe().
+    """
+    watermark = None
+    if snapshot_filename is not None:
+        watermark = read_watermark(snapshot_filename)
+        start = time.time()
+        dbee.restore(snapshot_filename)
+        metrics.observe("dbee.restore.duration", time.time() - start)
+    if from_transaction_id is None:
+        if watermark is None:
+            raise ClientError("no transaction ID to replay the log from")
+        from_transaction_id = watermark
+    replayer = Replayer(dbee, batch_size, watermark, workers)
+    try:
+        log.subscribe(from_transaction_id, replayer)
+    except Exception:
+        replayer.close()
+        raise
+    return replayer
@@ -0,0 +1,208 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Schedule snapshots to bound the time recovery takes.
+
+Recovery restores the latest snapshot and replays the transactions since
+its watermark, so the replay part of recovery grows with the number of
+transactions executed since the last snapshot. Rather than snapshotting at
+a fixed interval, a SnapshotScheduler watches a recovery.Replayer and
+estimates how long replaying its backlog would take:
+
+    (backlog + arrival rate * snapshot duration) / execute rate
+
+The execute rate is the number of transactions the dbee executes per second
+of execute_batch(), and the arrival rate the number of transactions
+executed per second of wall-clock time, both smoothed over recent ticks.
+Transactions keep arriving while a snapshot is being taken, so the backlog
+a snapshot leaves behind grows with how long recent snapshots took.
+
+When the estimate reaches max_recovery_time, the scheduler takes a snapshot
+with Replayer.snapshot() and, once it succeeds, checkpoints the dbeelog at
+the watermark of the snapshot so that the log can be truncated. At most one
+snapshot runs at a time; see dbee.Base.snapshot().
+"""
+
+import functools
+import logging
+import threading
+import time
+
+from . import metrics
+from . import recovery
+from .error import DbeeError
+
+
+_log = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 1.0
+
+DEFAULT_MIN_SNAPSHOT_INTERVAL = 10.0
+
+# Weight of the latest measurement in the smoothed rates and durations.
+_SMOOTHING = 0.3
+
+
+def _smooth(average, value):
+    if average is None:
+        return value
+    return average + _SMOOTHING * (value - average)
+
+
+class SnapshotScheduler(object):
+    """Take snapshots of a Replayer's dbee to bound recovery time."""
+
+    def __init__(self, replayer, log, filename_func, max_recovery_time,
+                 min_snapshot_interval=DEFAULT_MIN_SNAPSHOT_INTERVAL,
+                 interval=DEFAULT_INTERVAL, clock=time.time):
+        """Constructor
+
+        Args:
+            replayer: recovery.Replayer whose dbee to snapshot.
+            log: dbeelog.Base to checkpoint after each snapshot.
+            filename_func: function that returns the filename for the next
+                           snapshot.
+            max_recovery_time: seconds the replay part of recovery should
+                               not exceed.
+            min_snapshot_interval: minimum seconds between the start of two
+                                   snapshots.
+            interval: seconds between two estimates in the thread started
+                      by start().
+            clock: function that returns the current time in seconds.
+        """
+        self._replayer = replayer
+        self._log = log
+        self._filename_func = filename_func
+        self._max_recovery_time = max_recovery_time
+        self._min_snapshot_interval = min_snapshot_interval
+        self._interval = interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._snapshotting = False
+        self._last_start = None
+        self._snapshot_duration = 0.0
+        self._execute_rate = None
+        self._arrival_rate = None
+        self._last_tick = None
+        # Transactions executed when the last snapshot was requested.
+        self._base = replayer.stats[0]
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def snapshotting(self):
+        """True from a snapshot until the checkpoint that follows it."""
+        with self._lock:
+            return self._snapshotting
+
+    def start(self):
+        """Start estimating every interval seconds in a background thread."""
+        self._thread = threading.Thread(target=self._run,
+                                        name="dbee-snapshot-scheduler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        """Stop the background thread. A running snapshot still finishes."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def estimate(self):
+        """Return the estimated replay time in seconds, or None if the
+        execute rate hasn't been measured yet."""
+        with self._lock:
+            return self._estimate(self._replayer.stats[0])
+
+    def tick(self):
+        """Update the estimate, and start a snapshot if it's due.
+
+        Returns:
+            True if a snapshot was started.
+        """
+        now = self._clock()
+        applied, execute_time = self._replayer.stats
+        with self._lock:
+            if self._last_tick is not None:
+                last_time, last_applied, last_execute_time = self._last_tick
+                count = applied - last_applied
+                if count > 0 and execute_time > last_execute_time:
+                    self._execute_rate = _smooth(
+                        self._execute_rate,
+                        count / (execute_time - last_execute_time))
+                if now > last_time:
+                    self._arrival_rate = _smooth(
+                        self._arrival_rate, count / (now - last_time))
+            self._last_tick = (now, applied, execute_time)
+            estimate = self._estimate(applied)
+            if estimate is not None:
+                metrics.set_gauge("dbee.recovery.estimate", estimate)
+            if (estimate is None or estimate < self._max_recovery_time or
+                    self._snapshotting or
+                    self._last_start is not None and
+                    now - self._last_start < self._min_snapshot_interval):
+                return False
+            self._snapshotting = True
+            self._last_start = now
+            base = applied
+        filename = self._filename_func()
+        _log.info("taking snapshot %s, estimated replay time %.1fs",
+                  filename, estimate)
+        self._replayer.snapshot(filename, functools.partial(
+            self._on_snapshot, now, base))
+        return True
+
+    def _estimate(self, applied):
+        if not self._execute_rate:
+            return None
+        backlog = applied - self._base
+        if self._arrival_rate:
+            backlog += self._arrival_rate * self._snapshot_duration
+        return backlog / self._execute_rate
+
+    def _on_snapshot(self, start, base, error, filename):
+        if error is not None:
+            _log.error("scheduled snapshot failed: %s", error)
+            with self._lock:
+                self._snapshotting = False
+            return
+        with self._lock:
+            self._snapshot_duration = _smooth(
+                self._snapshot_duration or None, self._clock() - start)
+            self._base = base
+        try:
+            watermark = recovery.read_watermark(filename)
+        except DbeeError as e:
+            _log.error("failed to read the watermark of %s: %s", filename, e)
+            watermark = None
+        if watermark is None:
+            self._on_checkpoint(None, None, None)
+            return
+        self._log.checkpoint(watermark, functools.partial(
+            self._on_checkpoint, watermark))
+
+    def _on_checkpoint(self, watermark, error, transaction_id):
+        if error is not None:
+            _log.error("failed to checkpoint at %s: %s", watermark, error)
+        with self._lock:
+            self._snapshotting = False
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            try:
+                self.tick()
+            except Exception:
+                _log.exception("snapshot scheduler failed")
@@ -0,0 +1,382 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Ship snapshots between nodes to bootstrap new replicas.
+
+A SnapshotServer serves the latest snapshot a node published: the files of
+the snapshot and the metadata file with its watermark (see
+dbeekeeper.recovery). fetch() downloads them from a peer, and bootstrap()
+restores the downloaded snapshot and replays the log from its watermark, so
+a new replica neither replays the whole log nor needs snapshot files copied
+to it by hand.
+
+The protocol runs over a stream socket, TCP or Unix. The client sends one
+JSON request per line, and the server answers with one JSON line:
+
+    {"op": "list"}
+        {"snapshot": name, "files": [{"name", "size", "crc32"}, ...]}
+    {"op": "get", "name": name, "offset": offset, "length": length}
+        {"length": length}, followed by that many bytes of the file
+
+or {"error": message}. File contents are sent with os.sendfile() where it
+is available, so they go from the page cache to the socket without being
+copied through the server process. Files are downloaded in chunks into
+.part files; a download that fails resumes at the end of its .part file,
+and each file is checked against its CRC32 before it is renamed into
+place. The metadata file is renamed last, so a snapshot only has a
+watermark once all its files are complete.
+"""
+
+import errno
+import io
+import json
+import logging
+import os
+import socket
+import threading
+import zlib
+
+from . import recovery
+from .error import DbeeError
+
+
+_log = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+DEFAULT_RETRIES = 3
+
+_READ_SIZE = 64 * 1024
+
+
+def _crc32(filename):
+    crc = 0
+    with io.open(filename, "rb") as f:
+        while True:
+            data = f.read(_READ_SIZE)
+            if not data:
+                return crc & 0xffffffff
+            crc = zlib.crc32(data, crc)
+
+
+def _family(address):
+    if isinstance(address, tuple):
+        return socket.AF_INET6 if ":" in address[0] else socket.AF_INET
+    return socket.AF_UNIX
+
+
+def _no_delay(sock):
+    # Requests and response headers are small writes that Nagle's
+    # algorithm would hold back until the peer's delayed ACK.
+    if sock.family != getattr(socket, "AF_UNIX", None):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def _send_line(sock, message):
+    sock.sendall(json.dumps(message).encode("utf-8") + b"\n")
+
+
+def _read_line(f):
+    line = f.readline()
+    if not line.endswith(b"\n"):
+        raise EnvironmentError("connection closed")
+    return json.loads(line.decode("utf-8"))
+
+
+def _send_file(sock, f, offset, length):
+    sendfile = getattr(os, "sendfile", None)
+    if sendfile is not None:
+        start = offset
+        try:
+            while length > 0:
+                sent = sendfile(sock.fileno(), f.fileno(), offset, length)
+                if not sent:
+                    raise EnvironmentError("file is shorter than expected")
+                offset += sent
+                length -= sent
+            return
+        except OSError as e:
+            unsupported = (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP)
+            if offset != start or e.errno not in unsupported:
+                raise
+            # Nothing was sent yet: this file or socket doesn't support
+            # sendfile(), so copy it instead.
+    f.seek(offset)
+    while length > 0:
+        data = f.read(min(length, _READ_SIZE))
+        if not data:
+            raise EnvironmentError("file is shorter than expected")
+        sock.sendall(data)
+        length -= len(data)
+
+
+class SnapshotServer(object):
+    """Serve the latest published snapshot to peers."""
+
+    def __init__(self, address=("127.0.0.1", 0)):
+        """Constructor
+
+        Args:
+            address: address to listen on, a (host, port) tuple or the path
+                     of a Unix socket. Port 0 picks a free port; see
+                     the address property.
+        """
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._files = {}
+        self._sock = socket.socket(_family(address), socket.SOCK_STREAM)
+        if isinstance(address, tuple):
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(address)
+        self._sock.listen(16)
+        self._closed = False
+        self._thread = threading.Thread(target=self._accept,
+                                        name="snapshot-server")
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def address(self):
+        return self._sock.getsockname()
+
+    def publish(self, filename, files=None):
+        """Serve the snapshot in filename from now on.
+
+        The CRC32 of each file is computed here, so call this from the
+        thread that completed the snapshot rather than from a latency
+        sensitive one. The files must not change while they are published.
+
+        Args:
+            filename: snapshot file, as passed to the dbee.Base.snapshot()
+                      callback.
+            files: all the files the snapshot consists of, in the same
+                   directory as filename. Defaults to [filename]. The
+                   metadata file with the watermark is added if it exists.
+
+        Raises:
+            EnvironmentError: failed to read the files.
+        """
+        directory = os.path.dirname(filename)
+        files = list(files or [filename])
+        meta = recovery.metadata_path(filename)
+        if os.path.exists(meta):
+            files.append(meta)
+        entries = {}
+        for path in files:
+            if os.path.dirname(path) != directory:
+                raise ValueError("%s is not in %s" % (path, directory))
+            entries[os.path.basename(path)] = (
+                path, os.path.getsize(path), _crc32(path))
+        with self._lock:
+            self._snapshot = os.path.basename(filename)
+            self._files = entries
+
+    def close(self):
+        """Stop accepting connections."""
+        self._closed = True
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._sock.close()
+        self._thread.join()
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                conn, _ = self._sock.accept()
+            except (socket.error, OSError):
+                if self._closed:
+                    return
+                _log.exception("failed to accept a connection")
+                continue
+            thread = threading.Thread(target=self._serve, args=(conn,),
+                                      name="snapshot-server-connection")
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn):
+        try:
+            _no_delay(conn)
+            f = conn.makefile("rb")
+            while True:
+                line = f.readline()
+                if not line:
+                    return
+                try:
+                    request = json.loads(line.decode("utf-8"))
+                    self._handle(conn, request)
+                except (ValueError, KeyError, TypeError) as e:
+                    _send_line(conn, {"error": "bad request: %s" % e})
+        except EnvironmentError as e:
+            _log.debug("snapshot transfer failed: %s", e)
+        finally:
+            conn.close()
+
+    def _handle(self, conn, request):
+        with self._lock:
+            snapshot = self._snapshot
+            files = self._files
+        if snapshot is None:
+            _send_line(conn, {"error": "no snapshot published"})
+            return
+        if request["op"] == "list":
+            _send_line(conn, {"snapshot": snapshot, "files": [
+                {"name": name, "size": size, "crc32": crc}
+                for name, (_, size, crc) in sorted(files.items())]})
+            return
+        if request["op"] != "get":
+            _send_line(conn, {"error": "unknown op: %s" % request["op"]})
+            return
+        entry = files.get(request["name"])
+        if entry is None:
+            _send_line(conn, {"error": "%s is not published" %
+                              request["name"]})
+            return
+        path, size, _ = entry
+        offset = int(request["offset"])
+        length = max(0, min(int(request["length"]), size - offset))
+        with io.open(path, "rb") as source:
+            _send_line(conn, {"length": length})
+            _send_file(conn, source, offset, length)
+
+
+class _Connection(object):
+
+    def __init__(self, address, timeout):
+        self._sock = socket.socket(_family(address), socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(address)
+        _no_delay(self._sock)
+        self._file = self._sock.makefile("rb")
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+    def request(self, message):
+        _send_line(self._sock, message)
+        response = _read_line(self._file)
+        if "error" in response:
+            raise DbeeError("peer failed: %s" % response["error"])
+        return response
+
+    def read_into(self, f, length):
+        while length > 0:
+            data = self._file.read(min(length, _READ_SIZE))
+            if not data:
+                raise EnvironmentError("connection closed")
+            f.write(data)
+            length -= len(data)
+
+
+def _download(conn, directory, entry, chunk_size):
+    """Download a file into its .part file and return the .part path."""
+    name = entry["name"]
+    part = os.path.join(directory, name + ".part")
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    if offset > entry["size"]:
+        os.remove(part)
+        offset = 0
+    with io.open(part, "ab") as f:
+        while offset < entry["size"]:
+            length = conn.request({"op": "get", "name": name,
+                                   "offset": offset,
+                                   "length": chunk_size})["length"]
+            if not length:
+                raise DbeeError("peer sent no data for %s" % name)
+            conn.read_into(f, length)
+            f.flush()
+            offset += length
+        os.fsync(f.fileno())
+    if _crc32(part) != entry["crc32"]:
+        os.remove(part)
+        raise DbeeError("checksum mismatch in %s" % name)
+    return part
+
+
+def fetch(address, directory, chunk_size=DEFAULT_CHUNK_SIZE,
+          retries=DEFAULT_RETRIES, timeout=60):
+    """Download the latest snapshot of a peer into directory.
+
+    Interrupted downloads resume where they stopped, including across
+    calls, as long as the peer still publishes the same files.
+
+    Args:
+        address: address of the peer's SnapshotServer.
+        directory: directory to store the snapshot in.
+        chunk_size: maximum number of bytes per get request.
+        retries: number of times to reconnect after a failure.
+        timeout: socket timeout in seconds.
+
+    Returns:
+        Path of the downloaded snapshot file.
+
+    Raises:
+        dbeekeeper.DbeeError: the download failed after all the retries.
+    """
+    attempt = 0
+    while True:
+        try:
+            return _fetch(address, directory, chunk_size, timeout)
+        except (EnvironmentError, DbeeError, ValueError) as e:
+            if attempt >= retries:
+                raise DbeeError("failed to fetch a snapshot from %s: %s" %
+                                (address, e))
+            attempt += 1
+            _log.warning("snapshot download failed, retrying: %s", e)
+
+
+def _fetch(address, directory, chunk_size, timeout):
+    conn = _Connection(address, timeout)
+    try:
+        listing = conn.request({"op": "list"})
+        snapshot = listing["snapshot"]
+        entries = listing["files"]
+        for entry in entries:
+            if os.path.basename(entry["name"]) != entry["name"]:
+                raise DbeeError("peer sent a bad file name: %r" %
+                                entry["name"])
+        meta = recovery.metadata_path(snapshot)
+        # The metadata file goes last; it marks the snapshot complete.
+        entries.sort(key=lambda e: e["name"] == meta)
+        parts = [(_download(conn, directory, e, chunk_size), e["name"])
+                 for e in entries]
+    finally:
+        conn.close()
+    for part, name in parts:
+        os.rename(part, os.path.join(directory, name))
+    return os.path.join(directory, snapshot)
+
+
+def bootstrap(dbee, log, address, directory, **kwargs):
+    """Fetch a peer's snapshot, restore it, and replay the log since then.
+
+    Args:
+        dbee: dbee.Base to bootstrap.
+        log: dbeelog.Base to replay.
+        address: address of the peer's SnapshotServer.
+        directory: directory to store the snapshot in.
+        kwargs: passed to recovery.recover().
+
+    Returns:
+        recovery.Replayer, see recovery.recover().
+
+    Raises:
+        dbeekeeper.DbeeError: failed to fetch or restore the snapshot.
+        dbeekeeper.ClientError: the snapshot has no watermark.
+    """
+    filename = fetch(address, directory)
+    return recovery.recover(dbee, log, filename, **kwargs)
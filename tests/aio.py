@@ -0,0 +1,109 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import dbeekeeper
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from dbeekeeper.dbee import memory
+from dbeekeeper.dbeelog import local
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    from dbeekeeper import aio
+
+
+@unittest.skipIf(sys.version_info < (3, 5), "requires asyncio")
+class Aio(unittest.TestCase):
+    """Await dbeelog and dbee operations from an event loop."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal = local.Journal(os.path.join(self.directory, "log"))
+        self.loop = asyncio.new_event_loop()
+        self.log = aio.AsyncLog(local.LocalLog("log", "client1",
+                                               self.journal), self.loop)
+
+    def tearDown(self):
+        self.log.close()
+        self.journal.close()
+        self.loop.close()
+        shutil.rmtree(self.directory)
+
+    def run_until_complete(self, future):
+        return self.loop.run_until_complete(
+            asyncio.wait_for(future, 10))
+
+    def test_append(self):
+        txid = self.run_until_complete(self.log.append("t0"))
+        txids = self.run_until_complete(self.log.append_many(["t1", "t2"]))
+        self.assertEqual(sorted([txid] + txids), [txid] + txids)
+        self.assertRaises(dbeekeeper.ClientError, self.run_until_complete,
+                          self.log.append(42))
+
+    def test_running_loop(self):
+        log = aio.AsyncLog(self.log.log)
+        dbee = aio.AsyncDbee(memory.MemoryDbee())
+        if hasattr(asyncio, "get_running_loop"):
+            self.assertRaises(RuntimeError, log.append, "t0")
+        started = self.loop.create_future()
+        filename = os.path.join(self.directory, "snapshot")
+        self.loop.call_soon(lambda: started.set_result(
+            (log.append("t0"), dbee.snapshot(filename))))
+        append, snapshot = self.run_until_complete(started)
+        self.assertEqual(self.run_until_complete(append),
+                         local.format_transaction_id(1))
+        self.assertEqual(self.run_until_complete(snapshot), filename)
+
+    def test_checkpoint(self):
+        txid = self.run_until_complete(self.log.append("t0"))
+        self.assertEqual(self.run_until_complete(self.log.checkpoint(txid)),
+                         txid)
+        self.assertEqual(self.run_until_complete(self.log.get_checkpoints()),
+                         {"client1": txid})
+
+    def test_subscribe(self):
+        txids = self.run_until_complete(
+            self.log.append_many(["t%d" % i for i in range(100)]))
+        subscription = self.log.subscribe(txids[0], maxsize=8)
+        self.assertIs(subscription.__aiter__(), subscription)
+        received = [self.run_until_complete(subscription.__anext__())
+                    for _ in range(100)]
+        self.assertEqual([r[0] for r in received], txids)
+        self.assertEqual([r[2] for r in received],
+                         ["t%d" % i for i in range(100)])
+
+        # The next entry arrives after the consumer started waiting.
+        future = subscription.__anext__()
+        self.loop.call_soon(self.log.append, "t100")
+        self.assertEqual(self.run_until_complete(future)[2], "t100")
+
+        future = subscription.__anext__()
+        subscription.close()
+        self.assertRaises(StopAsyncIteration, self.run_until_complete,
+                          future)
+
+    def test_snapshot(self):
+        dbee = memory.MemoryDbee()
+        dbee.execute(memory.put("a", "1"))
+        filename = os.path.join(self.directory, "snapshot")
+        self.assertEqual(self.run_until_complete(
+            aio.AsyncDbee(dbee, self.loop).snapshot(filename)), filename)
+        restored = memory.MemoryDbee()
+        restored.restore(filename)
+        self.assertEqual(restored.get("a"), "1")
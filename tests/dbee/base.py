@@ -0,0 +1,57 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import dbeekeeper
+import unittest
+
+from dbeekeeper import dbee
+
+
+class ListDbee(dbee.Base):
+    """Minimal dbee that only supports execute()."""
+
+    def __init__(self):
+        self.transactions = []
+
+    def execute(self, transaction):
+        if transaction == "client error":
+            raise dbeekeeper.ClientError(transaction)
+        if transaction == "dbee error":
+            raise dbeekeeper.DbeeError(transaction)
+        self.transactions.append(transaction)
+
+    def snapshot(self, filename, callback):
+        pass
+
+    def restore(self, filename):
+        pass
+
+
+class ExecuteBatch(unittest.TestCase):
+    """The default execute_batch() implementation built on execute()."""
+
+    def test_execute_batch(self):
+        d = ListDbee()
+        errors = d.execute_batch(["a", "client error", "b"])
+        self.assertEqual(d.transactions, ["a", "b"])
+        self.assertIsNone(errors[0])
+        self.assertIsInstance(errors[1], dbeekeeper.ClientError)
+        self.assertIsNone(errors[2])
+
+    def test_execute_batch_dbee_error(self):
+        d = ListDbee()
+        self.assertRaises(dbeekeeper.DbeeError, d.execute_batch,
+                          ["a", "dbee error", "b"])
+        self.assertEqual(d.transactions, ["a"])
@@ -0,0 +1,212 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import dbeekeeper
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from dbeekeeper import framing
+from dbeekeeper.dbee import memory
+from tests.dbeelog.local import Result
+
+
+class MemoryDbee(unittest.TestCase):
+    """Execute transactions on, snapshot, and restore an in-memory dbee."""
+
+    use_fork = hasattr(os, "fork")
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "snapshot")
+        self.dbee = memory.MemoryDbee(use_fork=self.use_fork)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_execute(self):
+        self.dbee.execute(memory.put("a", "1"))
+        self.dbee.execute(memory.put("b", "2"))
+        self.dbee.execute(memory.delete("a"))
+        self.dbee.execute(memory.delete("a"))
+        self.assertIsNone(self.dbee.get("a"))
+        self.assertEqual(self.dbee.get("b"), "2")
+
+    def test_execute_frame(self):
+        frame = framing.encode(memory.put("a", "1").encode("utf-8"))
+        self.dbee.execute(memoryview(frame))
+        self.assertEqual(self.dbee.get("a"), "1")
+        self.assertRaises(dbeekeeper.ClientError, self.dbee.execute,
+                          frame[:-1])
+
+    def test_malformed(self):
+        for transaction in ("not json", '["put", "a"]', '["get", "a"]',
+                            '["put", "a", 1]'):
+            self.assertRaises(dbeekeeper.ClientError,
+                              self.dbee.execute, transaction)
+
+    def test_snapshot(self):
+        for i in range(1000):
+            self.dbee.execute(memory.put("k%d" % i, "v%d" % i))
+        result = Result()
+        self.dbee.snapshot(self.filename, result)
+        # Transactions keep executing while the snapshot is taken.
+        self.dbee.execute(memory.put("k0", "changed"))
+        self.assertEqual(result.wait(), [(None, self.filename)])
+
+        restored = memory.MemoryDbee()
+        restored.restore(self.filename)
+        self.assertEqual(len(restored), 1000)
+        self.assertEqual(restored.get("k999"), "v999")
+        self.assertIn(restored.get("k0"), ("v0", "changed"))
+
+    def test_concurrent_snapshot(self):
+        self.dbee.execute(memory.put("a", "1"))
+        first = Result()
+        second = Result()
+        self.dbee.snapshot(self.filename, first)
+        self.dbee.snapshot(self.filename, second)
+        errors = [r[0] for r in first.wait() + second.wait()]
+        self.assertTrue(errors[0] is None or errors[1] is None)
+        if errors[1] is not None:
+            self.assertIsInstance(errors[1], dbeekeeper.ClientError)
+
+    def test_restore_corrupted(self):
+        with open(self.filename, "wb") as f:
+            f.write(b"garbage")
+        self.assertRaises(dbeekeeper.DbeeError,
+                          self.dbee.restore, self.filename)
+
+
+class MemoryDbeeWithoutFork(MemoryDbee):
+    """Same as MemoryDbee, but snapshot by copying the state."""
+
+    use_fork = False
+
+
+class IncrementalSnapshot(unittest.TestCase):
+    """Chain delta snapshots to a base and fold them together."""
+
+    use_fork = hasattr(os, "fork")
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dbee = memory.MemoryDbee(use_fork=self.use_fork,
+                                      incremental=True, max_deltas=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def snapshot(self, name):
+        filename = os.path.join(self.directory, name)
+        result = Result()
+        self.dbee.snapshot(filename, result)
+        self.assertEqual(result.wait(), [(None, filename)])
+        return filename
+
+    def restore(self, filename):
+        dbee = memory.MemoryDbee()
+        dbee.restore(filename)
+        return dict((k, dbee.get(k)) for k in ("a", "b", "c"))
+
+    def test_chain(self):
+        self.dbee.execute(memory.put("a", "1"))
+        self.dbee.execute(memory.put("b", "1"))
+        first = self.snapshot("s1")
+        self.dbee.execute(memory.put("b", "2"))
+        self.dbee.execute(memory.delete("a"))
+        second = self.snapshot("s2")
+
+        files = memory.snapshot_files(second)
+        self.assertEqual(files, [second, first + ".base", second + ".delta0"])
+        self.assertEqual(self.restore(first), {"a": "1", "b": "1", "c": None})
+        self.assertEqual(self.restore(second),
+                         {"a": None, "b": "2", "c": None})
+
+    def test_merge(self):
+        for i in range(4):
+            self.dbee.execute(memory.put("c", str(i)))
+            filename = self.snapshot("s%d" % i)
+        self.wait_for_merge(filename)
+        files = memory.snapshot_files(filename)
+        self.assertEqual(len(files), 2)
+        self.assertTrue(files[1].startswith(filename + ".base-"))
+        self.assertEqual(self.restore(filename)["c"], "3")
+
+        # The next snapshot chains from the merged base.
+        self.dbee.execute(memory.put("a", "x"))
+        filename = self.snapshot("s4")
+        self.assertEqual(len(memory.snapshot_files(filename)), 3)
+        self.assertEqual(self.restore(filename),
+                         {"a": "x", "b": None, "c": "3"})
+
+    def test_merge_reused_filename(self):
+        self.dbee.execute(memory.put("a", "1"))
+        self.snapshot("s")
+        # Hold up the merge until another snapshot reuses the filename.
+        load = self.dbee._load
+        release = threading.Event()
+
+        def slow_load(filename):
+            release.wait(10)
+            return load(filename)
+        self.dbee._load = slow_load
+        for i in range(3):
+            self.dbee.execute(memory.put("b", str(i)))
+            filename = self.snapshot("s")
+        self.dbee.execute(memory.put("c", "1"))
+        self.snapshot("s")
+        release.set()
+        for i in range(100):
+            if not self.dbee._merging:
+                break
+            time.sleep(0.05)
+
+        # The merge didn't clobber the manifest of the later snapshot, and
+        # the next snapshot chains from the merged base.
+        self.assertEqual(self.restore(filename),
+                         {"a": "1", "b": "2", "c": "1"})
+        self.dbee.execute(memory.put("c", "2"))
+        self.snapshot("s2")
+        self.assertEqual(len(memory.snapshot_files(
+            os.path.join(self.directory, "s2"))), 4)
+        self.assertEqual(self.restore(os.path.join(self.directory, "s2")),
+                         {"a": "1", "b": "2", "c": "2"})
+
+    def wait_for_merge(self, filename):
+        for i in range(100):
+            if len(memory.snapshot_files(filename)) == 2:
+                return
+            time.sleep(0.05)
+
+    def test_restore_continues_chain(self):
+        self.dbee.execute(memory.put("a", "1"))
+        first = self.snapshot("s1")
+        self.dbee = memory.MemoryDbee(use_fork=self.use_fork,
+                                      incremental=True)
+        self.dbee.restore(first)
+        self.dbee.execute(memory.put("b", "1"))
+        second = self.snapshot("s2")
+        self.assertEqual(len(memory.snapshot_files(second)), 3)
+        self.assertEqual(self.restore(second), {"a": "1", "b": "1", "c": None})
+
+
+class IncrementalSnapshotWithoutFork(IncrementalSnapshot):
+    """Same as IncrementalSnapshot, but snapshot by copying the state."""
+
+    use_fork = False
@@ -0,0 +1,125 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import dbeekeeper
+import os
+import shutil
+import tempfile
+import unittest
+
+from dbeekeeper import framing
+from dbeekeeper.dbee import memory
+from dbeekeeper.dbee import process
+from tests.dbeelog.local import Result
+
+
+class FailingDbee(memory.MemoryDbee):
+    """MemoryDbee that fails on a poison transaction."""
+
+    def execute(self, transaction):
+        if transaction == "poison":
+            raise dbeekeeper.DbeeError("poisoned")
+        super(FailingDbee, self).execute(transaction)
+
+
+def broken_factory():
+    raise ValueError("broken")
+
+
+class Ring(unittest.TestCase):
+    """Pass records through a shared-memory ring."""
+
+    def test_wrap_around(self):
+        ring = process.Ring(64)
+        for i in range(50):
+            data = b"x" * (i % 20)
+            self.assertTrue(ring.put(data))
+            self.assertEqual(ring.get(), data)
+        self.assertIsNone(ring.get(0.01))
+
+    def test_full(self):
+        ring = process.Ring(32)
+        self.assertTrue(ring.put(b"a" * 20))
+        self.assertFalse(ring.put(b"b" * 20, 0.01))
+        self.assertRaises(dbeekeeper.ClientError, ring.put, b"c" * 40)
+
+
+class ProcessDbee(unittest.TestCase):
+    """Execute transactions on, snapshot, and restore a hosted dbee."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "snapshot")
+        self.dbee = process.ProcessDbee(FailingDbee, ring_size=4096)
+
+    def tearDown(self):
+        self.dbee.close()
+        shutil.rmtree(self.directory)
+
+    def restored(self):
+        result = Result()
+        self.dbee.snapshot(self.filename, result)
+        self.assertEqual(result.wait(), [(None, self.filename)])
+        dbee = memory.MemoryDbee()
+        dbee.restore(self.filename)
+        return dbee
+
+    def test_execute(self):
+        self.assertNotEqual(self.dbee.pid, os.getpid())
+        self.dbee.execute(memory.put("a", "1"))
+        frame = framing.encode(memory.put("b", "2").encode("utf-8"))
+        self.dbee.execute(memoryview(frame))
+        self.assertRaises(dbeekeeper.ClientError, self.dbee.execute, "bogus")
+        dbee = self.restored()
+        self.assertEqual(dbee.get("a"), "1")
+        self.assertEqual(dbee.get("b"), "2")
+
+    def test_execute_batch(self):
+        # More transactions and errors than fit in the ring at once.
+        transactions = []
+        for i in range(500):
+            transactions.append(memory.put("k%d" % i, "v" * 20))
+            transactions.append("bogus%d" % i)
+        errors = self.dbee.execute_batch(transactions)
+        self.assertEqual(errors[::2], [None] * 500)
+        for error in errors[1::2]:
+            self.assertIsInstance(error, dbeekeeper.ClientError)
+        self.assertEqual(len(self.restored()), 500)
+
+    def test_too_large(self):
+        errors = self.dbee.execute_batch([memory.put("a", "x" * 5000),
+                                          memory.put("b", "1")])
+        self.assertIsInstance(errors[0], dbeekeeper.ClientError)
+        self.assertIsNone(errors[1])
+
+    def test_dbee_error(self):
+        self.assertRaises(dbeekeeper.DbeeError, self.dbee.execute_batch,
+                          [memory.put("a", "1"), "poison"])
+        # The worker survives a DbeeError.
+        self.dbee.execute(memory.put("b", "2"))
+        self.assertEqual(self.restored().get("b"), "2")
+
+    def test_restore(self):
+        self.dbee.execute(memory.put("a", "1"))
+        self.restored()
+        self.dbee.execute(memory.put("a", "2"))
+        self.dbee.restore(self.filename)
+        self.assertEqual(self.restored().get("a"), "1")
+        self.assertRaises(dbeekeeper.DbeeError, self.dbee.restore,
+                          os.path.join(self.directory, "missing"))
+
+    def test_broken_factory(self):
+        self.assertRaises(dbeekeeper.DbeeError, process.ProcessDbee,
+                          broken_factory)
@@ -0,0 +1,115 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import dbeekeeper
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+from dbeekeeper.dbee import memory
+from dbeekeeper.dbee import snapshot
+
+
+class Snapshot(unittest.TestCase):
+    """Write and read chunked snapshot files."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "snapshot")
+        self.items = [("key%d" % i, "value%d" % i) for i in range(1000)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self):
+        chunks = list(snapshot.read(self.filename))
+        return chunks, [record for chunk in chunks for record in chunk]
+
+    def test_read(self):
+        snapshot.write(self.filename, self.items, chunk_size=1024)
+        self.assertTrue(snapshot.is_snapshot(self.filename))
+        chunks, records = self.read()
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(records, self.items)
+
+    def test_read_compressed(self):
+        snapshot.write(self.filename, self.items, chunk_size=1024,
+                       compress=True)
+        chunks, records = self.read()
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(records, self.items)
+
+    def test_read_parallel(self):
+        snapshot.write(self.filename, self.items, chunk_size=1024,
+                       compress=True)
+        # Chunks compress to about 210 bytes: inflate some of them in the
+        # workers and the others in place.
+        min_length = snapshot._MIN_PARALLEL_LENGTH
+        snapshot._MIN_PARALLEL_LENGTH = 210
+        try:
+            chunks = list(snapshot.read(self.filename, processes=2))
+            self.assertTrue(len(chunks) > 1)
+            self.assertEqual([r for chunk in chunks for r in chunk],
+                             self.items)
+
+            with open(self.filename, "r+b") as f:
+                f.seek(100)
+                f.write(b"X")
+            self.assertRaises(dbeekeeper.DbeeError, list,
+                              snapshot.read(self.filename, processes=2))
+        finally:
+            snapshot._MIN_PARALLEL_LENGTH = min_length
+
+    def test_empty(self):
+        snapshot.write(self.filename, [])
+        self.assertEqual(self.read(), ([], []))
+
+    def test_corrupted(self):
+        snapshot.write(self.filename, self.items)
+        with open(self.filename, "r+b") as f:
+            f.seek(100)
+            f.write(b"X")
+        self.assertRaises(dbeekeeper.DbeeError, self.read)
+
+    def test_malformed_chunk(self):
+        # The CRC of the chunk matches, but its record header is cut short.
+        chunk = b"\x00\x00\x00"
+        index = struct.pack(">QIIB", len(snapshot.MAGIC), len(chunk),
+                            zlib.crc32(chunk) & 0xffffffff, 0)
+        with open(self.filename, "wb") as f:
+            f.write(snapshot.MAGIC + chunk + index)
+            f.write(struct.pack(">QI8s", len(snapshot.MAGIC) + len(chunk), 1,
+                                snapshot.MAGIC))
+        self.assertRaises(dbeekeeper.DbeeError, self.read)
+
+    def test_not_a_snapshot(self):
+        with open(self.filename, "wb") as f:
+            f.write(b"garbage" * 10)
+        self.assertFalse(snapshot.is_snapshot(self.filename))
+        self.assertRaises(dbeekeeper.DbeeError, self.read)
+
+    def test_memory_dbee_restore(self):
+        snapshot.write(self.filename, self.items, chunk_size=1024)
+        dbee = memory.MemoryDbee()
+        dbee.restore(self.filename)
+        self.assertEqual(len(dbee), 1000)
+        self.assertEqual(dbee.get("key999"), "value999")
+
+        dbee = memory.MemoryDbee(restore_processes=2)
+        dbee.restore(self.filename)
+        self.assertEqual(len(dbee), 1000)
@@ -0,0 +1,140 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import dbeekeeper
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from dbeekeeper import framing
+from dbeekeeper.dbee import memory
+from dbeekeeper.dbee import sqlite
+from tests.dbeelog.local import Result
+
+
+class SqliteDbee(unittest.TestCase):
+    """Execute transactions on, snapshot, and restore a SQLite dbee."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "snapshot")
+        self.dbee = self.open("db", commit_interval=10)
+
+    def tearDown(self):
+        self.dbee.close()
+        shutil.rmtree(self.directory)
+
+    def open(self, name, **kwargs):
+        return sqlite.SqliteDbee(os.path.join(self.directory, name),
+                                 **kwargs)
+
+    def snapshot(self, dbee):
+        result = Result()
+        dbee.snapshot(self.filename, result)
+        return result.wait()[0]
+
+    def test_execute(self):
+        self.dbee.execute(memory.put("a", "1"))
+        self.dbee.execute(memory.put("b", "2"))
+        self.dbee.execute(memory.delete("a"))
+        self.dbee.execute(memory.delete("a"))
+        self.assertIsNone(self.dbee.get("a"))
+        self.assertEqual(self.dbee.get("b"), "2")
+        frame = framing.encode(memory.put("c", "3").encode("utf-8"))
+        self.dbee.execute(memoryview(frame))
+        self.assertEqual(self.dbee.get("c"), "3")
+        self.assertRaises(dbeekeeper.ClientError, self.dbee.execute,
+                          "not json")
+
+    def test_commit_interval(self):
+        for i in range(15):
+            self.dbee.execute(memory.put("k%d" % i, str(i)))
+        # Only the first 10 transactions are visible to other connections.
+        other = self.open("db")
+        self.assertEqual(len(other), 10)
+        self.dbee.commit()
+        self.assertEqual(len(other), 15)
+        other.close()
+
+    def test_execute_batch(self):
+        errors = self.dbee.execute_batch([memory.put("a", "1"), "bogus",
+                                          memory.put("b", "2")])
+        self.assertIsNone(errors[0])
+        self.assertIsInstance(errors[1], dbeekeeper.ClientError)
+        self.assertIsNone(errors[2])
+        other = self.open("db")
+        self.assertEqual(other.get("b"), "2")
+        other.close()
+
+    def test_snapshot_restore(self):
+        self.dbee.execute_batch([memory.put("k%d" % i, str(i))
+                                 for i in range(100)])
+        self.dbee.execute(memory.put("uncommitted", "x"))
+        self.assertEqual(self.snapshot(self.dbee), (None, self.filename))
+        # Writes continue after the snapshot without ending up in it.
+        self.dbee.execute_batch([memory.delete("k0"), memory.put("z", "z")])
+
+        dbee = self.open("restored")
+        dbee.execute(memory.put("stale", "1"))
+        dbee.restore(self.filename)
+        self.assertEqual(len(dbee), 101)
+        self.assertEqual(dbee.get("k0"), "0")
+        self.assertEqual(dbee.get("uncommitted"), "x")
+        self.assertIsNone(dbee.get("stale"))
+        self.assertIsNone(dbee.get("z"))
+        dbee.execute(memory.put("after", "1"))
+        dbee.close()
+
+        dbee = self.open("restored")
+        self.assertEqual(dbee.get("after"), "1")
+        dbee.close()
+
+    def test_snapshot_in_progress(self):
+        self.dbee.execute(memory.put("a", "1"))
+        backup = sqlite._backup
+        release = threading.Event()
+
+        def slow_backup(source, target):
+            release.wait(10)
+            backup(source, target)
+        sqlite._backup = slow_backup
+        try:
+            first = Result()
+            self.dbee.snapshot(self.filename, first)
+            for i in range(2):
+                result = Result()
+                self.dbee.snapshot(self.filename + str(i), result)
+                error, filename = result.wait()[0]
+                self.assertIsInstance(error, dbeekeeper.ClientError)
+                self.assertIsNone(filename)
+            self.assertRaises(dbeekeeper.ClientError, self.dbee.restore,
+                              self.filename)
+            release.set()
+            self.assertEqual(first.wait(), [(None, self.filename)])
+        finally:
+            sqlite._backup = backup
+        self.assertEqual(self.snapshot(self.dbee), (None, self.filename))
+
+    def test_restore_corrupted(self):
+        with open(self.filename, "wb") as f:
+            f.write(b"not a database" * 100)
+        self.dbee.execute(memory.put("a", "1"))
+        self.assertRaises(dbeekeeper.DbeeError, self.dbee.restore,
+                          self.filename)
+        self.assertEqual(self.dbee.get("a"), "1")
+        self.assertFalse(os.path.exists(
+            os.path.join(self.directory, "db.restore")))
@@ -0,0 +1,68 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import dbeekeeper
+import unittest
+
+from dbeekeeper import dbeelog
+
+
+class ListLog(dbeelog.Base):
+    """Minimal dbeelog that only supports append()."""
+
+    def __init__(self, fail_on=None):
+        super(ListLog, self).__init__("log", "client1")
+        self.transactions = []
+        self._fail_on = fail_on
+
+    def append(self, transaction, callback):
+        if transaction == self._fail_on:
+            callback(dbeekeeper.DbeeLogError("append failed"), None)
+            return
+        self.transactions.append(transaction)
+        callback(None, str(len(self.transactions)))
+
+    def subscribe(self, from_transaction_id, receive_func):
+        pass
+
+    def checkpoint(self, transaction_id, callback):
+        pass
+
+    def get_checkpoints(self, callback):
+        pass
+
+
+class AppendMany(unittest.TestCase):
+    """The default append_many() implementation built on append()."""
+
+    def test_append_many(self):
+        log = ListLog()
+        results = []
+        log.append_many(["a", "b", "c"], lambda *args: results.append(args))
+        self.assertEqual(results, [(None, ["1", "2", "3"])])
+        self.assertEqual(log.transactions, ["a", "b", "c"])
+
+    def test_append_many_empty(self):
+        results = []
+        ListLog().append_many([], lambda *args: results.append(args))
+        self.assertEqual(results, [(None, [])])
+
+    def test_append_many_error(self):
+        results = []
+        ListLog(fail_on="b").append_many(["a", "b", "c"],
+                                         lambda *args: results.append(args))
+        self.assertEqual(len(results), 1)
+        self.assertIsInstance(results[0][0], dbeekeeper.DbeeLogError)
+        self.assertIsNone(results[0][1])
@@ -0,0 +1,51 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import dbeekeeper
+import io
+import unittest
+
+from dbeekeeper.dbeelog import block
+
+
+class Block(unittest.TestCase):
+    """Pack and read compressed blocks."""
+
+    def test_roundtrip(self):
+        data = b"record" * 100
+        f = io.BytesIO(block.pack(data, 100) + block.pack(b"", 0))
+        size, count, raw = block.read(f)
+        self.assertEqual((count, raw), (100, data))
+        self.assertTrue(size < len(data))
+        self.assertEqual(block.read(f)[1:], (0, b""))
+        self.assertIsNone(block.read(f))
+
+    def test_stored(self):
+        data = b"incompressible"
+        packed = block.pack(data, 1)
+        self.assertEqual(len(packed), 16 + len(data))
+        self.assertEqual(block.read(io.BytesIO(packed)),
+                         (len(packed), 1, data))
+
+    def test_torn(self):
+        packed = block.pack(b"record" * 100, 100)
+        for end in (4, len(packed) - 1):
+            self.assertIsNone(block.read(io.BytesIO(packed[:end])))
+
+    def test_corrupted(self):
+        packed = bytearray(block.pack(b"record" * 100, 100))
+        packed[-1] ^= 0xff
+        self.assertRaises(dbeekeeper.DbeeLogError, block.read,
+                          io.BytesIO(bytes(packed)))
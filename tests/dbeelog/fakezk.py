@@ -0,0 +1,149 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import threading
+import time
+import unittest
+
+from kazoo.exceptions import BadVersionError
+from kazoo.exceptions import NoNodeError
+from kazoo.exceptions import NodeExistsError
+from kazoo.exceptions import NotEmptyError
+from kazoo.exceptions import RolledBackError
+from kazoo.exceptions import RuntimeInconsistency
+from kazoo.protocol.states import EventType
+
+from dbeekeeper.dbeelog import fakezk
+from tests.dbeelog.local import Result
+
+
+class FakeZooKeeper(unittest.TestCase):
+    """Serve kazoo-style requests from an in-memory znode tree."""
+
+    def setUp(self):
+        self.server = fakezk.FakeServer()
+        self.client = self.connect()
+
+    def tearDown(self):
+        self.client.stop()
+        self.server.close()
+
+    def connect(self):
+        client = fakezk.FakeClient(self.server)
+        client.start()
+        return client
+
+    def test_znodes(self):
+        c = self.client
+        self.assertEqual(c.create("/a", b"1"), "/a")
+        self.assertRaises(NodeExistsError, c.create, "/a")
+        self.assertRaises(NoNodeError, c.create, "/b/c")
+        c.create("/b/c", makepath=True)
+        data, stat = c.get("/a")
+        self.assertEqual((data, stat.version), (b"1", 0))
+        self.assertEqual(c.set("/a", b"2").version, 1)
+        self.assertRaises(BadVersionError, c.set, "/a", b"3", version=0)
+        self.assertEqual(sorted(c.get_children("/")), ["a", "b"])
+        self.assertRaises(NotEmptyError, c.delete, "/b")
+        c.delete("/b", recursive=True)
+        self.assertIsNone(c.exists("/b"))
+        c.ensure_path("/x/y/z")
+        self.assertIsNotNone(c.exists("/x/y/z"))
+
+    def test_sequence(self):
+        c = self.client
+        c.create("/log")
+        paths = [c.create("/log/txn-", sequence=True) for _ in range(3)]
+        self.assertEqual(paths, ["/log/txn-%010d" % i for i in range(3)])
+        c.delete(paths[2])
+        # Like ZooKeeper, the counter is the cversion of the parent.
+        self.assertEqual(c.create("/log/txn-", sequence=True),
+                         "/log/txn-0000000004")
+
+    def test_transaction(self):
+        c = self.client
+        c.create("/log")
+        t = c.transaction()
+        t.create("/log/txn-", b"a", sequence=True)
+        t.create("/log/txn-", b"b", sequence=True)
+        t.set_data("/log", b"x")
+        self.assertEqual(t.commit()[:2], ["/log/txn-0000000000",
+                                          "/log/txn-0000000001"])
+
+        t = c.transaction()
+        t.create("/log/txn-", b"c", sequence=True)
+        t.delete("/missing")
+        t.check("/log", 1)
+        results = t.commit()
+        self.assertIsInstance(results[0], RolledBackError)
+        self.assertIsInstance(results[1], NoNodeError)
+        self.assertIsInstance(results[2], RuntimeInconsistency)
+        self.assertEqual(sorted(c.get_children("/log")),
+                         ["txn-0000000000", "txn-0000000001"])
+        self.assertEqual(c.create("/log/txn-", sequence=True),
+                         "/log/txn-0000000002")
+
+    def test_watches(self):
+        c = self.client
+        c.create("/w")
+        events = Result(3)
+        c.get_children("/w", watch=events)
+        c.exists("/w/a", watch=events)
+        c.create("/w/a")
+        c.get("/w/a", watch=events)
+        c.set("/w/a", b"x")
+        c.set("/w/a", b"y")
+        received = events.wait()
+        self.assertEqual(sorted((e[0].type, e[0].path) for e in received),
+                         sorted([(EventType.CHILD, "/w"),
+                                 (EventType.CREATED, "/w/a"),
+                                 (EventType.CHANGED, "/w/a")]))
+        # Watches fire once.
+        time.sleep(0.05)
+        self.assertEqual(len(events.results), 3)
+
+    def test_ephemeral(self):
+        other = self.connect()
+        other.create("/e", ephemeral=True)
+        self.assertIsNotNone(self.client.exists("/e"))
+        other.stop()
+        self.assertIsNone(self.client.exists("/e"))
+
+    def test_latency(self):
+        self.client.stop()
+        self.server.close()
+        self.server = fakezk.FakeServer(latency=0.05, fsync=0.02,
+                                        jitter=0.05, seed=1)
+        self.client = self.connect()
+        start = time.time()
+        self.client.create("/l")
+        self.assertTrue(time.time() - start >= 0.07)
+
+        # Jitter never reorders the responses to a client.
+        order = []
+        lock = threading.Lock()
+        done = threading.Event()
+
+        def callback(i, result):
+            with lock:
+                order.append(i)
+                if len(order) == 20:
+                    done.set()
+        for i in range(20):
+            self.client.set_async("/l", b"%d" % i).rawlink(
+                lambda result, i=i: callback(i, result))
+        self.assertTrue(done.wait(10))
+        self.assertEqual(order, list(range(20)))
+        self.assertEqual(self.client.get("/l")[1].version, 20)
@@ -0,0 +1,134 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import dbeekeeper
+import threading
+import time
+import unittest
+
+from dbeekeeper.dbeelog import fanout
+from tests.dbeelog.base import ListLog
+from tests.dbeelog.local import Result
+
+
+class PushLog(ListLog):
+    """dbeelog whose entries are pushed by the test."""
+
+    def subscribe(self, from_transaction_id, receive_func):
+        self.receive_func = receive_func
+        return True
+
+    def push(self, start, stop):
+        for i in range(start, stop):
+            self.receive_func(None, "%03d" % i, "client1", "t%d" % i)
+
+    def push_async(self, start, stop):
+        thread = threading.Thread(target=self.push, args=(start, stop))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+class Fanout(unittest.TestCase):
+    """Share one subscription among local subscribers."""
+
+    def setUp(self):
+        self.log = PushLog()
+
+    def test_fanout(self):
+        f = fanout.Fanout(self.log, capacity=4)
+        results = [Result(10), Result(10)]
+        for result in results:
+            f.subscribe("", result)
+        self.log.push_async(0, 10).join(10)
+        for result in results:
+            self.assertEqual([r[3] for r in result.wait()],
+                             ["t%d" % i for i in range(10)])
+        f.close()
+
+    def test_subscribe_from(self):
+        f = fanout.Fanout(self.log, capacity=8)
+        self.log.push(0, 6)
+        result = Result(4)
+        f.subscribe("004", result)
+        self.log.push(6, 8)
+        self.assertEqual([r[1] for r in result.wait()],
+                         ["004", "005", "006", "007"])
+        f.close()
+
+    def test_subscribe_from_wrapped(self):
+        f = fanout.Fanout(self.log, capacity=8)
+        self.log.push(0, 13)
+        results = []
+        for i in range(5, 14):
+            results.append(Result(14 - i))
+            f.subscribe("%03d" % i, results[-1])
+        self.log.push(13, 14)
+        for i, result in zip(range(5, 14), results):
+            self.assertEqual([r[1] for r in result.wait()],
+                             ["%03d" % j for j in range(i, 14)])
+        f.close()
+
+    def test_subscribe_not_buffered(self):
+        f = fanout.Fanout(self.log, capacity=4)
+        self.log.push(0, 8)
+        self.assertRaises(dbeekeeper.DbeeLogError,
+                          f.subscribe, "001", lambda *args: None)
+
+    def test_subscribe_before_start(self):
+        f = fanout.Fanout(self.log, "005", capacity=4)
+        self.assertRaises(dbeekeeper.DbeeLogError,
+                          f.subscribe, "004", lambda *args: None)
+        result = Result(2)
+        f.subscribe("005", result)
+        self.log.push(5, 7)
+        self.assertEqual([r[1] for r in result.wait()], ["005", "006"])
+        f.close()
+
+    def test_backpressure(self):
+        f = fanout.Fanout(self.log, capacity=4)
+        release = threading.Event()
+        result = Result(10)
+
+        def slow(*args):
+            release.wait(10)
+            result(*args)
+        f.subscribe("", slow)
+        producer = self.log.push_async(0, 10)
+        time.sleep(0.1)
+        self.assertTrue(producer.is_alive())
+        release.set()
+        producer.join(10)
+        self.assertEqual(len(result.wait()), 10)
+        f.close()
+
+    def test_disconnect_slow_subscriber(self):
+        f = fanout.Fanout(self.log, capacity=4, slow_subscriber_timeout=0.05)
+        release = threading.Event()
+        slow_result = Result()
+
+        def slow(*args):
+            if args[0] is not None:
+                slow_result(*args)
+            release.wait(10)
+        fast_result = Result(10)
+        f.subscribe("", slow)
+        f.subscribe("", fast_result)
+        self.log.push_async(0, 10).join(10)
+        self.assertEqual(len(fast_result.wait()), 10)
+        release.set()
+        self.assertIsInstance(slow_result.wait()[0][0],
+                              dbeekeeper.DbeeLogError)
+        f.close()
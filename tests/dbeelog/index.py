@@ -0,0 +1,63 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from dbeekeeper.dbeelog import index
+
+
+class OffsetIndex(unittest.TestCase):
+    """Add, look up, and reload sparse index entries."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "segment.idx")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_sparse(self):
+        idx = index.OffsetIndex(self.path, interval=100)
+        for seq in range(10, 30):
+            idx.add(seq, (seq - 10) * 30)
+        idx.close()
+        self.assertEqual(len(idx), 5)
+        self.assertIsNone(idx.lookup(9))
+        self.assertEqual(idx.lookup(10), (10, 0))
+        self.assertEqual(idx.lookup(13), (10, 0))
+        self.assertEqual(idx.lookup(14), (14, 120))
+        self.assertEqual(idx.lookup(100), (26, 480))
+
+    def test_reload(self):
+        idx = index.OffsetIndex(self.path, interval=0)
+        for seq in range(5):
+            idx.add(seq, seq * 10)
+        idx.close()
+        # A torn entry at the end of the file is ignored.
+        with open(self.path, "ab") as f:
+            f.write(b"\x00\x01")
+        idx = index.OffsetIndex(self.path, interval=0)
+        self.assertEqual(len(idx), 5)
+        self.assertEqual(idx.lookup(3), (3, 30))
+
+    def test_clear(self):
+        idx = index.OffsetIndex(self.path)
+        idx.add(1, 0)
+        idx.clear()
+        self.assertEqual(len(idx), 0)
+        self.assertFalse(os.path.exists(self.path))
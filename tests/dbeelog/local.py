@@ -0,0 +1,461 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import dbeekeeper
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from dbeekeeper import framing
+from dbeekeeper.dbeelog import local
+
+
+class Result(object):
+    """Collect callback results and wait for a number of them."""
+
+    def __init__(self, count=1):
+        self.results = []
+        self._count = count
+        self._event = threading.Event()
+
+    def __call__(self, *args):
+        self.results.append(args)
+        if len(self.results) >= self._count:
+            self._event.set()
+
+    def wait(self):
+        assert self._event.wait(10), "timed out"
+        return self.results
+
+
+class LocalLog(unittest.TestCase):
+    """Append, subscribe, and checkpoint a file-backed dbeelog."""
+
+    block_size = None
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal = self.open_journal(segment_size=64)
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.directory)
+
+    def open_journal(self, **kwargs):
+        return local.Journal(self.directory, block_size=self.block_size,
+                             **kwargs)
+
+    def append(self, log, transactions):
+        result = Result(len(transactions))
+        for transaction in transactions:
+            log.append(transaction, result)
+        return [txid for _, txid in result.wait()]
+
+    def test_append(self):
+        log = local.LocalLog("log", "client1", self.journal)
+        txids = []
+        for i in range(0, 100, 20):
+            txids += self.append(log, ["t%d" % j for j in range(i, i + 20)])
+        self.assertEqual(txids, sorted(txids))
+        self.assertEqual(len(set(txids)), 100)
+        self.assertTrue(len(os.listdir(self.directory)) > 1)
+
+    def test_append_rejects_non_string(self):
+        log = local.LocalLog("log", "client1", self.journal)
+        result = Result()
+        log.append(42, result)
+        error, txid = result.wait()[0]
+        self.assertIsInstance(error, dbeekeeper.ClientError)
+        self.assertIsNone(txid)
+
+    def test_append_rejects_non_utf8(self):
+        if str is bytes:
+            return
+        log = local.LocalLog("log", "client1", self.journal)
+        result = Result()
+        log.append(b"\xff\xfe", result)
+        self.assertIsInstance(result.wait()[0][0], dbeekeeper.ClientError)
+        result = Result()
+        log.append_many([b"t0", b"\xff\xfe"], result)
+        self.assertIsInstance(result.wait()[0][0], dbeekeeper.ClientError)
+        self.assertEqual(self.append(log, [b"t1"]),
+                         [local.format_transaction_id(1)])
+
+    def test_append_many(self):
+        writer = local.LocalLog("log", "client1", self.journal)
+        other = local.LocalLog("log", "client2", self.journal)
+        result = Result(2)
+        writer.append_many(["t%d" % i for i in range(10)], result)
+        other.append("u0", result)
+        txids = [r[1] for r in result.wait() if isinstance(r[1], list)][0]
+        seqs = [int(txid) for txid in txids]
+        self.assertEqual(seqs, list(range(seqs[0], seqs[0] + 10)))
+
+    def test_subscribe(self):
+        writer = local.LocalLog("log", "client1", self.journal)
+        reader = local.LocalLog("log", "client2", self.journal)
+        txids = self.append(writer, ["t%d" % i for i in range(10)])
+
+        result = Result(5)
+        self.assertTrue(reader.subscribe(txids[5], result))
+        self.append(writer, ["t10"])
+        # t10 may or may not have arrived too.
+        received = result.wait()[:5]
+        reader.close()
+        self.assertEqual([r[3] for r in received],
+                         ["t5", "t6", "t7", "t8", "t9"])
+        self.assertEqual([r[1] for r in received], txids[5:10])
+        self.assertEqual(set(r[2] for r in received), set(["client1"]))
+
+    def test_subscribe_frames(self):
+        log = local.LocalLog("log", "client1", self.journal)
+        frames = [framing.encode(b"payload%d" % i, b"h") for i in range(3)]
+        txids = self.append(log, frames[:2] + [memoryview(frames[2])])
+        result = Result(3)
+        log.subscribe(txids[0], result)
+        received = result.wait()
+        log.close()
+        for frame, r in zip(frames, received):
+            self.assertIsInstance(r[3], memoryview)
+            self.assertEqual(r[3].tobytes(), frame)
+
+    def test_subscribe_corrupted_frame(self):
+        log = local.LocalLog("log", "client1", self.journal)
+        txid = self.append(log, [framing.encode(b"payload")])[0]
+        self.journal.close()
+        segments = sorted(f for f in os.listdir(self.directory)
+                          if f.endswith(".log"))
+        with open(os.path.join(self.directory, segments[-1]), "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b"X")
+
+        self.journal = self.open_journal(segment_size=64)
+        log = local.LocalLog("log", "client1", self.journal)
+        result = Result()
+        log.subscribe(txid, result)
+        error = result.wait()[0][0]
+        log.close()
+        self.assertIsInstance(error, dbeekeeper.DbeeLogError)
+
+    def test_reopen(self):
+        log = local.LocalLog("log", "client1", self.journal)
+        txids = self.append(log, ["t%d" % i for i in range(20)])
+        self.journal.close()
+
+        # Simulate a torn write at the tail of the last segment.
+        segments = sorted(f for f in os.listdir(self.directory)
+                          if f.endswith((".log", ".blk")))
+        with open(os.path.join(self.directory, segments[-1]), "ab") as f:
+            f.write(b"\x00\x00")
+
+        self.journal = self.open_journal(segment_size=64)
+        log = local.LocalLog("log", "client1", self.journal)
+        self.assertEqual(self.append(log, ["t20"]),
+                         [local.format_transaction_id(21)])
+        result = Result(21)
+        log.subscribe(txids[0], result)
+        received = result.wait()
+        log.close()
+        self.assertEqual([r[3] for r in received],
+                         ["t%d" % i for i in range(21)])
+
+    def test_seek(self):
+        self.journal.close()
+        self.journal = self.open_journal(segment_size=1024,
+                                         index_interval=64)
+        log = local.LocalLog("log", "client1", self.journal)
+        txids = []
+        for i in range(0, 200, 50):
+            txids += self.append(log, ["t%d" % j for j in range(i, i + 50)])
+        self.journal.close()
+
+        # Index files of closed segments are rebuilt if they are missing.
+        for name in os.listdir(self.directory):
+            if name.endswith(".idx"):
+                os.remove(os.path.join(self.directory, name))
+        self.journal = self.open_journal(segment_size=1024,
+                                         index_interval=64)
+        log = local.LocalLog("log", "client1", self.journal)
+        for i in (0, 1, 77, 150, 199):
+            result = Result()
+            log.subscribe(txids[i], result)
+            self.assertEqual(result.wait()[0][1:], (txids[i], "client1",
+                                                    "t%d" % i))
+        log.close()
+
+    def test_checkpoint(self):
+        log = local.LocalLog("log", "client1", self.journal)
+        txid = self.append(log, ["t0"])[0]
+        result = Result()
+        log.checkpoint(txid, result)
+        self.assertEqual(result.wait(), [(None, txid)])
+
+        self.journal.close()
+        self.journal = self.open_journal()
+        log = local.LocalLog("log", "client2", self.journal)
+        result = Result()
+        log.get_checkpoints(result)
+        self.assertEqual(result.wait(), [(None, {"client1": txid})])
+
+    def test_group_commit(self):
+        self.journal.close()
+        self.journal = self.open_journal()
+        log = local.LocalLog("log", "client1", self.journal)
+        fsync = os.fsync
+        calls = []
+        release = threading.Event()
+
+        def slow_fsync(fd):
+            calls.append(fd)
+            release.wait(10)
+            fsync(fd)
+        os.fsync = slow_fsync
+        try:
+            first = Result()
+            log.append("t0", first)
+            for i in range(100):
+                if calls:
+                    break
+                time.sleep(0.01)
+            # These appends queue up behind the commit of t0.
+            result = Result(50)
+            for i in range(50):
+                log.append("t%d" % (i + 1), result)
+            release.set()
+            first.wait()
+            self.assertEqual([error for error, _ in result.wait()],
+                             [None] * 50)
+        finally:
+            os.fsync = fsync
+        self.assertEqual(len(calls), 2)
+
+    def test_checkpoint_concurrent_append(self):
+        log = local.LocalLog("log", "client1", self.journal)
+        txid = self.append(log, ["t0"])[0]
+        store = self.journal._store_checkpoints
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_store(checkpoints):
+            started.set()
+            release.wait(10)
+            store(checkpoints)
+        self.journal._store_checkpoints = slow_store
+
+        checkpointed = Result()
+        thread = threading.Thread(target=log.checkpoint,
+                                  args=(txid, checkpointed))
+        thread.start()
+        started.wait(10)
+        # Appends are committed while the checkpoint is being stored.
+        self.assertEqual(len(self.append(log, ["t1", "t2"])), 2)
+        self.assertEqual(checkpointed.results, [])
+        release.set()
+        thread.join()
+        self.assertEqual(checkpointed.wait(), [(None, txid)])
+
+    def test_checkpoint_coalescing(self):
+        writes = []
+        store = self.journal._store_checkpoints
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_store(checkpoints):
+            writes.append(checkpoints)
+            started.set()
+            release.wait(10)
+            store(checkpoints)
+        self.journal._store_checkpoints = slow_store
+
+        logs = [local.LocalLog("log", "client%d" % i, self.journal)
+                for i in range(4)]
+        txids = self.append(logs[0], ["t%d" % i for i in range(10)])
+        result = Result(10)
+        threads = [threading.Thread(target=logs[i % 4].checkpoint,
+                                    args=(txids[i], result))
+                   for i in range(10)]
+        threads[0].start()
+        started.wait(10)
+        for thread in threads[1:]:
+            thread.start()
+        for i in range(100):
+            if self.journal._checkpoint_requested == 10:
+                break
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(result.wait()),
+                         [(None, txid) for txid in txids])
+        # The first write, and one for the nine calls made meanwhile.
+        self.assertEqual(len(writes), 2)
+        self.assertEqual(self.journal.get_checkpoints(), writes[-1])
+
+    def test_truncate(self):
+        logs = [local.LocalLog("log", "client%d" % i, self.journal,
+                               min_checkpoints=2) for i in range(3)]
+        txids = []
+        for i in range(0, 40, 10):
+            txids += self.append(logs[0],
+                                 ["t%d" % j for j in range(i, i + 10)])
+        segments = len(os.listdir(self.directory))
+
+        result = Result(3)
+        logs[0].checkpoint(txids[35], result)
+        logs[1].checkpoint(txids[5], result)
+        logs[2].checkpoint(txids[25], result)
+        result.wait()
+        self.journal.close()
+
+        self.assertTrue(len(os.listdir(self.directory)) < segments)
+        self.assertTrue(self.journal.first_seq() <= int(txids[25]))
+        self.assertTrue(self.journal.first_seq() > int(txids[5]))
+        self.journal = self.open_journal(segment_size=64)
+        log = local.LocalLog("log", "client1", self.journal)
+        self.assertRaises(dbeekeeper.DbeeLogError,
+                          log.subscribe, txids[0], lambda *args: None)
+        result = Result(15)
+        log.subscribe(txids[25], result)
+        self.assertEqual([r[3] for r in result.wait()],
+                         ["t%d" % i for i in range(25, 40)])
+        log.close()
+
+    def test_checkpoint_malformed(self):
+        log = local.LocalLog("log", "client1", self.journal)
+        result = Result()
+        log.checkpoint("bogus", result)
+        error, txid = result.wait()[0]
+        self.assertIsInstance(error, dbeekeeper.ClientError)
+
+
+class BlockCompressed(LocalLog):
+    """Same as LocalLog, with block-compressed segments."""
+
+    block_size = 256
+
+    def test_small_commits(self):
+        self.journal.close()
+        self.journal = self.open_journal()
+        log = local.LocalLog("log", "client1", self.journal)
+        transaction = "0123456789abcde"
+        for i in range(3):
+            self.append(log, [transaction])
+        # Each commit is a block of its own, stored uncompressed.
+        record = 6 + len("client1") + len(transaction)
+        self.assertEqual(os.path.getsize(self.journal.segment_path(1)),
+                         3 * (16 + record))
+        result = Result(3)
+        log.subscribe(local.format_transaction_id(1), result)
+        self.assertEqual([r[3] for r in result.wait()], [transaction] * 3)
+        log.close()
+
+    def test_compression(self):
+        self.journal.close()
+        shutil.rmtree(self.directory)
+        self.block_size = 64 * 1024
+        self.journal = self.open_journal()
+        log = local.LocalLog("log", "client1", self.journal)
+        transaction = "INSERT INTO t VALUES ('%s')" % ("x" * 100)
+        result = Result()
+        log.append_many([transaction] * 50, result)
+        txids = result.wait()[0][1]
+        size = sum(os.path.getsize(os.path.join(self.directory, name))
+                   for name in os.listdir(self.directory)
+                   if name.endswith(".blk"))
+        self.assertTrue(size < 50 * len(transaction) / 5)
+
+        result = Result(10)
+        log.subscribe(txids[40], result)
+        received = result.wait()
+        log.close()
+        self.assertEqual([r[1] for r in received], txids[40:])
+        self.assertEqual(set(r[3] for r in received), set([transaction]))
+
+    def test_mixed_segments(self):
+        self.journal.close()
+        shutil.rmtree(self.directory)
+        self.block_size = None
+        self.journal = self.open_journal(segment_size=64)
+        log = local.LocalLog("log", "client1", self.journal)
+        txids = self.append(log, ["t%d" % i for i in range(10)])
+        self.journal.close()
+
+        self.block_size = 256
+        self.journal = self.open_journal(segment_size=64)
+        log = local.LocalLog("log", "client1", self.journal)
+        txids += self.append(log, ["t%d" % i for i in range(10, 20)])
+        names = os.listdir(self.directory)
+        self.assertTrue(any(name.endswith(".log") for name in names))
+        self.assertTrue(any(name.endswith(".blk") for name in names))
+        result = Result(20)
+        log.subscribe(txids[0], result)
+        received = result.wait()
+        log.close()
+        self.assertEqual([r[3] for r in received],
+                         ["t%d" % i for i in range(20)])
+
+    def test_corrupted_block_at_tail(self):
+        # A complete block that fails its CRC is not a torn write, even in
+        # the last segment, so the journal refuses to open.
+        self.journal.close()
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        self.journal = self.open_journal()
+        log = local.LocalLog("log", "client1", self.journal)
+        self.append(log, ["t%d" % i for i in range(5)])
+        self.journal.close()
+        path = os.path.join(self.directory, [
+            f for f in os.listdir(self.directory) if f.endswith(".blk")][0])
+        size = os.path.getsize(path)
+        with open(path, "r+b") as f:
+            f.seek(16)  # past the header of the first block
+            original = f.read(1)
+            f.seek(16)
+            f.write(b"X")
+        self.assertRaises(dbeekeeper.DbeeLogError, self.open_journal)
+        self.assertEqual(os.path.getsize(path), size)
+
+        with open(path, "r+b") as f:
+            f.seek(16)
+            f.write(original)
+        self.journal = self.open_journal()
+        self.assertEqual(self.journal.last_seq, 5)
+
+    def test_subscribe_corrupted_frame(self):
+        # The index of an earlier segment is already on disk, so the
+        # corrupted block is only found when a subscriber reads it.
+        log = local.LocalLog("log", "client1", self.journal)
+        txids = []
+        for i in range(0, 20, 5):
+            txids += self.append(log, ["t%d" % j for j in range(i, i + 5)])
+        self.journal.close()
+        segments = sorted(f for f in os.listdir(self.directory)
+                          if f.endswith(".blk"))
+        self.assertTrue(len(segments) > 1)
+        with open(os.path.join(self.directory, segments[0]), "r+b") as f:
+            f.seek(16)  # past the header of the first block
+            f.write(b"X")
+
+        self.journal = self.open_journal(segment_size=64)
+        log = local.LocalLog("log", "client1", self.journal)
+        result = Result()
+        log.subscribe(txids[0], result)
+        error = result.wait()[0][0]
+        log.close()
+        self.assertIsInstance(error, dbeekeeper.DbeeLogError)
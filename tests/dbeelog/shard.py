@@ -0,0 +1,193 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import dbeekeeper
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from dbeekeeper.dbeelog import local
+from dbeekeeper.dbeelog import shard
+from tests.dbeelog.local import Result
+
+
+class ShardedLog(unittest.TestCase):
+    """Partition transactions across LocalLog shards."""
+
+    shard_count = 3
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journals = [local.Journal(os.path.join(self.directory, str(i)),
+                                       segment_size=64)
+                         for i in range(self.shard_count)]
+
+    def tearDown(self):
+        for journal in self.journals:
+            journal.close()
+        shutil.rmtree(self.directory)
+
+    def open_log(self, client_id, min_checkpoints=3):
+        shards = [local.LocalLog("log%d" % i, client_id, journal,
+                                 min_checkpoints)
+                  for i, journal in enumerate(self.journals)]
+        return shard.ShardedLog("log", client_id, shards,
+                                key_func=lambda t: t.split("=")[0],
+                                min_checkpoints=min_checkpoints)
+
+    def append(self, log, transactions):
+        result = Result()
+        log.append_many(transactions, result)
+        error, txids = result.wait()[0]
+        self.assertIsNone(error)
+        return txids
+
+    def test_transaction_id(self):
+        txid = shard.format_transaction_id(2, "00000000000000000042")
+        self.assertEqual(shard.parse_transaction_id(txid),
+                         (2, "00000000000000000042"))
+        for bad in ("", "42", "x:42", "2:"):
+            self.assertRaises(dbeekeeper.ClientError,
+                              shard.parse_transaction_id, bad)
+        cursor = shard.format_cursor(["0001:a", "0000:b"])
+        self.assertEqual(cursor, "0000:b,0001:a")
+        self.assertEqual(shard.parse_cursor(cursor), {0: "b", 1: "a"})
+        self.assertEqual(shard.parse_cursor(""), {})
+        self.assertRaises(dbeekeeper.ClientError, shard.parse_cursor,
+                          "0001:a,0001:b")
+
+    def test_append(self):
+        log = self.open_log("client1")
+        transactions = ["k%d=%d" % (i % 7, i) for i in range(50)]
+        txids = self.append(log, transactions)
+        self.assertEqual(len(set(txids)), 50)
+        for transaction, txid in zip(transactions, txids):
+            key = transaction.split("=")[0]
+            self.assertEqual(shard.parse_transaction_id(txid)[0],
+                             log.shard_for(key))
+        self.assertTrue(len(set(shard.parse_transaction_id(t)[0]
+                                for t in txids)) > 1)
+
+        result = Result()
+        log.append("v", result, key="k1")
+        error, txid = result.wait()[0]
+        self.assertIsNone(error)
+        self.assertEqual(shard.parse_transaction_id(txid)[0],
+                         log.shard_for("k1"))
+
+    def test_append_without_key(self):
+        log = shard.ShardedLog("log", "client1", [
+            local.LocalLog("log0", "client1", self.journals[0])])
+        result = Result()
+        log.append("t", result)
+        error, txid = result.wait()[0]
+        self.assertIsInstance(error, dbeekeeper.ClientError)
+        result = Result()
+        log.append_many(["t", "u"], result, keys=["k"])
+        self.assertIsInstance(result.wait()[0][0], dbeekeeper.ClientError)
+
+    def test_subscribe(self):
+        writer = self.open_log("client1")
+        reader = self.open_log("client2")
+        transactions = ["k%d=%d" % (i % 5, i) for i in range(30)]
+        txids = self.append(writer, transactions)
+
+        # Start each shard from its first transaction.
+        firsts = {}
+        for txid in txids:
+            firsts.setdefault(shard.parse_transaction_id(txid)[0], txid)
+        result = Result(30)
+        self.assertTrue(reader.subscribe(
+            shard.format_cursor(firsts.values()), result))
+        received = result.wait()
+        reader.close()
+        self.assertEqual(sorted(r[1] for r in received), sorted(txids))
+        # Transactions with the same key arrive in append order.
+        for key in ("k%d" % i for i in range(5)):
+            self.assertEqual([r[3] for r in received
+                              if r[3].startswith(key + "=")],
+                             [t for t in transactions
+                              if t.startswith(key + "=")])
+
+    def test_subscribe_error(self):
+        writer = self.open_log("client1")
+        reader = self.open_log("client2")
+        receivers = []
+        subscribe = reader.shards[0].subscribe
+
+        def record(from_transaction_id, receive_func):
+            receivers.append(receive_func)
+            return subscribe(from_transaction_id, receive_func)
+        reader.shards[0].subscribe = record
+        result = Result(3)
+        reader.subscribe("", result)
+        self.append(writer, ["k%d=%d" % (i, i) for i in range(3)])
+        result.wait()
+
+        # A failing shard ends the subscription of all the shards.
+        error = dbeekeeper.DbeeLogError("shard failed")
+        receivers[0](error, None, None, None)
+        receivers[0](None, "00000000000000000001", "client1", "late")
+        self.append(writer, ["k%d=%d" % (i, i) for i in range(10)])
+        time.sleep(0.2)
+        reader.close()
+        self.assertEqual(len(result.results), 4)
+        self.assertEqual(result.results[3], (error, None, None, None))
+
+    def test_subscribe_fails_partway(self):
+        writer = self.open_log("client1")
+        reader = self.open_log("client2")
+        receivers = []
+        subscribe = reader.shards[0].subscribe
+
+        def record(from_transaction_id, receive_func):
+            receivers.append(receive_func)
+            return subscribe(from_transaction_id, receive_func)
+        reader.shards[0].subscribe = record
+
+        def fail(from_transaction_id, receive_func):
+            raise dbeekeeper.DbeeLogError("shard failed")
+        reader.shards[-1].subscribe = fail
+        result = Result()
+        self.assertRaises(dbeekeeper.DbeeLogError, reader.subscribe, "",
+                          result)
+        # The shards subscribed before the failure are cancelled.
+        self.assertEqual(len(receivers), 2)
+        self.assertIs(receivers[1], shard._discard)
+        self.append(writer, ["k%d=%d" % (i, i) for i in range(10)])
+        time.sleep(0.2)
+        reader.close()
+        self.assertEqual(result.results, [])
+
+    def test_checkpoint(self):
+        writer = self.open_log("client1", min_checkpoints=1)
+        txids = self.append(writer, ["k%d=%d" % (i, i) for i in range(20)])
+        lasts = {}
+        for txid in txids:
+            lasts[shard.parse_transaction_id(txid)[0]] = txid
+        cursor = shard.format_cursor(lasts.values())
+        result = Result()
+        writer.checkpoint(cursor, result)
+        self.assertEqual(result.wait(), [(None, cursor)])
+
+        result = Result()
+        writer.get_checkpoints(result)
+        self.assertEqual(result.wait(), [(None, {"client1": cursor})])
+
+        result = Result()
+        writer.checkpoint("9999:00000000000000000001", result)
+        self.assertIsInstance(result.wait()[0][0], dbeekeeper.ClientError)
@@ -0,0 +1,169 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import dbeekeeper
+import errno
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from dbeekeeper import framing
+from dbeekeeper.dbeelog import local
+from dbeekeeper.dbeelog import spill
+from tests.dbeelog.local import Result
+
+
+class SpillingReceiver(unittest.TestCase):
+    """Spill the entries of a slow subscriber to disk, in order."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_spill(self):
+        release = threading.Event()
+        result = Result(1001)
+
+        def receive(*args):
+            release.wait()
+            result(*args)
+        receiver = spill.SpillingReceiver(receive, max_entries=10,
+                                          directory=self.directory)
+        entries = []
+        for i in range(1000):
+            if i % 3:
+                transaction = "t%d" % i
+            else:
+                transaction = memoryview(framing.encode(b"f%d" % i))
+            entries.append(("%020d" % i, "client%d" % (i % 2), transaction))
+            receiver(None, *entries[-1])
+        receiver(dbeekeeper.DbeeLogError("done"), None, None, None)
+        self.assertTrue(receiver.spilled_bytes > 0)
+        # The spill file is already unlinked.
+        self.assertEqual(os.listdir(self.directory), [])
+
+        release.set()
+        received = result.wait()
+        receiver.close()
+        self.assertEqual([r[1:3] for r in received[:-1]],
+                         [e[:2] for e in entries])
+        for r, e in zip(received, entries):
+            self.assertEqual(type(r[3]), type(e[2]))
+            if isinstance(e[2], memoryview):
+                self.assertEqual(r[3].tobytes(), e[2].tobytes())
+            else:
+                self.assertEqual(r[3], e[2])
+        self.assertIsInstance(received[-1][0], dbeekeeper.DbeeLogError)
+        self.assertEqual(receiver.spilled_bytes, 0)
+
+    def test_spill_while_reading(self):
+        release = threading.Event()
+        reading = threading.Event()
+        resume = threading.Event()
+        result = Result(80)
+
+        def receive(*args):
+            release.wait()
+            result(*args)
+        receiver = spill.SpillingReceiver(receive, max_entries=1,
+                                          directory=self.directory)
+        unspill = receiver._unspill
+
+        def slow_unspill(pos, end):
+            reading.set()
+            resume.wait()
+            return unspill(pos, end)
+        receiver._unspill = slow_unspill
+        entries = [("%020d" % i, "client1", "t%02d" % i) for i in range(80)]
+        for entry in entries[:20]:
+            receiver(None, *entry)
+        release.set()
+        self.assertTrue(reading.wait(10))
+
+        # Spilling goes on while the spill file is being read back.
+        spiller = threading.Thread(target=lambda: [
+            receiver(None, *entry) for entry in entries[20:40]])
+        spiller.start()
+        spiller.join(10)
+        self.assertFalse(spiller.is_alive())
+        resume.set()
+        deadline = time.time() + 10
+        while len(result.results) < 40 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(receiver.spilled_bytes, 0)
+
+        # The drained file is reused, with new records at the same offsets.
+        release.clear()
+        for entry in entries[40:]:
+            receiver(None, *entry)
+        self.assertTrue(receiver.spilled_bytes > 0)
+        release.set()
+        received = result.wait()
+        receiver.close()
+        self.assertEqual([r[1:] for r in received], entries)
+
+    def test_spill_error(self):
+        release = threading.Event()
+        done = threading.Event()
+        received = []
+
+        def receive(*args):
+            release.wait()
+            received.append(args)
+            if args[0] is not None:
+                done.set()
+        receiver = spill.SpillingReceiver(receive, max_entries=2,
+                                          directory=self.directory)
+        spill_ = receiver._spill
+        spilled = []
+
+        def failing_spill(record):
+            if len(spilled) == 3:
+                raise IOError(errno.ENOSPC, "No space left on device")
+            spilled.append(record)
+            spill_(record)
+        receiver._spill = failing_spill
+        entries = [("%020d" % i, "client1", "t%d" % i) for i in range(10)]
+        for entry in entries:
+            receiver(None, *entry)
+        release.set()
+        self.assertTrue(done.wait(10))
+        receiver.close()
+        # The entries before the one that failed to spill, then the error.
+        count = len(received) - 1
+        self.assertTrue(3 < count < 10)
+        self.assertEqual([r[1:] for r in received[:-1]], entries[:count])
+        self.assertIsInstance(received[-1][0], EnvironmentError)
+
+    def test_spilling_log(self):
+        journal = local.Journal(self.directory)
+        log = spill.SpillingLog(local.LocalLog("log", "client1", journal),
+                                max_entries=5)
+        result = Result()
+        log.append_many(["t%d" % i for i in range(100)], result)
+        txids = result.wait()[0][1]
+        result = Result(100)
+        log.subscribe(txids[0], result)
+        received = result.wait()
+        log.close()
+        journal.close()
+        self.assertEqual([r[1] for r in received], txids)
+        self.assertEqual([r[3] for r in received],
+                         ["t%d" % i for i in range(100)])
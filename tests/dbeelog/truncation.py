@@ -0,0 +1,64 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import threading
+import unittest
+
+from dbeekeeper.dbeelog import truncation
+
+
+class CheckpointTracker(unittest.TestCase):
+    """Compute the truncation point from the checkpoints."""
+
+    def test_docstring_example(self):
+        # The example in the dbeelog.Base constructor docstring.
+        tracker = truncation.CheckpointTracker({"client1": 5, "client2": 1,
+                                                "client3": 3, "client4": 6,
+                                                "client5": 4})
+        self.assertEqual(tracker.truncation_point(3), 4)
+        self.assertEqual(tracker.truncation_point(1), 6)
+        self.assertEqual(tracker.truncation_point(5), 1)
+        self.assertIsNone(tracker.truncation_point(6))
+        self.assertIsNone(tracker.truncation_point(0))
+
+    def test_update(self):
+        tracker = truncation.CheckpointTracker()
+        tracker.update("client1", 1)
+        tracker.update("client2", 2)
+        self.assertEqual(tracker.truncation_point(2), 1)
+        tracker.update("client1", 7)
+        tracker.update("client1", 7)
+        self.assertEqual(len(tracker), 2)
+        self.assertEqual(tracker.truncation_point(2), 2)
+        self.assertEqual(tracker.truncation_point(1), 7)
+
+
+class Truncator(unittest.TestCase):
+    """Truncate a log in the background."""
+
+    def test_advance(self):
+        points = []
+        called = threading.Event()
+
+        def truncate(point):
+            points.append(point)
+            called.set()
+        truncator = truncation.Truncator(truncate)
+        truncator.advance(None)
+        truncator.advance(5)
+        self.assertTrue(called.wait(10))
+        truncator.advance(3)
+        truncator.close()
+        self.assertEqual(points, [5])
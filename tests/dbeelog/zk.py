@@ -0,0 +1,297 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import collections
+import dbeekeeper
+import os
+import threading
+import time
+import unittest
+import uuid
+
+from kazoo.client import KazooClient
+from kazoo.handlers.threading import KazooTimeoutError
+
+from dbeekeeper.dbeelog import fakezk
+from dbeekeeper.dbeelog import zk
+from tests.dbeelog.local import Result
+
+
+class ZkLog(unittest.TestCase):
+    """Append, subscribe, and checkpoint a ZooKeeper-backed dbeelog.
+
+    These tests need a ZooKeeper server. Set $ZOOKEEPER to its address if it
+    isn't running on localhost:2181.
+    """
+
+    def setUp(self):
+        self.client = self.connect()
+        self.root = "/dbeekeeper-test-%s" % uuid.uuid4().hex
+
+    def connect(self):
+        client = KazooClient(os.environ.get("ZOOKEEPER", "localhost:2181"))
+        try:
+            client.start(timeout=1)
+        except KazooTimeoutError:
+            client.close()
+            self.skipTest("zookeeper is not available")
+        return client
+
+    def tearDown(self):
+        self.client.delete(self.root, recursive=True)
+        self.client.stop()
+        self.client.close()
+
+    def log(self, client_id, **kwargs):
+        return zk.ZkLog("log", client_id, self.client, root=self.root,
+                        **kwargs)
+
+    def test_append(self):
+        log = self.log("client1", batch_size=7, max_in_flight=2)
+        result = Result(100)
+        for i in range(100):
+            log.append("t%d" % i, result)
+        txids = [txid for error, txid in result.wait()]
+        self.assertEqual(sorted(txids), txids)
+        self.assertEqual(len(set(txids)), 100)
+
+    def test_append_many(self):
+        log = self.log("client1")
+        result = Result()
+        log.append_many(["t%d" % i for i in range(10)], result)
+        error, txids = result.wait()[0]
+        self.assertIsNone(error)
+        seqs = [int(txid) for txid in txids]
+        self.assertEqual(seqs, list(range(seqs[0], seqs[0] + 10)))
+
+    def test_subscribe(self):
+        writer = self.log("client1")
+        reader = self.log("client2")
+        result = Result()
+        writer.append_many(["t%d" % i for i in range(5)], result)
+        txids = result.wait()[0][1]
+
+        result = Result(5)
+        reader.subscribe(txids[2], result)
+        writer.append_many(["t5", "t6"], lambda error, txids: None)
+        received = result.wait()
+        reader.close()
+        self.assertEqual([r[3] for r in received],
+                         ["t2", "t3", "t4", "t5", "t6"])
+        self.assertEqual(set(r[2] for r in received), set(["client1"]))
+
+    def test_subscribe_incremental(self):
+        writer = self.log("client1")
+        client = _Counting(self.client)
+        reader = zk.ZkLog("log", "client2", client, root=self.root)
+        self.append_many(writer, ["t%d" % i for i in range(20)])
+        result = Result(10)
+        reader.subscribe("", result)
+        for i in range(10):
+            self.append_many(writer, ["u%d" % i])
+        self.assertEqual([r[3] for r in result.wait()],
+                         ["u%d" % i for i in range(10)])
+        reader.close()
+        # Only subscribe() lists the log, and only new entries are read.
+        self.assertEqual(client.calls["get_children"], 1)
+        self.assertEqual(client.calls["get_async"], 10)
+
+    def test_subscribe_truncated(self):
+        writer = self.log("client1", min_checkpoints=1)
+        reader = self.log("client2")
+        received = []
+        release = threading.Event()
+        errors = Result()
+
+        def receive(error, txid, client_id, transaction):
+            if error is not None:
+                errors(error)
+                return
+            received.append(transaction)
+            if transaction == "t3":
+                release.wait(10)
+        reader.subscribe("", receive)
+
+        # Truncating entries the reader has read only leaves gaps in the
+        # sequence numbers, which it skips.
+        txids = self.append_many(writer, ["t0", "t1", "t2"])
+        self.wait_for(lambda: len(received) == 3)
+        self.truncate(writer, txids[-1])
+        self.append_many(writer, ["t3"])
+        self.wait_for(lambda: len(received) == 4)
+        # Truncating entries it hasn't read yet ends the subscription.
+        txids = self.append_many(writer, ["t4", "t5", "t6", "t7"])
+        self.truncate(writer, txids[-1])
+        release.set()
+        self.assertIsInstance(errors.wait()[0][0], dbeekeeper.DbeeLogError)
+        self.assertEqual(received, ["t0", "t1", "t2", "t3"])
+
+        result = Result()
+        self.assertRaises(dbeekeeper.DbeeLogError, reader.subscribe,
+                          txids[0], result)
+        reader.close()
+        writer.close()
+
+    def append_many(self, log, transactions):
+        result = Result()
+        log.append_many(transactions, result)
+        return result.wait()[0][1]
+
+    def truncate(self, log, txid):
+        result = Result()
+        log.checkpoint(txid, result)
+        result.wait()
+        self.wait_for(lambda: min(self.client.get_children(
+            self.root + "/log/log")) == "txn-" + txid)
+
+    def wait_for(self, predicate):
+        for i in range(100):
+            if predicate():
+                return
+            time.sleep(0.1)
+        self.fail("timed out")
+
+    def test_checkpoint(self):
+        log1 = self.log("client1")
+        log2 = self.log("client2")
+        result = Result()
+        log1.checkpoint("0000000003", result)
+        self.assertEqual(result.wait(), [(None, "0000000003")])
+
+        result = Result()
+        log2.get_checkpoints(result)
+        self.assertEqual(result.wait(), [(None, {"client1": "0000000003"})])
+
+    def test_checkpoint_coalescing(self):
+        client = _Counting(self.client)
+        log = zk.ZkLog("log", "client1", client, root=self.root)
+        txids = [zk.format_transaction_id(i) for i in range(10)]
+        result = Result(10)
+        for txid in txids:
+            log.checkpoint(txid, result)
+        self.assertEqual(result.wait(), [(None, txid) for txid in txids])
+        self.assertTrue(client.calls["set_async"] < 10)
+        self.assertEqual(
+            self.client.get(self.root + "/log/checkpoints/client1")[0],
+            txids[-1].encode("utf-8"))
+
+    def test_get_checkpoints_cache(self):
+        log1 = self.log("client1")
+        client = _Counting(self.client)
+        log2 = zk.ZkLog("log", "client2", client, root=self.root)
+        result = Result()
+        log1.checkpoint("0000000003", result)
+        result.wait()
+
+        result = Result()
+        log2.get_checkpoints(result)
+        result.wait()
+        reads = dict(client.calls)
+        result = Result()
+        log2.get_checkpoints(result)
+        self.assertEqual(result.wait(), [(None, {"client1": "0000000003"})])
+        self.assertEqual(client.calls, reads)
+
+        # A client sees its own checkpoint as soon as it is acknowledged.
+        for i in range(20):
+            txid = zk.format_transaction_id(i)
+            result = Result()
+            log2.checkpoint(txid, result)
+            result.wait()
+            result = Result()
+            log2.get_checkpoints(result)
+            self.assertEqual(result.wait(), [(None, {"client1": "0000000003",
+                                                     "client2": txid})])
+
+        # Another client's checkpoint only costs a read of its own znode.
+        result = Result()
+        log2.get_checkpoints(result)
+        result.wait()
+        reads = collections.Counter(client.calls)
+        result = Result()
+        log1.checkpoint("0000000004", result)
+        result.wait()
+        for _ in range(100):
+            if "client1" not in log2._cached_values:
+                break
+            time.sleep(0.01)
+        result = Result()
+        log2.get_checkpoints(result)
+        self.assertEqual(result.wait()[0][1]["client1"], "0000000004")
+        self.assertEqual(client.calls - reads, {"get_async": 1})
+
+    def test_truncate(self):
+        logs = [self.log("client%d" % i, min_checkpoints=2)
+                for i in range(3)]
+        result = Result()
+        logs[0].append_many(["t%d" % i for i in range(10)], result)
+        txids = result.wait()[0][1]
+
+        result = Result(3)
+        logs[0].checkpoint(txids[8], result)
+        logs[1].checkpoint(txids[2], result)
+        logs[2].checkpoint(txids[5], result)
+        result.wait()
+        for i in range(100):
+            children = self.client.get_children(self.root + "/log/log")
+            if min(children) == "txn-" + txids[5]:
+                break
+            time.sleep(0.1)
+        for log in logs:
+            log.close()
+        self.assertEqual(sorted(children), ["txn-" + t for t in txids[5:]])
+
+    def test_append_rejects_non_utf8(self):
+        if str is bytes:
+            return
+        result = Result()
+        self.log("client1").append(b"\xff\xfe", result)
+        self.assertIsInstance(result.wait()[0][0], dbeekeeper.ClientError)
+
+    def test_checkpoint_malformed(self):
+        result = Result()
+        self.log("client1").checkpoint("bogus", result)
+        self.assertIsInstance(result.wait()[0][0], dbeekeeper.ClientError)
+
+
+class _Counting(object):
+    """Client proxy that counts the calls to each method."""
+
+    def __init__(self, client):
+        self._client = client
+        self.calls = collections.Counter()
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+
+        def call(*args, **kwargs):
+            self.calls[name] += 1
+            return method(*args, **kwargs)
+        return call
+
+
+class FakeZkLog(ZkLog):
+    """Run the ZkLog tests against a fake ZooKeeper with some latency."""
+
+    def connect(self):
+        self.server = fakezk.FakeServer(latency=0.001, fsync=0.001,
+                                        jitter=0.001, seed=0)
+        client = fakezk.FakeClient(self.server)
+        client.start()
+        return client
+
+    def tearDown(self):
+        super(FakeZkLog, self).tearDown()
+        self.server.close()
@@ -29,6 +29,9 @@ class Error(unittest.TestCase):
     def raise_dbeeerror(self):
         raise dbeekeeper.DbeeError("dbee error")
 
+    def raise_dbeelogerror(self):
+        raise dbeekeeper.DbeeLogError("dbeelog error")
+
     def test_clienterror(self):
         with self.assertRaises(dbeekeeper.ClientError):
             self.raise_clienterror()
@@ -36,3 +39,7 @@ class Error(unittest.TestCase):
     def test_servererror(self):
         with self.assertRaises(dbeekeeper.DbeeError):
             self.raise_dbeeerror()
+
+    def test_dbeelogerror(self):
+        with self.assertRaises(dbeekeeper.DbeeLogError):
+            self.raise_dbeelogerror()
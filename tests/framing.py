@@ -0,0 +1,61 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import dbeekeeper
+import unittest
+
+from dbeekeeper import framing
+
+
+class Framing(unittest.TestCase):
+    """Encode, decode, and verify transaction frames."""
+
+    def test_roundtrip(self):
+        frame = framing.encode(b"payload", b"header")
+        self.assertTrue(framing.is_frame(frame))
+        self.assertTrue(framing.is_frame(memoryview(frame)))
+        header, payload = framing.decode(frame)
+        self.assertEqual(header.tobytes(), b"header")
+        self.assertEqual(payload.tobytes(), b"payload")
+        header, payload = framing.decode(framing.encode(b""))
+        self.assertEqual(len(header), 0)
+        self.assertEqual(len(payload), 0)
+
+    def test_strings_are_not_frames(self):
+        self.assertFalse(framing.is_frame(u"\u06ee"))
+        self.assertFalse(framing.is_frame(u"\u06ee".encode("utf-8")))
+        self.assertEqual(framing.unpack_transaction(b"abc"), "abc")
+
+    def test_not_utf8(self):
+        framing.check_transaction(b"abc")
+        framing.check_transaction(framing.encode(b"\xff"))
+        if str is bytes:
+            return
+        self.assertRaises(dbeekeeper.ClientError,
+                          framing.check_transaction, b"\xff\xfe")
+        self.assertRaises(dbeekeeper.DbeeLogError,
+                          framing.unpack_transaction, b"\xff\xfe")
+
+    def test_corrupted(self):
+        frame = bytearray(framing.encode(b"payload"))
+        self.assertRaises(dbeekeeper.DbeeLogError, framing.decode,
+                          frame[:-1])
+        self.assertRaises(dbeekeeper.DbeeLogError, framing.decode,
+                          frame[:4])
+        frame[-1] ^= 0xff
+        self.assertRaises(dbeekeeper.DbeeLogError, framing.decode, frame)
+        framing.decode(frame, verify=False)
+        self.assertRaises(dbeekeeper.DbeeLogError,
+                          framing.unpack_transaction, frame)
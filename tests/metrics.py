@@ -0,0 +1,128 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from dbeekeeper import metrics
+from dbeekeeper import recovery
+from dbeekeeper.dbee import memory
+from dbeekeeper.dbeelog import local
+from tests.dbeelog.local import Result
+
+
+class Registry(unittest.TestCase):
+    """Record metrics and export them to sinks."""
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_metrics(self):
+        self.registry.counter("c").increment()
+        self.registry.counter("c").increment(2)
+        self.registry.gauge("g").set(5)
+        histogram = self.registry.histogram("h")
+        for value in (0, 1e-6, 1.5e-6, 3e-6, 1.0):
+            histogram.observe(value)
+        collected = self.registry.collect()
+        self.assertEqual(collected["counters"], {"c": 3})
+        self.assertEqual(collected["gauges"], {"g": 5})
+        h = collected["histograms"]["h"]
+        self.assertEqual(h["count"], 5)
+        self.assertEqual([n for _, n in h["buckets"]], [2, 1, 1, 1])
+        for value, (bound, _) in zip((1e-6, 1.5e-6, 3e-6, 1.0),
+                                     h["buckets"]):
+            self.assertTrue(value <= bound < 2 * value)
+        self.assertRaises(TypeError, self.registry.counter, "g")
+
+    def test_sinks(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "metrics")
+            memory_sink = metrics.MemorySink()
+            self.registry.add_sink(metrics.FileSink(path))
+            self.registry.add_sink(memory_sink)
+            self.registry.counter("c").increment()
+            exporter = metrics.Exporter(60, self.registry)
+            exporter.close()
+            self.registry.export()
+            self.assertEqual(memory_sink.metrics["counters"], {"c": 1})
+            with open(path) as f:
+                lines = [json.loads(line) for line in f]
+            self.assertEqual(len(lines), 2)
+            self.assertEqual(lines[-1]["metrics"]["counters"], {"c": 1})
+        finally:
+            shutil.rmtree(directory)
+
+
+class Instrumentation(unittest.TestCase):
+    """dbeelogs, dbees and recovery report to the module-level registry."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        metrics.registry.clear()
+
+    def tearDown(self):
+        metrics.disable()
+        metrics.registry.clear()
+        shutil.rmtree(self.directory)
+
+    def test_disabled(self):
+        callback = Result()
+        self.assertIs(metrics.timed("t", callback), callback)
+        metrics.observe("h", 1)
+        metrics.increment("c")
+        self.assertEqual(metrics.registry.collect(),
+                         {"counters": {}, "gauges": {}, "histograms": {}})
+
+    def test_enabled(self):
+        metrics.enable()
+        journal = local.Journal(os.path.join(self.directory, "log"))
+        log = local.LocalLog("log", "client1", journal, min_checkpoints=1)
+        result = Result()
+        log.append_many([memory.put("k%d" % i, "v") for i in range(10)],
+                        result)
+        txids = result.wait()[0][1]
+        result = Result()
+        log.checkpoint(txids[-1], result)
+        result.wait()
+
+        dbee = memory.MemoryDbee()
+        filename = os.path.join(self.directory, "snapshot")
+        result = Result()
+        dbee.snapshot(filename, result)
+        result.wait()
+        replayer = recovery.recover(dbee, log, filename, txids[0])
+        self.assertTrue(replayer.wait(txids[-1], timeout=10))
+        replayer.close()
+        log.close()
+        journal.close()
+
+        collected = metrics.registry.collect()
+        self.assertEqual(collected["counters"],
+                         {"dbeelog.append.transactions": 10,
+                          "dbee.transactions": 10})
+        self.assertEqual(collected["gauges"],
+                         {"dbeelog.checkpoint.spread": 0})
+        histograms = collected["histograms"]
+        for name in ("dbeelog.append.latency", "dbeelog.subscribe.lag",
+                     "dbee.execute.duration", "dbee.execute_batch.duration",
+                     "dbee.snapshot.duration", "dbee.snapshot.bytes",
+                     "dbee.restore.duration"):
+            self.assertTrue(histograms[name]["count"] > 0, name)
+        self.assertEqual(histograms["dbee.execute.duration"]["count"], 10)
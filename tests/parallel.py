@@ -0,0 +1,117 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import dbeekeeper
+import threading
+import time
+import unittest
+
+from dbeekeeper import parallel
+from dbeekeeper.dbee import memory
+
+
+class SlowDbee(memory.MemoryDbee):
+    """MemoryDbee that records the order and concurrency of execute()."""
+
+    def __init__(self, fail_on=None):
+        super(SlowDbee, self).__init__()
+        self.order = []
+        self.running = 0
+        self.max_running = 0
+        self._fail_on = fail_on
+        self._lock = threading.Lock()
+
+    def execute(self, transaction):
+        with self._lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.01)
+        with self._lock:
+            self.running -= 1
+            self.order.append(transaction)
+        if transaction == self._fail_on:
+            raise dbeekeeper.DbeeError("dbee failure")
+        super(SlowDbee, self).execute(transaction)
+
+
+class Plan(unittest.TestCase):
+    """Order transactions by their key sets."""
+
+    def test_plan(self):
+        pending, dependents = parallel.plan([
+            ((), ("a",)),       # 0
+            ((), ("b",)),       # 1
+            (("a",), ("c",)),   # 2: reads what 0 writes
+            ((), ("a",)),       # 3: writes what 0 writes and 2 reads
+            None,               # 4: everything before
+            ((), ("d",)),       # 5: after 4
+        ])
+        self.assertEqual(pending, [0, 0, 1, 2, 4, 1])
+        self.assertEqual([sorted(d) for d in dependents],
+                         [[2, 3, 4], [4], [3, 4], [4], [5], []])
+
+
+class ParallelExecutor(unittest.TestCase):
+    """Execute non-conflicting transactions concurrently."""
+
+    def test_execute_batch(self):
+        dbee = SlowDbee()
+        executor = parallel.ParallelExecutor(dbee, workers=4)
+        transactions = []
+        for i in range(10):
+            for key in "abcd":
+                transactions.append(memory.put(key, str(i)))
+        transactions.insert(20, "bogus")
+        errors = executor.execute_batch(transactions)
+        executor.close()
+        self.assertIsInstance(errors[20], dbeekeeper.ClientError)
+        self.assertEqual(errors.count(None), 40)
+        self.assertTrue(dbee.max_running > 1)
+        for key in "abcd":
+            self.assertEqual(dbee.get(key), "9")
+            self.assertEqual([t for t in dbee.order
+                              if t != "bogus" and
+                              memory._parse(t)[1] == key],
+                             [memory.put(key, str(i)) for i in range(10)])
+        # Nothing after the transaction without a key set started before it.
+        bogus = dbee.order.index("bogus")
+        self.assertEqual(set(dbee.order[:bogus]), set(transactions[:20]))
+
+    def test_batches(self):
+        dbee = SlowDbee()
+        batches = []
+        execute_batch = dbee.execute_batch
+
+        def record(transactions):
+            batches.append(transactions)
+            return execute_batch(transactions)
+        dbee.execute_batch = record
+        executor = parallel.ParallelExecutor(dbee, workers=2)
+        transactions = [memory.put("key%d" % i, "0") for i in range(10)]
+        self.assertEqual(executor.execute_batch(transactions), [None] * 10)
+        executor.close()
+        # Independent transactions go to the dbee's execute_batch() together.
+        self.assertEqual(sorted(t for b in batches for t in b),
+                         sorted(transactions))
+        self.assertTrue(max(len(b) for b in batches) > 1)
+
+    def test_dbee_error(self):
+        dbee = SlowDbee(fail_on=memory.put("a", "1"))
+        executor = parallel.ParallelExecutor(dbee, workers=2)
+        self.assertRaises(dbeekeeper.DbeeError, executor.execute_batch,
+                          [memory.put("a", "0"), memory.put("a", "1"),
+                           memory.put("a", "2")])
+        executor.close()
+        self.assertEqual(dbee.get("a"), "0")
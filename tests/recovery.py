@@ -0,0 +1,139 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import dbeekeeper
+import os
+import shutil
+import tempfile
+import unittest
+
+from dbeekeeper import recovery
+from dbeekeeper.dbee import memory
+from dbeekeeper.dbeelog import local
+from tests.dbeelog.local import Result
+
+
+class BatchDbee(memory.MemoryDbee):
+    """MemoryDbee that records the size of each batch."""
+
+    def __init__(self, fail_on=None):
+        super(BatchDbee, self).__init__()
+        self.batches = []
+        self._fail_on = fail_on
+
+    def execute(self, transaction):
+        if transaction == self._fail_on:
+            raise dbeekeeper.DbeeError("dbee failure")
+        super(BatchDbee, self).execute(transaction)
+
+    def execute_batch(self, transactions):
+        self.batches.append(len(transactions))
+        return super(BatchDbee, self).execute_batch(transactions)
+
+
+class Recovery(unittest.TestCase):
+    """Restore a dbee and replay the log in batches."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal = local.Journal(os.path.join(self.directory, "log"))
+        self.log = local.LocalLog("log", "client1", self.journal)
+
+    def tearDown(self):
+        self.log.close()
+        self.journal.close()
+        shutil.rmtree(self.directory)
+
+    def append(self, transactions):
+        result = Result()
+        self.log.append_many(transactions, result)
+        return result.wait()[0][1]
+
+    def test_recover(self):
+        txids = self.append([memory.put("k%d" % i, str(i))
+                             for i in range(50)])
+        dbee = memory.MemoryDbee()
+        dbee.execute_batch([memory.put("k%d" % i, str(i))
+                            for i in range(10)])
+        filename = os.path.join(self.directory, "snapshot")
+        result = Result()
+        dbee.snapshot(filename, result)
+        result.wait()
+        txids += self.append(["bogus"] + [
+            memory.put("k%d" % i, str(i)) for i in range(50, 100)])
+
+        dbee = BatchDbee()
+        replayer = recovery.recover(dbee, self.log, filename, txids[10],
+                                    batch_size=40)
+        self.assertTrue(replayer.wait(txids[-1], timeout=10))
+        replayer.close()
+        self.assertEqual(len(dbee), 100)
+        self.assertEqual(dbee.get("k99"), "99")
+        self.assertEqual(sum(dbee.batches), 91)
+        self.assertTrue(max(dbee.batches) <= 40)
+        self.assertTrue(len(dbee.batches) < 91)
+
+    def test_workers(self):
+        txids = self.append([memory.put("k%d" % (i % 10), str(i))
+                             for i in range(100)])
+        dbee = memory.MemoryDbee()
+        replayer = recovery.recover(dbee, self.log, None, txids[0],
+                                    workers=4)
+        self.assertTrue(replayer.wait(txids[-1], timeout=10))
+        replayer.close()
+        self.assertEqual(len(dbee), 10)
+        self.assertEqual(dbee.get("k3"), "93")
+
+    def test_dbee_error(self):
+        txids = self.append([memory.put("a", "1"), memory.put("b", "2"),
+                             memory.put("c", "3")])
+        dbee = BatchDbee(fail_on=memory.put("b", "2"))
+        replayer = recovery.recover(dbee, self.log, None, txids[0])
+        self.assertRaises(dbeekeeper.DbeeError, replayer.wait, txids[-1])
+        replayer.close()
+        self.assertEqual(dbee.get("a"), "1")
+        self.assertIsNone(dbee.get("c"))
+
+    def test_watermark(self):
+        txids = self.append([memory.put("k%d" % i, str(i))
+                             for i in range(20)])
+        replayer = recovery.recover(memory.MemoryDbee(), self.log, None,
+                                    txids[0])
+        self.assertTrue(replayer.wait(txids[-1], timeout=10))
+        filename = os.path.join(self.directory, "snapshot")
+        result = Result()
+        replayer.snapshot(filename, result)
+        self.assertEqual(result.wait(), [(None, filename)])
+        replayer.close()
+        self.assertEqual(recovery.read_watermark(filename), txids[-1])
+
+        txids += self.append([memory.put("k%d" % i, str(i))
+                              for i in range(20, 30)])
+        dbee = BatchDbee()
+        replayer = recovery.recover(dbee, self.log, filename)
+        self.assertTrue(replayer.wait(txids[-1], timeout=10))
+        replayer.close()
+        self.assertEqual(len(dbee), 30)
+        self.assertEqual(sum(dbee.batches), 10)
+
+    def test_no_watermark(self):
+        dbee = memory.MemoryDbee()
+        filename = os.path.join(self.directory, "snapshot")
+        result = Result()
+        dbee.snapshot(filename, result)
+        result.wait()
+        self.assertIsNone(recovery.read_watermark(filename))
+        self.assertRaises(dbeekeeper.ClientError, recovery.recover,
+                          memory.MemoryDbee(), self.log, filename)
@@ -0,0 +1,145 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from dbeekeeper import recovery
+from dbeekeeper import scheduler
+from dbeekeeper.dbee import memory
+from dbeekeeper.dbeelog import local
+from tests.dbeelog.local import Result
+
+
+class FakeReplayer(object):
+    """Replayer with stats set by the test."""
+
+    def __init__(self):
+        self.stats = (0, 0.0)
+        self.snapshots = []
+
+    def snapshot(self, filename, callback):
+        self.snapshots.append((filename, callback))
+
+
+class FakeLog(object):
+
+    def __init__(self):
+        self.checkpoints = []
+
+    def checkpoint(self, transaction_id, callback):
+        self.checkpoints.append(transaction_id)
+        callback(None, transaction_id)
+
+
+class SnapshotScheduler(unittest.TestCase):
+    """Snapshot when the estimated replay time reaches the target."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.now = 0.0
+        self.count = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def clock(self):
+        return self.now
+
+    def filename(self):
+        self.count += 1
+        return os.path.join(self.directory, "snapshot%d" % self.count)
+
+    def test_schedule(self):
+        replayer = FakeReplayer()
+        log = FakeLog()
+        s = scheduler.SnapshotScheduler(replayer, log, self.filename, 5.0,
+                                        min_snapshot_interval=0,
+                                        clock=self.clock)
+        self.assertFalse(s.tick())
+        self.assertIsNone(s.estimate())
+
+        # 1000 transactions per second of execute time, 100 per second.
+        self.now, replayer.stats = 10.0, (1000, 1.0)
+        self.assertFalse(s.tick())
+        self.assertAlmostEqual(s.estimate(), 1.0)
+
+        self.now, replayer.stats = 20.0, (6000, 6.0)
+        self.assertTrue(s.tick())
+        self.assertTrue(s.snapshotting)
+        self.now, replayer.stats = 30.0, (9000, 9.0)
+        self.assertFalse(s.tick())
+        self.assertEqual(len(replayer.snapshots), 1)
+
+        filename, callback = replayer.snapshots[0]
+        recovery._write_watermark(filename, "0042")
+        self.now = 32.0
+        callback(None, filename)
+        self.assertFalse(s.snapshotting)
+        self.assertEqual(log.checkpoints, ["0042"])
+        # The backlog starts over at the snapshot, and includes what arrives
+        # while the next snapshot would be taken.
+        arrival = 100 + 0.3 * (500 - 100)
+        arrival += 0.3 * (300 - arrival)
+        self.assertAlmostEqual(s.estimate(), (3000 + arrival * 12) / 1000)
+
+    def test_failed_snapshot(self):
+        replayer = FakeReplayer()
+        log = FakeLog()
+        s = scheduler.SnapshotScheduler(replayer, log, self.filename, 1.0,
+                                        min_snapshot_interval=5,
+                                        clock=self.clock)
+        s.tick()
+        self.now, replayer.stats = 1.0, (5000, 1.0)
+        self.assertTrue(s.tick())
+        replayer.snapshots[0][1](Exception("failed"), None)
+        self.assertFalse(s.snapshotting)
+        self.assertEqual(log.checkpoints, [])
+        # Retried once min_snapshot_interval has passed.
+        self.now = 3.0
+        self.assertFalse(s.tick())
+        self.now = 6.0
+        self.assertTrue(s.tick())
+
+    def test_replayer(self):
+        journal = local.Journal(os.path.join(self.directory, "log"))
+        log = local.LocalLog("log", "client1", journal, min_checkpoints=1)
+        result = Result()
+        log.append_many([memory.put("k%d" % i, str(i)) for i in range(100)],
+                        result)
+        txids = result.wait()[0][1]
+        replayer = recovery.recover(memory.MemoryDbee(), log, None, txids[0])
+        self.assertTrue(replayer.wait(txids[-1], timeout=10))
+
+        s = scheduler.SnapshotScheduler(replayer, log, self.filename, 0.0,
+                                        min_snapshot_interval=0,
+                                        clock=self.clock)
+        self.assertFalse(s.tick())
+        result = Result()
+        log.append(memory.put("a", "1"), result)
+        txid = result.wait()[0][1]
+        self.assertTrue(replayer.wait(txid, timeout=10))
+        self.now = 1.0
+        self.assertTrue(s.tick())
+        while s.snapshotting:
+            replayer.wait(txid, timeout=0.1)
+        result = Result()
+        log.get_checkpoints(result)
+        self.assertEqual(result.wait(), [(None, {"client1": txid})])
+        replayer.close()
+        log.close()
+        journal.close()
@@ -0,0 +1,122 @@
+# Copyright 2013 VMware, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import dbeekeeper
+import os
+import shutil
+import tempfile
+import unittest
+
+from dbeekeeper import recovery
+from dbeekeeper import transfer
+from dbeekeeper.dbee import memory
+from dbeekeeper.dbeelog import local
+from tests.dbeelog.local import Result
+
+
+class Transfer(unittest.TestCase):
+    """Ship a snapshot to a peer and bootstrap a replica from it."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, "source")
+        self.target = os.path.join(self.directory, "target")
+        os.mkdir(self.source)
+        os.mkdir(self.target)
+        self.journal = local.Journal(os.path.join(self.directory, "log"))
+        self.log = local.LocalLog("log", "client1", self.journal)
+        self.server = transfer.SnapshotServer()
+
+    def tearDown(self):
+        self.server.close()
+        self.log.close()
+        self.journal.close()
+        shutil.rmtree(self.directory)
+
+    def append(self, transactions):
+        result = Result()
+        self.log.append_many(transactions, result)
+        return result.wait()[0][1]
+
+    def snapshot(self, count=1000):
+        """Replay count transactions and publish a snapshot of them."""
+        txids = self.append([memory.put("k%d" % i, "v" * 100)
+                             for i in range(count)])
+        replayer = recovery.recover(memory.MemoryDbee(), self.log, None,
+                                    txids[0])
+        self.assertTrue(replayer.wait(txids[-1], timeout=10))
+        filename = os.path.join(self.source, "snapshot")
+        result = Result()
+        replayer.snapshot(filename, result)
+        self.assertEqual(result.wait(), [(None, filename)])
+        replayer.close()
+        self.server.publish(filename)
+        return filename, txids
+
+    def read(self, filename):
+        with open(filename, "rb") as f:
+            return f.read()
+
+    def test_fetch(self):
+        filename, txids = self.snapshot()
+        fetched = transfer.fetch(self.server.address, self.target,
+                                 chunk_size=1000)
+        self.assertEqual(fetched, os.path.join(self.target, "snapshot"))
+        self.assertEqual(self.read(fetched), self.read(filename))
+        self.assertEqual(recovery.read_watermark(fetched), txids[-1])
+        self.assertEqual(sorted(os.listdir(self.target)),
+                         ["snapshot", "snapshot.meta"])
+
+    def test_resume(self):
+        filename, _ = self.snapshot()
+        data = self.read(filename)
+        part = os.path.join(self.target, "snapshot.part")
+        with open(part, "wb") as f:
+            f.write(data[:len(data) // 2])
+        fetched = transfer.fetch(self.server.address, self.target)
+        self.assertEqual(self.read(fetched), data)
+
+        # A corrupted partial download is detected and downloaded again.
+        os.remove(fetched)
+        with open(part, "wb") as f:
+            f.write(b"X" * 100)
+        fetched = transfer.fetch(self.server.address, self.target)
+        self.assertEqual(self.read(fetched), data)
+
+    def test_no_snapshot(self):
+        self.assertRaises(dbeekeeper.DbeeError, transfer.fetch,
+                          self.server.address, self.target, retries=0)
+
+    def test_unix_socket(self):
+        filename, _ = self.snapshot(10)
+        self.server.close()
+        self.server = transfer.SnapshotServer(
+            os.path.join(self.directory, "socket"))
+        self.server.publish(filename)
+        fetched = transfer.fetch(self.server.address, self.target)
+        self.assertEqual(self.read(fetched), self.read(filename))
+
+    def test_bootstrap(self):
+        _, txids = self.snapshot(100)
+        txids += self.append([memory.put("k%d" % i, "new")
+                              for i in range(50, 150)])
+        dbee = memory.MemoryDbee()
+        replayer = transfer.bootstrap(dbee, self.log, self.server.address,
+                                      self.target, batch_size=10)
+        self.assertTrue(replayer.wait(txids[-1], timeout=10))
+        replayer.close()
+        self.assertEqual(len(dbee), 150)
+        self.assertEqual(dbee.get("k0"), "v" * 100)
+        self.assertEqual(dbee.get("k99"), "new")